@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for cigarbox.bitops.Bitmap, HierBitmap and SparseBitmap
+
+Runs each scenario against each map class and prints the results as JSON
+(see benchutil).  Scenarios, on a map of N bits:
+
+    search      ffs/fls on a map with only the far end set, and ffc/flc
+                on a map with only the far end clear: the worst case,
+                where every word in between is skipped
+    bulk        zero(), fill(), and growing the map from empty to N bits
+    setops      set_range(), popcount(), |=, &, andnot(), iter_set() and
+                set_many() between maps each holding half the bits
+    alloc       allocating ids with ffc()+set() and freeing them with
+                clr(), the way event.Loop allocates timer idents, with
+                the low half of the map already in use
+"""
+
+import argparse
+import random
+import sys
+
+import benchutil
+
+from cigarbox import bitops
+
+def _searches(cls, nbits, reps):
+    results = []
+    m = cls(nbits, resizeable=False)
+    m.set(nbits - 1)
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            m.ffs()
+    results.append(benchutil.result('ffs', reps, t, nbits=nbits,
+            cls=cls.__name__))
+
+    m.zero()
+    m.set(0)
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            m.fls()
+    results.append(benchutil.result('fls', reps, t, nbits=nbits,
+            cls=cls.__name__))
+
+    m.fill()
+    m.clr(nbits - 1)
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            m.ffc()
+    results.append(benchutil.result('ffc', reps, t, nbits=nbits,
+            cls=cls.__name__))
+
+    m.fill()
+    m.clr(0)
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            m.flc()
+    results.append(benchutil.result('flc', reps, t, nbits=nbits,
+            cls=cls.__name__))
+    return results
+
+def _bulk(cls, nbits, reps):
+    results = []
+    m = cls(nbits, resizeable=False)
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            m.zero()
+    results.append(benchutil.result('zero', reps, t, nbits=nbits,
+            cls=cls.__name__))
+
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            m.fill()
+    results.append(benchutil.result('fill', reps, t, nbits=nbits,
+            cls=cls.__name__))
+
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            m = cls(0)
+            m.resize(nbits)
+    results.append(benchutil.result('resize', reps, t, nbits=nbits,
+            cls=cls.__name__))
+    return results
+
+def _setops(cls, nbits, reps):
+    results = []
+    a = cls(nbits, resizeable=False)
+    b = cls(nbits, resizeable=False)
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            a.set_range(0, nbits // 2)
+    results.append(benchutil.result('set_range', reps, t, nbits=nbits,
+            cls=cls.__name__))
+    b.set_range(nbits // 4, nbits - nbits // 4)
+
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            a.popcount()
+    results.append(benchutil.result('popcount', reps, t, nbits=nbits,
+            cls=cls.__name__))
+
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            a |= b
+    results.append(benchutil.result('ior', reps, t, nbits=nbits,
+            cls=cls.__name__))
+
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            a & b
+    results.append(benchutil.result('and', reps, t, nbits=nbits,
+            cls=cls.__name__))
+
+    with benchutil.Timer() as t:
+        for i in xrange(reps):
+            a.andnot(b)
+    results.append(benchutil.result('andnot', reps, t, nbits=nbits,
+            cls=cls.__name__))
+
+    # iter_set and set_many touch every bit, so run them once
+    a.zero()
+    a.set_many(xrange(0, nbits, 64))
+    with benchutil.Timer() as t:
+        for i in a.iter_set():
+            pass
+    results.append(benchutil.result('iter_set', 1, t, nbits=nbits,
+            cls=cls.__name__))
+
+    ids = range(0, nbits, 3)
+    with benchutil.Timer() as t:
+        a.set_many(ids)
+    results.append(benchutil.result('set_many', 1, t, nbits=nbits,
+            cls=cls.__name__, nids=len(ids)))
+    return results
+
+def _alloc(cls, nbits, nids):
+    m = cls(nbits, resizeable=False)
+    for i in xrange(nbits // 2):
+        m.set(i)
+    nids = min(nids, nbits - nbits // 2)
+    ids = []
+    with benchutil.Timer() as t:
+        for i in xrange(nids):
+            ident = m.ffc()
+            m.set(ident)
+            ids.append(ident)
+        random.shuffle(ids)
+        for ident in ids:
+            m.clr(ident)
+    return [benchutil.result('alloc', nids, t, nbits=nbits,
+            cls=cls.__name__)]
+
+_CLASSES = {
+    'Bitmap': bitops.Bitmap,
+    'HierBitmap': bitops.HierBitmap,
+    'SparseBitmap': bitops.SparseBitmap,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0],
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--cls', action='append',
+            choices=sorted(_CLASSES),
+            help='map class to run (repeatable; default: all)')
+    parser.add_argument('-s', '--scenario', action='append',
+            choices=('search', 'bulk', 'setops', 'alloc'),
+            help='scenario to run (repeatable; default: all)')
+    parser.add_argument('-n', '--nbits', type=int, action='append',
+            help='map size in bits (repeatable; default: 1000 and 1000000)')
+    parser.add_argument('-q', '--quick', action='store_true',
+            help='use small sizes, for a smoke test')
+    args = parser.parse_args(argv)
+
+    classes = [_CLASSES[c] for c in args.cls or sorted(_CLASSES)]
+    scenarios = args.scenario or ('search', 'bulk', 'setops', 'alloc')
+    if args.quick:
+        sizes, reps, nids = args.nbits or (1000, 100000), 10, 100
+    else:
+        sizes, reps, nids = args.nbits or (1000, 1000000), 100, 10000
+
+    results = []
+    for cls in classes:
+        for nbits in sizes:
+            # small maps need more repetitions to be measurable
+            n = max(reps, (reps * 1000000) // nbits)
+            if 'search' in scenarios:
+                results.extend(_searches(cls, nbits, n))
+            if 'bulk' in scenarios:
+                results.extend(_bulk(cls, nbits, n))
+            if 'setops' in scenarios:
+                results.extend(_setops(cls, nbits, max(1, n // 100)))
+            if 'alloc' in scenarios:
+                results.extend(_alloc(cls, nbits, nids))
+    benchutil.report('bitops', results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
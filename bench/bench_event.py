@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for cigarbox.event.Loop
+
+Runs each scenario against each readiness backend and prints the results
+as JSON (see benchutil).  The soft RLIMIT_NOFILE is raised to the hard
+limit first; sizes that still need more fds are reported as skipped.
+Scenarios:
+
+    idle        N idle fds plus one active pipe; measures the wakeup
+                latency of the active pipe as N grows
+    pingpong    round trips over a socketpair
+    timers      N one-shot timers with random timeouts, half of them
+                cancelled before they fire
+    churn       registering and unregistering N fds on alternate
+                iterations
+"""
+
+import argparse
+import os
+import random
+import resource
+import socket
+
+import benchutil
+
+from cigarbox import event
+
+# select(2) cannot watch fds at or above FD_SETSIZE
+_FD_SETSIZE = 1024
+
+# fds a scenario needs besides its pipes: stdio, the loop's own, and so on
+_FD_SLACK = 32
+
+def _raise_nofile():
+    # the larger idle sizes need more fds than the usual soft limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        want = hard if hard != resource.RLIM_INFINITY else 65536
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+        except (ValueError, OSError):
+            pass
+
+def _too_many_fds(npipes):
+    # the skip reason if npipes pipes do not fit under RLIMIT_NOFILE
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    need = 2 * npipes + _FD_SLACK
+    if soft != resource.RLIM_INFINITY and need > soft:
+        return 'needs %d fds, RLIMIT_NOFILE is %d' % (need, soft)
+    return None
+
+def _noop(what, loop):
+    pass
+
+def bench_idle(backend, nidle, rounds):
+    skipped = _too_many_fds(nidle + 1)
+    if skipped:
+        return {'name': 'idle', 'backend': backend, 'nidle': nidle,
+                'skipped': skipped}
+    loop = event.Loop(backend=backend)
+    pipes = [os.pipe() for i in xrange(nidle)]
+    rfd, wfd = os.pipe()
+    try:
+        if backend == 'select' and wfd >= _FD_SETSIZE:
+            return {'name': 'idle', 'backend': backend, 'nidle': nidle,
+                    'skipped': 'fd >= FD_SETSIZE'}
+        for r, w in pipes:
+            loop.add(r, _noop, event.READ|event.PERSIST)
+
+        latencies = []
+        state = {'sent': 0.0, 'n': 0}
+        def on_read(what, loop):
+            os.read(rfd, 1)
+            latencies.append((event.monotonic() - state['sent']) * 1e6)
+            state['n'] += 1
+            if state['n'] == rounds:
+                loop.stop()
+            else:
+                state['sent'] = event.monotonic()
+                os.write(wfd, 'x')
+        loop.add(rfd, on_read, event.READ|event.PERSIST)
+
+        with benchutil.Timer() as t:
+            state['sent'] = event.monotonic()
+            os.write(wfd, 'x')
+            loop.run()
+        return benchutil.result('idle', rounds, t, backend=backend,
+                nidle=nidle, latency_us=benchutil.percentiles(latencies))
+    finally:
+        loop.close()
+        for r, w in pipes + [(rfd, wfd)]:
+            os.close(r)
+            os.close(w)
+
+def bench_pingpong(backend, rounds):
+    loop = event.Loop(backend=backend)
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    b.setblocking(False)
+    try:
+        latencies = []
+        state = {'sent': 0.0, 'n': 0}
+        def on_a(what, loop):
+            a.recv(1)
+            a.send('y')
+        def on_b(what, loop):
+            b.recv(1)
+            latencies.append((event.monotonic() - state['sent']) * 1e6)
+            state['n'] += 1
+            if state['n'] == rounds:
+                loop.stop()
+            else:
+                state['sent'] = event.monotonic()
+                b.send('x')
+        loop.add(a.fileno(), on_a, event.READ|event.PERSIST)
+        loop.add(b.fileno(), on_b, event.READ|event.PERSIST)
+
+        with benchutil.Timer() as t:
+            state['sent'] = event.monotonic()
+            b.send('x')
+            loop.run()
+        return benchutil.result('pingpong', rounds, t, backend=backend,
+                latency_us=benchutil.percentiles(latencies))
+    finally:
+        loop.close()
+        a.close()
+        b.close()
+
+def bench_timers(backend, ntimers, timers='heap', seed=0):
+    rand = random.Random(seed)
+    loop = event.Loop(backend=backend, timers=timers)
+    try:
+        lateness = []
+        state = {'start': 0.0}
+        def on_timeout(what, loop, due=0.0):
+            # timers that came due while the others were being added are
+            # measured from the start of the run
+            due = max(due, state['start'])
+            lateness.append((loop.now() - due) * 1e6)
+
+        with benchutil.Timer() as add_t:
+            idents = []
+            for i in xrange(ntimers):
+                ms = rand.randint(1, 50)
+                due = loop.now() + ms / 1000.0
+                fn = lambda what, loop, due=due: on_timeout(what, loop, due)
+                idents.append(loop.once(fn, ms))
+
+        cancel = rand.sample(idents, ntimers // 2)
+        with benchutil.Timer() as cancel_t:
+            for ident in cancel:
+                loop.remove(ident)
+
+        with benchutil.Timer() as run_t:
+            state['start'] = event.monotonic()
+            loop.run()
+
+        nfired = len(lateness)
+        return benchutil.result('timers', nfired, run_t, backend=backend,
+                timers=timers, ntimers=ntimers,
+                add_us_per_op=add_t.wall * 1e6 / ntimers,
+                cancel_us_per_op=cancel_t.wall * 1e6 / len(cancel),
+                lateness_us=benchutil.percentiles(lateness))
+    finally:
+        loop.close()
+
+def bench_churn(backend, nfds, steps):
+    skipped = _too_many_fds(nfds)
+    if skipped:
+        return {'name': 'churn', 'backend': backend, 'nfds': nfds,
+                'skipped': skipped}
+    loop = event.Loop(backend=backend)
+    pipes = [os.pipe() for i in xrange(nfds)]
+    try:
+        if backend == 'select' and pipes[-1][1] >= _FD_SETSIZE:
+            return {'name': 'churn', 'backend': backend, 'nfds': nfds,
+                    'skipped': 'fd >= FD_SETSIZE'}
+        rfds = [r for r, w in pipes]
+        state = {'step': 0}
+        def step():
+            if state['step'] == steps:
+                return
+            if state['step'] % 2 == 0:
+                for fd in rfds:
+                    loop.add(fd, _noop, event.READ|event.PERSIST)
+            else:
+                for fd in rfds:
+                    loop.remove(fd)
+            state['step'] += 1
+            loop.call_soon(step)
+
+        with benchutil.Timer() as t:
+            loop.call_soon(step)
+            loop.run()
+        return benchutil.result('churn', nfds * steps, t, backend=backend,
+                nfds=nfds, steps=steps)
+    finally:
+        loop.close()
+        for r, w in pipes:
+            os.close(r)
+            os.close(w)
+
+def _backends():
+    return [b for b in ('select', 'poll', 'epoll') if hasattr(event.select, b)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0],
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-b', '--backend', action='append',
+            choices=_backends(),
+            help='backend to run (repeatable; default: all available)')
+    parser.add_argument('-s', '--scenario', action='append',
+            choices=('idle', 'pingpong', 'timers', 'churn'),
+            help='scenario to run (repeatable; default: all)')
+    parser.add_argument('-q', '--quick', action='store_true',
+            help='use small sizes, for a smoke test')
+    args = parser.parse_args(argv)
+
+    _raise_nofile()
+    backends = args.backend or _backends()
+    scenarios = args.scenario or ('idle', 'pingpong', 'timers', 'churn')
+    if args.quick:
+        idle_sizes, rounds, timer_sizes, churn = (10, 100), 1000, (1000,), 10
+    else:
+        idle_sizes, rounds, timer_sizes, churn = \
+                (10, 1000, 5000), 10000, (10000, 100000), 100
+
+    results = []
+    for backend in backends:
+        if 'idle' in scenarios:
+            for n in idle_sizes:
+                results.append(bench_idle(backend, n, rounds))
+        if 'pingpong' in scenarios:
+            results.append(bench_pingpong(backend, rounds))
+        if 'timers' in scenarios:
+            for n in timer_sizes:
+                results.append(bench_timers(backend, n))
+                if backend == 'epoll':
+                    results.append(bench_timers(backend, n, timers='timerfd'))
+        if 'churn' in scenarios:
+            results.append(bench_churn(backend, 100, churn))
+    benchutil.report('event', results)
+
+if __name__ == '__main__':
+    main()
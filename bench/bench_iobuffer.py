@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for cigarbox.iobuffer.IOBuffer
+
+Runs each scenario against IOBuffer and against a baseline that decodes
+and encodes the way IOBuffer used to: slicing a temporary out of the
+bytearray and calling struct.unpack with a format string, or building a
+temporary with struct.pack and splicing it in.  Prints the results as
+JSON (see benchutil).  Scenarios, over N records of one field of each
+integer type (u8, u16/u32/u64 big and little endian):
+
+    read        decoding every field with read_u*()
+    write       encoding every field with write_u*() into an empty buffer
+    view        reading 64-byte and 4 KB payloads with read_view()
+                against read()
+    batch       decoding N u32be values and N (u64, u16, f64) records in
+                one call each (read_array, iter_records) against field by
+                field
+"""
+
+import argparse
+import struct
+import sys
+
+import benchutil
+
+from cigarbox import iobuffer
+
+_FIELDS = (
+    ('u8', '>B', 1, 0x7f),
+    ('u16be', '>H', 2, 0x1234),
+    ('u32be', '>I', 4, 0x12345678),
+    ('u64be', '>Q', 8, 0x123456789abcdef0),
+    ('u16le', '<H', 2, 0x1234),
+    ('u32le', '<I', 4, 0x12345678),
+    ('u64le', '<Q', 8, 0x123456789abcdef0),
+)
+
+_RECORD = ''.join(struct.pack(fmt, v) for name, fmt, size, v in _FIELDS)
+
+# the old IOBuffer field codecs, for comparison
+
+def _slice_read(b, fmt, size):
+    have = len(b._a) - b._i
+    if have < size:
+        raise EOFError(iobuffer._EOF_READ_FMT, size, have)
+    newi = b._i + size
+    num = struct.unpack(fmt, b._a[b._i:newi])[0]
+    b._i = newi
+    return num
+
+def _slice_write(b, fmt, size, v):
+    newi = b._i + size
+    if b.maxsize != -1 and newi > b.maxsize:
+        raise EOFError(iobuffer._EOF_WRITE_FMT, size, b.maxsize,
+                b.maxsize - b._i)
+    b._a[b._i:newi] = struct.pack(fmt, v)
+    b._i = newi
+    return size
+
+def _read(impl, nrecords):
+    b = iobuffer.IOBuffer(_RECORD * nrecords)
+    nfields = nrecords * len(_FIELDS)
+    if impl == 'iobuffer':
+        readers = [getattr(b, 'read_' + name) for name, fmt, size, v
+                in _FIELDS]
+        with benchutil.Timer() as t:
+            for i in xrange(nrecords):
+                for read in readers:
+                    read()
+    else:
+        with benchutil.Timer() as t:
+            for i in xrange(nrecords):
+                for name, fmt, size, v in _FIELDS:
+                    _slice_read(b, fmt, size)
+    return [benchutil.result('read', nfields, t, impl=impl,
+            nrecords=nrecords)]
+
+def _write(impl, nrecords):
+    b = iobuffer.IOBuffer()
+    nfields = nrecords * len(_FIELDS)
+    if impl == 'iobuffer':
+        writers = [(getattr(b, 'write_' + name), v) for name, fmt, size, v
+                in _FIELDS]
+        with benchutil.Timer() as t:
+            for i in xrange(nrecords):
+                for write, v in writers:
+                    write(v)
+    else:
+        with benchutil.Timer() as t:
+            for i in xrange(nrecords):
+                for name, fmt, size, v in _FIELDS:
+                    _slice_write(b, fmt, size, v)
+    return [benchutil.result('write', nfields, t, impl=impl,
+            nrecords=nrecords)]
+
+def _view(impl, nrecords):
+    results = []
+    for size in (64, 4096):
+        n = max(1, nrecords * 64 // size)
+        b = iobuffer.IOBuffer('x' * (size * n))
+        read = b.read_view if impl == 'iobuffer' else b.read
+        with benchutil.Timer() as t:
+            for i in xrange(n):
+                read(size)
+        results.append(benchutil.result('view', n, t, impl=impl,
+                size=size))
+    return results
+
+def _batch(impl, nrecords):
+    results = []
+    b = iobuffer.IOBuffer(struct.pack('>%dI' % nrecords, *range(nrecords)))
+    with benchutil.Timer() as t:
+        if impl == 'iobuffer':
+            b.read_array('>I', nrecords)
+        else:
+            for i in xrange(nrecords):
+                _slice_read(b, '>I', 4)
+    results.append(benchutil.result('batch_u32be', nrecords, t, impl=impl,
+            nrecords=nrecords))
+
+    b = iobuffer.IOBuffer(struct.pack('>QHd', 1, 2, 3.0) * nrecords)
+    with benchutil.Timer() as t:
+        if impl == 'iobuffer':
+            for r in b.iter_records('>QHd', nrecords):
+                pass
+        else:
+            for i in xrange(nrecords):
+                (_slice_read(b, '>Q', 8), _slice_read(b, '>H', 2),
+                        _slice_read(b, '>d', 8))
+    results.append(benchutil.result('batch_records', nrecords, t,
+            impl=impl, nrecords=nrecords))
+    return results
+
+_SCENARIOS = {
+    'read': _read,
+    'write': _write,
+    'view': _view,
+    'batch': _batch,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0],
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--scenario', action='append',
+            choices=sorted(_SCENARIOS),
+            help='scenario to run (repeatable; default: all)')
+    parser.add_argument('-q', '--quick', action='store_true',
+            help='use small sizes, for a smoke test')
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenario or ('read', 'write', 'view', 'batch')
+    nrecords = 1000 if args.quick else 100000
+
+    results = []
+    for name in scenarios:
+        for impl in ('slice', 'iobuffer'):
+            results.extend(_SCENARIOS[name](impl, nrecords))
+    benchutil.report('iobuffer', results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+Helpers shared by the benchmark scripts
+
+Every benchmark prints a single JSON document to stdout, so that results
+can be stored and compared between runs to catch regressions.
+"""
+
+import json
+import os
+import platform
+import sys
+import time
+
+def cpu_time():
+    """Return the user + system CPU time of this process, in seconds."""
+    t = os.times()
+    return t[0] + t[1]
+
+def percentiles(samples, ps=(50, 90, 99)):
+    """Return {'pN': value} for each percentile N of samples.
+
+    Uses the nearest-rank method; an empty sample list gives zeros.
+    """
+    d = {}
+    a = sorted(samples)
+    for p in ps:
+        if a:
+            i = min(len(a) - 1, max(0, int(len(a) * p / 100.0 + 0.5) - 1))
+            d['p%d' % p] = a[i]
+        else:
+            d['p%d' % p] = 0
+    return d
+
+class Timer(object):
+    """Measure the wall-clock and CPU time of a block.
+
+        with Timer() as t:
+            work()
+        t.wall, t.cpu
+    """
+    def __enter__(self):
+        self._wall = time.time()
+        self._cpu = cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.time() - self._wall
+        self.cpu = cpu_time() - self._cpu
+        return False
+
+def result(name, ops, timer, **extra):
+    """Return a result dict for ops operations measured by timer."""
+    d = {
+        'name': name,
+        'ops': ops,
+        'wall_s': timer.wall,
+        'ops_per_sec': ops / timer.wall if timer.wall else 0.0,
+        'cpu_us_per_op': timer.cpu * 1e6 / ops if ops else 0.0,
+    }
+    d.update(extra)
+    return d
+
+def report(suite, results, out=sys.stdout):
+    doc = {
+        'suite': suite,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+    json.dump(doc, out, indent=2, sort_keys=True)
+    out.write('\n')
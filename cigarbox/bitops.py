@@ -1,39 +1,209 @@
 import array
+import binascii
+import bisect
+import ctypes
+import fcntl
+import hashlib
+import itertools
+import math
+import mmap
+import operator
+import os
+import struct
+import sys
+import tempfile
+import threading
+import weakref
 
 #
-#   i >> 3 is the same as i / 8
-#   i & 7 is the same as i % 8
-# 
-#   1000000
-# 
+#   Bits are stored in an array of machine words.  Bit i lives in word
+#   i >> _WORD_SHIFT, at bit position i & _WORD_MASK counting from the
+#   least significant bit:
 #
-#                       1 1 1 1 1 1   1 1 1 1 2 2 2 2
-# 0 1 2 3 4 5 6 7 | 8 9 0 1 2 3 4 5 | 6 7 8 9 0 1 2 3
+#       word 0                          word 1
+#       bit 63 ...           1 0        bit 127 ...         65 64
 #
+#   Bits past nbits in the last word are always clear, so searches can
+#   treat whole words without masking, except at the end of the map.
 #
-#   isset(9)
+#   Searches skip runs of empty (or full) words at C speed, by comparing
+#   buffers of the array against a run of empty (or full) words, first in
+#   big chunks and then in small ones.  They then locate the bit within
+#   the word found with int.bit_length():
+#
+#       lowest set bit of w     (w & -w).bit_length() - 1
+#       highest set bit of w    w.bit_length() - 1
+#
+#   to_bytes() writes the words little endian, whatever the machine, so
+#   that bit i of the map is bit i & 7 (counting from the least
+#   significant bit) of byte i >> 3; from_bytes() reads the same layout.
+#   memoryview() and from_buffer() use the words in place, in native byte
+#   order, which is that same layout on little-endian machines.  Python 2
+#   arrays and mmaps do not know about the ctypes views over them, and
+#   move their memory when they are resized, so a map keeps weak
+#   references to the views it has handed out and refuses to change its
+#   number of words while any of them is alive.
+#
+#   Bulk operations between maps (&, |, ^, andnot, popcount) read runs of
+#   words as one long integer, through binascii.hexlify, so that the
+#   arithmetic on each run happens in C.  Runs are _BULK_WORDS long, to
+#   bound the size of the temporaries.
+#
+
+_TYPECODE = 'L'
+_WORD_BYTES = array.array(_TYPECODE).itemsize
+_WORD_BITS = _WORD_BYTES * 8
+_WORD_SHIFT = _WORD_BITS.bit_length() - 1
+_WORD_MASK = _WORD_BITS - 1
+_FULL = (1 << _WORD_BITS) - 1
+_WORD = struct.Struct(_TYPECODE)
+
+# words compared at a time when skipping runs of empty or full words
+_CHUNKS = (512, 16)
+_RUNS = {
+    0: [(n, buffer(array.array(_TYPECODE, [0]) * n)) for n in _CHUNKS],
+    _FULL: [(n, buffer(array.array(_TYPECODE, [_FULL]) * n))
+            for n in _CHUNKS],
+}
+
+# words handled at a time by the bulk operations
+_BULK_WORDS = 1 << 14
 
 _INDEX_ERR_FMT = 'invalid bit index (%d) for BitMap(nbits=%d, resizeable=%s)'
 
+def _nwords(nbits):
+    return (nbits + _WORD_MASK) >> _WORD_SHIFT
+
+def _zeros(n):
+    return array.array(_TYPECODE, [0]) * n
+
+def _high_bits(i):
+    # bits i & _WORD_MASK and up of i's word
+    return _FULL ^ ((1 << (i & _WORD_MASK)) - 1)
+
+def _low_bits(i):
+    # bits i & _WORD_MASK and down of i's word
+    return _FULL >> (_WORD_MASK - (i & _WORD_MASK))
+
+def _to_long(buf):
+    # a buffer of words, as one integer
+    if not len(buf):
+        return 0
+    return int(binascii.hexlify(buf), 16)
+
+def _from_long(v, n):
+    # the inverse of _to_long, for a run of n words
+    return array.array(_TYPECODE,
+            binascii.unhexlify('%0*x' % (n * _WORD_BYTES * 2, v)))
+
+def _sized(indexes):
+    if hasattr(indexes, '__len__'):
+        return indexes
+    return list(indexes)
+
+class _BufferWords(object):
+    # the words of a map kept in a writable buffer other than an array:
+    # an mmap or a ctypes char array, from byte offset base on.  Has the
+    # parts of the array interface that Bitmap uses.
+
+    def __init__(self, buf, base, n):
+        self._buf = buf
+        self._base = base
+        self._n = n
+
+    def _off(self, x):
+        return self._base + x * _WORD_BYTES
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, x):
+        if isinstance(x, slice):
+            start, stop, step = x.indices(self._n)
+            stop = max(start, stop)
+            return array.array(_TYPECODE,
+                    self._buf[self._off(start):self._off(stop)])
+        if x < 0:
+            x += self._n
+        return _WORD.unpack_from(self._buf, self._off(x))[0]
+
+    def __setitem__(self, x, v):
+        if isinstance(x, slice):
+            start, stop, step = x.indices(self._n)
+            stop = max(start, stop)
+            if len(v) != stop - start:
+                raise ValueError('cannot resize buffer words')
+            self._buf[self._off(start):self._off(stop)] = v.tostring()
+            return
+        if x < 0:
+            x += self._n
+        _WORD.pack_into(self._buf, self._off(x), v)
+
+    def __delitem__(self, x):
+        # only dropping the words from some index on is supported; they
+        # are cleared, so that growing again finds them clear
+        start, stop, step = x.indices(self._n)
+        self._buf[self._off(start):self._off(self._n)] = \
+                '\0' * ((self._n - start) * _WORD_BYTES)
+        self._n = start
+
+    def extend(self, words):
+        raise ValueError('cannot grow a map over a foreign buffer')
+
+    def buffer(self, x, n):
+        return buffer(self._buf, self._off(x), n * _WORD_BYTES)
+
+    def chars(self):
+        # a ctypes char array over the words
+        nbytes = self._n * _WORD_BYTES
+        return (ctypes.c_char * nbytes).from_buffer(self._buf, self._base)
+
 class Bitmap(object):
+    # weak references to the ctypes arrays under live memoryview()s
+    _views = ()
+
     def __init__(self, nbits=64, resizeable=True):
-        x = nbits / 8 
-        y = nbits % 8 
-        if y:
-            x += 1
         self._nbits = nbits
         self._resizeable = resizeable
-        self._a = array.array('B', [0 for i in xrange(x)])
+        self._a = _zeros(_nwords(nbits))
 
     def _resize(self, nbits):
+        need = _nwords(nbits) - len(self._a)
+        if need > 0:
+            self._check_views()
         self._nbits = nbits
-        x = nbits / 8 
-        y = nbits % 8 
-        if y:
-            x += 1
-        need = x - len(self._a)
         if need > 0:
-            self._a.extend([0 for i in xrange(need)])
+            self._a.extend(_zeros(need))
+
+    def _check_views(self):
+        # called before the number of words changes
+        views = self._views
+        if views:
+            self._views = views = [r for r in views if r() is not None]
+            if views:
+                raise BufferError('cannot resize a map with live '
+                        'memoryviews')
+
+    def _tail_mask(self):
+        # the valid bits of the last word
+        r = self._nbits & _WORD_MASK
+        if r:
+            return (1 << r) - 1
+        return _FULL
+
+    def _rebuild(self):
+        # recompute any state derived from the words; Bitmap has none
+        pass
+
+    def _buffer(self, x, n):
+        # a buffer over words x to x+n-1
+        a = self._a
+        if isinstance(a, _BufferWords):
+            return a.buffer(x, n)
+        return buffer(a, x * _WORD_BYTES, n * _WORD_BYTES)
 
     def _check_arg(self, i):
         if i < 0:
@@ -48,46 +218,369 @@ class Bitmap(object):
                 self._resize(i+1)
 
     def _is_set(self, i):
-        x = i >> 3  
-        y = 0x80 >> (i & 7)
-        return bool(self._a[x] & y)
+        return bool(self._a[i >> _WORD_SHIFT] & (1 << (i & _WORD_MASK)))
 
     def is_set(self, i):
         if i >= self._nbits or i < 0:
-            raise IndexError(_INDEX_ERR_FMT % (i, self._nbits))
+            raise IndexError(_INDEX_ERR_FMT %
+                    (i, self._nbits, self._resizeable))
         return self._is_set(i)
 
     def set(self, i):
         self._check_arg(i)
-        x = i >> 3  
-        y = 0x80 >> (i & 7)
-        self._a[x] |= y
+        self._a[i >> _WORD_SHIFT] |= 1 << (i & _WORD_MASK)
 
     def clr(self, i):
         self._check_arg(i)
-        x = i >> 3  
-        y = ~(0x80 >> (i & 7))
-        self._a[x] &= y
+        self._a[i >> _WORD_SHIFT] &= _FULL ^ (1 << (i & _WORD_MASK))
 
     def zero(self):
-        for i in len(xrange(self._a)):
-            self._a[i] = 0
+        """Clear every bit."""
+        self._a[:] = _zeros(len(self._a))
+
+    def fill(self):
+        """Set every bit below nbits."""
+        n = len(self._a)
+        if n:
+            self._a[:] = array.array(_TYPECODE, [_FULL]) * n
+            self._a[-1] = self._tail_mask()
+
+    def resize(self, nbits):
+        """Grow or shrink the map to nbits bits.
+
+        New bits are clear.  Bits dropped by shrinking are cleared, so they
+        are clear again if the map grows back.
+        """
+        if nbits < 0:
+            raise ValueError('invalid nbits (%d)' % nbits)
+        if nbits >= self._nbits:
+            self._resize(nbits)
+            return
+        if _nwords(nbits) < len(self._a):
+            self._check_views()
+        self._nbits = nbits
+        del self._a[_nwords(nbits):]
+        if self._a:
+            self._a[-1] &= self._tail_mask()
+
+    def copy(self):
+        """Return a new map of the same class, size and bits."""
+        m = self.__class__(0, self._resizeable)
+        m._nbits = self._nbits
+        m._a = array.array(_TYPECODE, self._a)
+        m._rebuild()
+        return m
+
+    def to_bytes(self):
+        """Return the words of the map as a string, little endian.
+
+        The string holds nbits rounded up to a whole number of words;
+        the bits past nbits are clear.
+        """
+        s = str(self._buffer(0, len(self._a)))
+        if sys.byteorder == 'big':
+            words = array.array(_TYPECODE, s)
+            words.byteswap()
+            s = words.tostring()
+        return s
+
+    @classmethod
+    def _wrap(cls, words, nbits, resizeable):
+        m = cls.__new__(cls)
+        m._nbits = nbits
+        m._resizeable = resizeable
+        m._a = words
+        if words:
+            words[-1] &= m._tail_mask()
+        m._rebuild()
+        return m
+
+    @classmethod
+    def _nbits_for(cls, nbytes, nbits):
+        if nbits is None:
+            nbits = (nbytes // _WORD_BYTES) * _WORD_BITS
+        if nbits < 0 or _nwords(nbits) * _WORD_BYTES > nbytes:
+            raise ValueError('invalid nbits (%d) for %d bytes' %
+                    (nbits, nbytes))
+        return nbits
+
+    @classmethod
+    def from_bytes(cls, data, nbits=None, resizeable=True):
+        """Return a new map holding a copy of the bits in data.
+
+        data is a string (or other buffer) laid out as by to_bytes().
+        nbits defaults to every bit of the whole words in data.
+        """
+        nbits = cls._nbits_for(len(data), nbits)
+        nbytes = _nwords(nbits) * _WORD_BYTES
+        words = array.array(_TYPECODE, str(buffer(data, 0, nbytes)))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        return cls._wrap(words, nbits, resizeable)
+
+    @classmethod
+    def from_buffer(cls, buf, nbits=None):
+        """Return a map whose words are those of buf, without copying.
+
+        buf is a writable buffer, such as a bytearray, an mmap or an
+        array, laid out as by memoryview(); changes to the map show in
+        buf, and the other way round.  The bits of the last word past
+        nbits are cleared.  nbits defaults to every bit of the whole words
+        in buf, and the map cannot grow.
+        """
+        nbits = cls._nbits_for(len(buffer(buf)), nbits)
+        n = _nwords(nbits)
+        c = (ctypes.c_char * (n * _WORD_BYTES)).from_buffer(buf)
+        return cls._wrap(_BufferWords(c, 0, n), nbits, False)
+
+    def memoryview(self):
+        """Return a writable memoryview of the map's words, without copying.
+
+        The view holds bytes, with the words in native byte order.  While
+        the view, or a slice of it, is alive, the map cannot change its
+        number of words: growing it (including by setting a bit past
+        nbits) or shrinking it raises BufferError, and leaves the map as
+        it was.
+        """
+        return memoryview(self._chars())
+
+    def _chars(self):
+        # a ctypes char array over the words, tracked as a live view
+        a = self._a
+        if isinstance(a, _BufferWords):
+            c = a.chars()
+        else:
+            c = (ctypes.c_char * (len(a) * _WORD_BYTES)).from_buffer(a)
+        if not self._views:
+            self._views = []
+        self._views.append(weakref.ref(c))
+        return c
+
+    def _range(self, start, stop, on):
+        # set or clear bits start to stop-1 in the words; return the
+        # indexes of the first and last word touched
+        self._check_arg(stop - 1)
+        self._check_arg(start)
+        a = self._a
+        first = start >> _WORD_SHIFT
+        last = (stop - 1) >> _WORD_SHIFT
+        head = _high_bits(start)
+        tail = _low_bits(stop - 1)
+        if first == last:
+            head &= tail
+        if on:
+            a[first] |= head
+            if first != last:
+                a[first+1:last] = \
+                        array.array(_TYPECODE, [_FULL]) * (last - first - 1)
+                a[last] |= tail
+        else:
+            a[first] &= _FULL ^ head
+            if first != last:
+                a[first+1:last] = _zeros(last - first - 1)
+                a[last] &= _FULL ^ tail
+        return first, last
+
+    def set_range(self, start, stop):
+        """Set bits start to stop-1."""
+        if start < stop:
+            self._range(start, stop, True)
+
+    def clr_range(self, start, stop):
+        """Clear bits start to stop-1."""
+        if start < stop:
+            self._range(start, stop, False)
+
+    def _check_many(self, indexes):
+        # check (and maybe grow to) the largest and smallest index
+        if len(indexes):
+            self._check_arg(max(indexes))
+            self._check_arg(min(indexes))
+
+    def set_many(self, indexes):
+        """Set each bit in indexes, an iterable or array of ints.
+
+        The indexes are checked before any bit is set.
+        """
+        indexes = _sized(indexes)
+        self._check_many(indexes)
+        a = self._a
+        for i in indexes:
+            a[i >> _WORD_SHIFT] |= 1 << (i & _WORD_MASK)
+
+    def test_many(self, indexes):
+        """Return a list of is_set(i) for each i in indexes."""
+        indexes = _sized(indexes)
+        if len(indexes) and (min(indexes) < 0 or
+                max(indexes) >= self._nbits):
+            bad = [i for i in indexes if i < 0 or i >= self._nbits][0]
+            raise IndexError(_INDEX_ERR_FMT %
+                    (bad, self._nbits, self._resizeable))
+        a = self._a
+        return [bool(a[i >> _WORD_SHIFT] & (1 << (i & _WORD_MASK)))
+                for i in indexes]
+
+    def popcount(self):
+        """Return the number of set bits."""
+        n = len(self._a)
+        count = 0
+        for x in xrange(0, n, _BULK_WORDS):
+            buf = self._buffer(x, min(_BULK_WORDS, n - x))
+            count += bin(_to_long(buf)).count('1')
+        return count
+
+    def iter_set(self):
+        """Yield the index of each set bit, in increasing order.
+
+        Runs of empty words are skipped as in ffs().
+        """
+        a = self._a
+        n = len(a)
+        x = self._first_word(0)
+        while x >= 0:
+            w = a[x]
+            base = x << _WORD_SHIFT
+            while w:
+                low = w & -w
+                yield base + low.bit_length() - 1
+                w ^= low
+            x += 1
+            if x >= n:
+                return
+            if not a[x]:
+                x = self._first_word(0, x)
+
+    def _combine(self, other, op):
+        # self = self op other, over the words the maps have in common
+        a = self._a
+        n = min(len(a), len(other._a))
+        for x in xrange(0, n, _BULK_WORDS):
+            c = min(_BULK_WORDS, n - x)
+            v = op(_to_long(self._buffer(x, c)), _to_long(other._buffer(x, c)))
+            a[x:x+c] = _from_long(v, c)
+
+    def _cover(self, other):
+        # make room for the set bits of other
+        if other._nbits <= self._nbits:
+            return
+        if self._resizeable:
+            self._resize(other._nbits)
+            return
+        i = other.fls()
+        if i >= self._nbits:
+            raise IndexError(_INDEX_ERR_FMT %
+                    (i, self._nbits, self._resizeable))
+
+    def __iand__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        self._combine(other, operator.and_)
+        n = len(other._a)
+        if len(self._a) > n:
+            self._a[n:] = _zeros(len(self._a) - n)
+        self._rebuild()
+        return self
+
+    def __ior__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        self._cover(other)
+        self._combine(other, operator.or_)
+        self._rebuild()
+        return self
+
+    def __ixor__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        self._cover(other)
+        self._combine(other, operator.xor)
+        self._rebuild()
+        return self
+
+    def iandnot(self, other):
+        """Clear the bits of self that are set in other, in place."""
+        self._combine(other, lambda x, y: x & ~y)
+        self._rebuild()
+        return self
+
+    def _grown_copy(self, other):
+        m = self.copy()
+        if other._nbits > m._nbits:
+            m.resize(other._nbits)
+        return m
+
+    def __and__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        m = self.copy()
+        m &= other
+        return m
+
+    def __or__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        m = self._grown_copy(other)
+        m |= other
+        return m
+
+    def __xor__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        m = self._grown_copy(other)
+        m ^= other
+        return m
+
+    def andnot(self, other):
+        """Return a copy of self without the bits that are set in other."""
+        return self.copy().iandnot(other)
+
+    def _first_word(self, skip, start=0):
+        # index of the first word from start on that is not skip, or -1
+        a = self._a
+        n = len(a)
+        x = start
+        if n - x > _CHUNKS[-1]:
+            for chunk, run in _RUNS[skip]:
+                while x + chunk <= n and self._buffer(x, chunk) == run:
+                    x += chunk
+        while x < n and a[x] == skip:
+            x += 1
+        if x == n:
+            return -1
+        return x
+
+    def _last_word(self, skip, end):
+        # index of the last word before end that is not skip, or -1
+        a = self._a
+        x = end
+        if end > _CHUNKS[-1]:
+            for chunk, run in _RUNS[skip]:
+                while x - chunk >= 0 and self._buffer(x - chunk, chunk) == run:
+                    x -= chunk
+        x -= 1
+        while x >= 0 and a[x] == skip:
+            x -= 1
+        return x
 
     def ffs(self):
-        for i in xrange(0, self._nbits):
-            if self._is_set(i):
-                return i
-        return -1
+        x = self._first_word(0)
+        if x < 0:
+            return -1
+        w = self._a[x]
+        return (x << _WORD_SHIFT) + (w & -w).bit_length() - 1
 
     def fls(self):
-        for i in xrange(self._nbits-1, -1, -1):
-            if self._is_set(i):
-                return i
-        return -1
+        x = self._last_word(0, len(self._a))
+        if x < 0:
+            return -1
+        return (x << _WORD_SHIFT) + self._a[x].bit_length() - 1
 
     def ffc(self):
-        for i in xrange(0, self._nbits):
-            if not self._is_set(i):
+        x = self._first_word(_FULL)
+        if x >= 0:
+            w = ~self._a[x] & _FULL
+            i = (x << _WORD_SHIFT) + (w & -w).bit_length() - 1
+            if i < self._nbits:
                 return i
         if self._resizeable:
             self._resize(self._nbits + 1)
@@ -96,11 +589,1386 @@ class Bitmap(object):
             return -1
 
     def flc(self):
-        for i in xrange(self._nbits-1, -1, -1):
-            if not self._is_set(i):
-                return i
+        a = self._a
+        if a:
+            # check the last word with its padding masked off, then skip
+            # the full words before it
+            x = len(a) - 1
+            w = ~a[x] & self._tail_mask()
+            if not w:
+                x = self._last_word(_FULL, x)
+                if x >= 0:
+                    w = ~a[x] & _FULL
+            if w:
+                return (x << _WORD_SHIFT) + w.bit_length() - 1
         if self._resizeable:
             self._resize(self._nbits + 1)
             return self._nbits - 1
         else:
             return -1
+
+class HierBitmap(Bitmap):
+    """A Bitmap with summary levels, for allocating ids out of large maps.
+
+    Besides the bits themselves, the map keeps two trees of summary
+    bitmaps.  In the first, bit x of the lowest level is set when word x
+    of the map has a set bit, and bit x of each level above is set when
+    word x of the level below is non-zero.  The second tree is built the
+    same way over the words that have a clear bit.  ffs/fls/ffc/flc walk
+    down a tree from its one-word top level, so they take O(log64 n)
+    steps instead of scanning the map; set() and clr() update the trees
+    in O(log64 n) steps, and usually stop at the lowest level.
+
+    zero(), fill() and resize() redo the summaries in O(n/64) steps,
+    most of them slice assignments.  set_range() and clr_range() update
+    them a range at a time; the in-place set operators rebuild them.
+
+    Writes that bypass the map would leave the summaries stale, so
+    memoryview() is read-only and from_buffer() is not supported.
+    """
+    def __init__(self, nbits=64, resizeable=True):
+        Bitmap.__init__(self, nbits, resizeable)
+        self._rebuild()
+
+    @classmethod
+    def from_buffer(cls, buf, nbits=None):
+        raise ValueError('a HierBitmap cannot share its words with a buffer')
+
+    def memoryview(self):
+        """Return a read-only memoryview of the map's words, without
+        copying.
+
+        As for Bitmap.memoryview(), the map cannot change its number of
+        words while the view is alive.
+        """
+        return memoryview(buffer(self._chars()))
+
+    def _word_mask(self, x):
+        if x == len(self._a) - 1:
+            return self._tail_mask()
+        return _FULL
+
+    def _empty(self):
+        # clear summary levels for the map, lowest level first
+        levels = []
+        n = len(self._a)
+        while True:
+            level = _zeros(_nwords(n))
+            levels.append(level)
+            if len(level) <= 1:
+                return levels
+            n = len(level)
+
+    def _rebuild(self):
+        a = self._a
+        self._used = self._empty()
+        self._free = self._empty()
+        last = len(a) - 1
+        for x, w in enumerate(a):
+            if w:
+                self._mark(self._used, x, True)
+            if w != _FULL or x == last:
+                self._mark(self._free, x, w != self._word_mask(x))
+
+    def _mark(self, levels, x, on):
+        # set or clear the summary bit of word x, and of its ancestors
+        # when their words become non-zero or zero
+        for level in levels:
+            i = x >> _WORD_SHIFT
+            bit = 1 << (x & _WORD_MASK)
+            w = level[i]
+            if on:
+                if w & bit:
+                    return
+                level[i] = w | bit
+                if w:
+                    return
+            else:
+                if not w & bit:
+                    return
+                level[i] = w = w ^ bit
+                if w:
+                    return
+            x = i
+
+    def _mark_range(self, levels, lo, hi):
+        # set the summary bits of words lo to hi-1, and of their ancestors
+        for level in levels:
+            if lo >= hi:
+                return
+            first = lo >> _WORD_SHIFT
+            last = (hi - 1) >> _WORD_SHIFT
+            head = _high_bits(lo)
+            tail = _low_bits(hi - 1)
+            if first == last:
+                level[first] |= head & tail
+            else:
+                level[first] |= head
+                level[first+1:last] = \
+                        array.array(_TYPECODE, [_FULL]) * (last - first - 1)
+                level[last] |= tail
+            lo, hi = first, last + 1
+
+    def _unmark_range(self, levels, lo, hi):
+        # clear the summary bits of words lo to hi-1, and of their
+        # ancestors whose words become zero
+        for level in levels:
+            if lo >= hi:
+                return
+            first = lo >> _WORD_SHIFT
+            last = (hi - 1) >> _WORD_SHIFT
+            head = _high_bits(lo)
+            tail = _low_bits(hi - 1)
+            if first == last:
+                level[first] &= _FULL ^ (head & tail)
+            else:
+                level[first] &= _FULL ^ head
+                level[first+1:last] = _zeros(last - first - 1)
+                level[last] &= _FULL ^ tail
+            # the words in between are now zero; the end words may not be
+            lo = first + 1 if level[first] else first
+            hi = last if level[last] else last + 1
+
+    def _grow(self, levels):
+        # extend the summary levels to cover every word of the map
+        n = len(self._a)
+        for i, level in enumerate(levels):
+            need = _nwords(n) - len(level)
+            if need > 0:
+                level.extend(_zeros(need))
+            n = len(level)
+        while len(levels[-1]) > 1:
+            top = levels[-1]
+            level = _zeros(_nwords(len(top)))
+            for x, w in enumerate(top):
+                if w:
+                    level[x >> _WORD_SHIFT] |= 1 << (x & _WORD_MASK)
+            levels.append(level)
+
+    def _resize(self, nbits):
+        a = self._a
+        old = len(a)
+        Bitmap._resize(self, nbits)
+        if len(a) > old:
+            self._grow(self._used)
+            self._grow(self._free)
+            self._mark_range(self._free, old, len(a))
+        if old:
+            # the old last word may have gained valid bits
+            x = old - 1
+            self._mark(self._free, x, a[x] != self._word_mask(x))
+
+    def set(self, i):
+        self._check_arg(i)
+        x = i >> _WORD_SHIFT
+        w = self._a[x] | (1 << (i & _WORD_MASK))
+        self._a[x] = w
+        self._mark(self._used, x, True)
+        if w == self._word_mask(x):
+            self._mark(self._free, x, False)
+
+    def clr(self, i):
+        self._check_arg(i)
+        x = i >> _WORD_SHIFT
+        w = self._a[x] & (_FULL ^ (1 << (i & _WORD_MASK)))
+        self._a[x] = w
+        self._mark(self._free, x, True)
+        if not w:
+            self._mark(self._used, x, False)
+
+    def set_range(self, start, stop):
+        if start >= stop:
+            return
+        first, last = self._range(start, stop, True)
+        self._mark_range(self._used, first, last + 1)
+        # the words in between are now full
+        self._unmark_range(self._free, first + 1, last)
+        for x in (first, last):
+            self._mark(self._free, x, self._a[x] != self._word_mask(x))
+
+    def clr_range(self, start, stop):
+        if start >= stop:
+            return
+        first, last = self._range(start, stop, False)
+        self._mark_range(self._free, first, last + 1)
+        # the words in between are now empty
+        self._unmark_range(self._used, first + 1, last)
+        for x in (first, last):
+            self._mark(self._used, x, bool(self._a[x]))
+
+    def set_many(self, indexes):
+        indexes = _sized(indexes)
+        Bitmap.set_many(self, indexes)
+        a = self._a
+        for x in set([i >> _WORD_SHIFT for i in indexes]):
+            self._mark(self._used, x, True)
+            if a[x] == self._word_mask(x):
+                self._mark(self._free, x, False)
+
+    def zero(self):
+        Bitmap.zero(self)
+        self._used = self._empty()
+        self._free = self._empty()
+        self._mark_range(self._free, 0, len(self._a))
+
+    def fill(self):
+        Bitmap.fill(self)
+        self._used = self._empty()
+        self._free = self._empty()
+        self._mark_range(self._used, 0, len(self._a))
+
+    def resize(self, nbits):
+        shrink = nbits < self._nbits
+        Bitmap.resize(self, nbits)
+        if shrink:
+            self._rebuild()
+
+    def _lowest(self, levels):
+        # index of the first word with a summary bit set, or -1
+        x = 0
+        for level in reversed(levels):
+            if x >= len(level):
+                return -1
+            w = level[x]
+            if not w:
+                return -1
+            x = (x << _WORD_SHIFT) + (w & -w).bit_length() - 1
+        return x
+
+    def _highest(self, levels):
+        # index of the last word with a summary bit set, or -1
+        x = 0
+        for level in reversed(levels):
+            if x >= len(level):
+                return -1
+            w = level[x]
+            if not w:
+                return -1
+            x = (x << _WORD_SHIFT) + w.bit_length() - 1
+        return x
+
+    def ffs(self):
+        x = self._lowest(self._used)
+        if x < 0:
+            return -1
+        w = self._a[x]
+        return (x << _WORD_SHIFT) + (w & -w).bit_length() - 1
+
+    def fls(self):
+        x = self._highest(self._used)
+        if x < 0:
+            return -1
+        return (x << _WORD_SHIFT) + self._a[x].bit_length() - 1
+
+    def ffc(self):
+        x = self._lowest(self._free)
+        if x >= 0:
+            w = ~self._a[x] & self._word_mask(x)
+            return (x << _WORD_SHIFT) + (w & -w).bit_length() - 1
+        if self._resizeable:
+            self._resize(self._nbits + 1)
+            return self._nbits - 1
+        else:
+            return -1
+
+    def flc(self):
+        x = self._highest(self._free)
+        if x >= 0:
+            w = ~self._a[x] & self._word_mask(x)
+            return (x << _WORD_SHIFT) + w.bit_length() - 1
+        if self._resizeable:
+            self._resize(self._nbits + 1)
+            return self._nbits - 1
+        else:
+            return -1
+
+
+#
+#   A MappedBitmap file is a header followed by the words of the map:
+#
+#       offset  size
+#       0       4       magic, 'CBBM'
+#       4       1       1 if the map is resizeable, else 0
+#       5       3       padding
+#       8       8       nbits, little endian
+#       16              words, native byte order, _WORD_BYTES each
+#
+#   The file may hold more words than nbits needs; growth doubles it.
+#
+
+_MAGIC = 'CBBM'
+_HEADER = struct.Struct('<4sB3xQ')
+class _MappedWords(_BufferWords):
+    # _BufferWords over the words of a MappedBitmap's mmap, which can grow
+
+    def extend(self, words):
+        n = self._n + len(words)
+        size = self._buf.size()
+        if self._off(n) > size:
+            self._buf.resize(max(self._off(n), 2 * size - self._base))
+        self._n = n
+        self[n-len(words):] = words
+
+class MappedBitmap(Bitmap):
+    """A Bitmap kept in a file, through mmap.
+
+    Opening an existing file only reads its header; pages of the map
+    load as they are touched, and changes go to the page cache, to reach
+    the file at flush() or when the kernel writes them back.  A new file
+    is created with nbits and resizeable; an existing one keeps its own.
+    Growing the map extends the file and remaps it.
+
+    Words are stored in native byte order, so files move only between
+    machines of the same word size and byte order.  Operators that
+    return a new map (&, |, ^, andnot, copy) return a plain Bitmap.
+    """
+    def __init__(self, path, nbits=64, resizeable=True):
+        self._path = path
+        self._fd = fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            size = os.fstat(fd).st_size
+            new = not size
+            if new:
+                size = _HEADER.size + _nwords(nbits) * _WORD_BYTES
+                os.ftruncate(fd, size)
+            elif size < _HEADER.size:
+                raise ValueError('%s: not a bitmap file' % path)
+            self._mm = mmap.mmap(fd, size)
+        except:
+            os.close(fd)
+            raise
+
+        if new:
+            self._nbits = nbits
+            self._resizeable = resizeable
+            self._write_header()
+        else:
+            magic, resizeable, nbits = _HEADER.unpack_from(self._mm)
+            if magic != _MAGIC or \
+                    _HEADER.size + _nwords(nbits) * _WORD_BYTES > size:
+                self._mm.close()
+                os.close(fd)
+                raise ValueError('%s: not a bitmap file' % path)
+            self._nbits = nbits
+            self._resizeable = bool(resizeable)
+        self._a = _MappedWords(self._mm, _HEADER.size, _nwords(self._nbits))
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mm, 0, _MAGIC, int(self._resizeable),
+                self._nbits)
+
+    def _resize(self, nbits):
+        Bitmap._resize(self, nbits)
+        self._write_header()
+
+    def resize(self, nbits):
+        Bitmap.resize(self, nbits)
+        self._write_header()
+
+    def _fill_words(self, w):
+        a = self._a
+        n = len(a)
+        run = array.array(_TYPECODE, [w]) * min(n, _BULK_WORDS)
+        for x in xrange(0, n, _BULK_WORDS):
+            c = min(_BULK_WORDS, n - x)
+            a[x:x+c] = run if c == len(run) else run[:c]
+
+    def zero(self):
+        self._fill_words(0)
+
+    def fill(self):
+        if len(self._a):
+            self._fill_words(_FULL)
+            self._a[-1] = self._tail_mask()
+
+    def copy(self):
+        m = Bitmap(0, self._resizeable)
+        m._nbits = self._nbits
+        m._a = self._a[:]
+        return m
+
+    def flush(self):
+        """Write the changed pages of the map to the file."""
+        self._mm.flush()
+
+    def close(self):
+        """Flush and unmap the file; the map is unusable afterwards."""
+        self._mm.flush()
+        self._mm.close()
+        os.close(self._fd)
+
+# where SharedBitmap creates its anonymous files, if it exists
+_SHM_DIR = '/dev/shm'
+
+# the threading.Locks of a SharedBitmap; word x uses lock x % _NTLOCKS
+_NTLOCKS = 64
+
+class SharedBitmap(MappedBitmap):
+    """A fixed-size MappedBitmap that several processes can update at once.
+
+    With a path, the map is the file at path, created with nbits if it
+    does not exist, and any process can attach to it by opening the same
+    path.  Without one, the map lives in an unlinked file in /dev/shm,
+    and is shared with the processes forked after it is made, such as
+    the workers of a loopgroup.LoopGroup.
+
+    Each word has its own lock: an fcntl record lock on the byte at the
+    word's index.  Record locks belong to a process, so the threads of
+    one process also take one of a fixed set of threading.Locks, picked
+    by word index; threads only contend when their words share one.
+    set(), clr() and ffc_and_set() hold the word's lock, so
+    processes can allocate and free ids without talking to each other.
+    The other operations, including ffc(), do not lock; bulk updates
+    (zero(), set_range(), |= and so on) must not race with other
+    writers.
+    """
+    def __init__(self, path=None, nbits=64):
+        anonymous = path is None
+        if anonymous:
+            fd, path = tempfile.mkstemp(prefix='cigarbox-bitmap-',
+                    dir=_SHM_DIR if os.path.isdir(_SHM_DIR) else None)
+            os.close(fd)
+        try:
+            MappedBitmap.__init__(self, path, nbits, False)
+        finally:
+            if anonymous:
+                os.unlink(path)
+        if self._resizeable:
+            self._resizeable = False
+            self._write_header()
+        self._tlocks = [threading.Lock() for i in xrange(_NTLOCKS)]
+
+    def _lock(self, x):
+        self._tlocks[x % _NTLOCKS].acquire()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, x, os.SEEK_SET)
+
+    def _unlock(self, x):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, x, os.SEEK_SET)
+        self._tlocks[x % _NTLOCKS].release()
+
+    def resize(self, nbits):
+        raise ValueError('a SharedBitmap cannot be resized')
+
+    def set(self, i):
+        self._check_arg(i)
+        x = i >> _WORD_SHIFT
+        self._lock(x)
+        try:
+            self._a[x] |= 1 << (i & _WORD_MASK)
+        finally:
+            self._unlock(x)
+
+    def clr(self, i):
+        self._check_arg(i)
+        x = i >> _WORD_SHIFT
+        self._lock(x)
+        try:
+            self._a[x] &= _FULL ^ (1 << (i & _WORD_MASK))
+        finally:
+            self._unlock(x)
+
+    def ffc_and_set(self):
+        """Atomically find the first clear bit, set it and return its index.
+
+        Returns -1 if every bit is set.  The search itself does not lock;
+        only the word found is locked and checked again, so a bit taken
+        by another process in the meantime sends the search on.
+        """
+        a = self._a
+        last = len(a) - 1
+        x = 0
+        while True:
+            x = self._first_word(_FULL, x)
+            if x < 0:
+                return -1
+            mask = self._tail_mask() if x == last else _FULL
+            self._lock(x)
+            try:
+                w = a[x]
+                free = ~w & mask
+                if free:
+                    bit = free & -free
+                    a[x] = w | bit
+                    return (x << _WORD_SHIFT) + bit.bit_length() - 1
+            finally:
+                self._unlock(x)
+            if x == last:
+                return -1
+            x += 1
+
+#
+#   SparseBitmap splits the bit space into chunks of _CHUNK_BITS bits.
+#   Chunk k holds bits k << _CHUNK_SHIFT up to ((k + 1) << _CHUNK_SHIFT) - 1,
+#   as the offsets of the set bits within the chunk.  Only chunks with a
+#   set bit exist, and each is stored in whichever of three forms suits
+#   its contents:
+#
+#       _ArrayChunk     a sorted array of offsets, for up to _ARRAY_MAX
+#                       set bits (2 bytes per bit)
+#       _BitsChunk      a Bitmap of _CHUNK_BITS bits (8 KB), for more
+#       _RunChunk       sorted arrays of the first and last offset of each
+#                       run of set bits (4 bytes per run), made by
+#                       set_range() and optimize()
+#
+#   Chunks are converted as they fill and empty, so memory stays in
+#   proportion to the set bits rather than to nbits.  Set operations
+#   between maps work chunk by chunk, on the chunk keys the maps share;
+#   pairs of array chunks are combined as Python sets, and other pairs
+#   as Bitmaps.
+#
+
+_CHUNK_SHIFT = 16
+_CHUNK_BITS = 1 << _CHUNK_SHIFT
+_CHUNK_MASK = _CHUNK_BITS - 1
+_ARRAY_MAX = 4096
+_RUN_MAX = 2048
+
+def _offsets(values):
+    return array.array('H', values)
+
+def _chunk_bitmap():
+    return Bitmap(_CHUNK_BITS, resizeable=False)
+
+def _chunk_from_bitmap(bm, n=None):
+    # the smaller of an array and a bits chunk for bm, or None if empty
+    if n is None:
+        n = bm.popcount()
+    if not n:
+        return None
+    if n <= _ARRAY_MAX:
+        return _ArrayChunk(_offsets(bm.iter_set()))
+    return _BitsChunk(bm, n)
+
+def _chunk_from_values(values):
+    # as _chunk_from_bitmap, for a sorted list of offsets
+    if not values:
+        return None
+    if len(values) <= _ARRAY_MAX:
+        return _ArrayChunk(_offsets(values))
+    bm = _chunk_bitmap()
+    bm.set_many(values)
+    return _BitsChunk(bm, len(values))
+
+class _ArrayChunk(object):
+    __slots__ = ('a',)
+
+    def __init__(self, a):
+        self.a = a
+
+    def __iter__(self):
+        return iter(self.a)
+
+    def copy(self):
+        return _ArrayChunk(_offsets(self.a))
+
+    def card(self):
+        return len(self.a)
+
+    def runs(self):
+        n = 0
+        prev = -2
+        for x in self.a:
+            if x != prev + 1:
+                n += 1
+            prev = x
+        return n
+
+    def bitmap(self):
+        bm = _chunk_bitmap()
+        bm.set_many(self.a)
+        return bm
+
+    def select(self, offsets):
+        # the sorted offsets that are set in this chunk
+        return sorted(set(self.a).intersection(offsets))
+
+    def contains(self, x):
+        a = self.a
+        i = bisect.bisect_left(a, x)
+        return i < len(a) and a[i] == x
+
+    def add(self, x):
+        a = self.a
+        i = bisect.bisect_left(a, x)
+        if i < len(a) and a[i] == x:
+            return self
+        a.insert(i, x)
+        if len(a) > _ARRAY_MAX:
+            return _chunk_from_values(a)
+        return self
+
+    def remove(self, x):
+        a = self.a
+        i = bisect.bisect_left(a, x)
+        if i < len(a) and a[i] == x:
+            del a[i]
+            if not a:
+                return None
+        return self
+
+    def first(self):
+        return self.a[0]
+
+    def last(self):
+        return self.a[-1]
+
+    def first_clear(self):
+        # a[i] == i holds for a prefix of the array
+        a = self.a
+        lo, hi = 0, len(a)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if a[mid] == mid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def last_clear(self, hi):
+        a = self.a
+        i = bisect.bisect_right(a, hi) - 1
+        while i >= 0 and a[i] == hi:
+            hi -= 1
+            i -= 1
+        if hi < 0:
+            return None
+        return hi
+
+    def clr_range(self, lo, hi):
+        a = self.a
+        del a[bisect.bisect_left(a, lo):bisect.bisect_right(a, hi)]
+        if not a:
+            return None
+        return self
+
+class _BitsChunk(object):
+    __slots__ = ('bm', 'n')
+
+    def __init__(self, bm, n):
+        self.bm = bm
+        self.n = n
+
+    def __iter__(self):
+        return self.bm.iter_set()
+
+    def copy(self):
+        return _BitsChunk(self.bm.copy(), self.n)
+
+    def card(self):
+        return self.n
+
+    def runs(self):
+        # a run starts at each set bit whose lower neighbour is clear
+        n = 0
+        carry = 0
+        for w in self.bm._a:
+            if w:
+                n += bin(w & ~((w << 1) | carry) & _FULL).count('1')
+            carry = w >> _WORD_MASK
+        return n
+
+    def bitmap(self):
+        return self.bm.copy()
+
+    def select(self, offsets):
+        return list(itertools.compress(offsets, self.bm.test_many(offsets)))
+
+    def contains(self, x):
+        return self.bm._is_set(x)
+
+    def add(self, x):
+        if not self.bm._is_set(x):
+            self.bm.set(x)
+            self.n += 1
+        return self
+
+    def remove(self, x):
+        if self.bm._is_set(x):
+            self.bm.clr(x)
+            self.n -= 1
+            if self.n <= _ARRAY_MAX:
+                return _chunk_from_bitmap(self.bm, self.n)
+        return self
+
+    def first(self):
+        return self.bm.ffs()
+
+    def last(self):
+        return self.bm.fls()
+
+    def first_clear(self):
+        x = self.bm.ffc()
+        if x < 0:
+            return None
+        return x
+
+    def last_clear(self, hi):
+        a = self.bm._a
+        x = hi >> _WORD_SHIFT
+        w = ~a[x] & _low_bits(hi)
+        if not w:
+            x = self.bm._last_word(_FULL, x)
+            if x < 0:
+                return None
+            w = ~a[x] & _FULL
+        return (x << _WORD_SHIFT) + w.bit_length() - 1
+
+    def clr_range(self, lo, hi):
+        self.bm.clr_range(lo, hi + 1)
+        return _chunk_from_bitmap(self.bm)
+
+class _RunChunk(object):
+    # runs are sorted, and never overlap or touch
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, starts, ends):
+        self.starts = starts
+        self.ends = ends
+
+    def __iter__(self):
+        for s, e in itertools.izip(self.starts, self.ends):
+            for x in xrange(s, e + 1):
+                yield x
+
+    def copy(self):
+        return _RunChunk(_offsets(self.starts), _offsets(self.ends))
+
+    def card(self):
+        return sum(self.ends) - sum(self.starts) + len(self.starts)
+
+    def runs(self):
+        return len(self.starts)
+
+    def bitmap(self):
+        bm = _chunk_bitmap()
+        for s, e in itertools.izip(self.starts, self.ends):
+            bm.set_range(s, e + 1)
+        return bm
+
+    def _checked(self):
+        if len(self.starts) > _RUN_MAX:
+            return _chunk_from_bitmap(self.bitmap())
+        return self
+
+    def select(self, offsets):
+        # offsets is sorted, so each run selects a slice of it
+        selected = []
+        for s, e in itertools.izip(self.starts, self.ends):
+            selected.extend(offsets[bisect.bisect_left(offsets, s):
+                    bisect.bisect_right(offsets, e)])
+        return selected
+
+    def contains(self, x):
+        i = bisect.bisect_right(self.starts, x) - 1
+        return i >= 0 and x <= self.ends[i]
+
+    def add(self, x):
+        return self.set_range(x, x)
+
+    def remove(self, x):
+        return self.clr_range(x, x)
+
+    def first(self):
+        return self.starts[0]
+
+    def last(self):
+        return self.ends[-1]
+
+    def first_clear(self):
+        if self.starts[0]:
+            return 0
+        e = self.ends[0]
+        if e == _CHUNK_MASK:
+            return None
+        return e + 1
+
+    def last_clear(self, hi):
+        i = bisect.bisect_right(self.starts, hi) - 1
+        if i < 0 or self.ends[i] < hi:
+            return hi
+        if not self.starts[i]:
+            return None
+        return self.starts[i] - 1
+
+    def set_range(self, lo, hi):
+        # replace the runs that overlap or touch lo..hi with one run
+        starts, ends = self.starts, self.ends
+        i = bisect.bisect_left(ends, lo - 1)
+        j = bisect.bisect_right(starts, hi + 1)
+        if i < j:
+            lo = min(lo, starts[i])
+            hi = max(hi, ends[j-1])
+        starts[i:j] = _offsets([lo])
+        ends[i:j] = _offsets([hi])
+        return self._checked()
+
+    def clr_range(self, lo, hi):
+        # replace the runs that overlap lo..hi with what is left of them
+        starts, ends = self.starts, self.ends
+        i = bisect.bisect_left(ends, lo)
+        j = bisect.bisect_right(starts, hi)
+        if i >= j:
+            return self
+        s, e = [], []
+        if starts[i] < lo:
+            s.append(starts[i])
+            e.append(lo - 1)
+        if ends[j-1] > hi:
+            s.append(hi + 1)
+            e.append(ends[j-1])
+        starts[i:j] = _offsets(s)
+        ends[i:j] = _offsets(e)
+        if not starts:
+            return None
+        return self._checked()
+
+def _chunk_set_range(chunk, lo, hi):
+    if chunk is None or (lo == 0 and hi == _CHUNK_MASK):
+        return _RunChunk(_offsets([lo]), _offsets([hi]))
+    if isinstance(chunk, _RunChunk):
+        return chunk.set_range(lo, hi)
+    bm = chunk.bitmap()
+    bm.set_range(lo, hi + 1)
+    return _chunk_from_bitmap(bm)
+
+def _chunk_op(c, d, bm_op, set_op):
+    # c op d for two chunks, or None if the result is empty
+    if isinstance(c, _ArrayChunk) and isinstance(d, _ArrayChunk):
+        return _chunk_from_values(sorted(set_op(set(c.a), set(d.a))))
+    if set_op is operator.and_:
+        # the result is no bigger than an array operand
+        if isinstance(d, _ArrayChunk):
+            c, d = d, c
+        if isinstance(c, _ArrayChunk):
+            return _chunk_from_values(d.select(c.a))
+    elif set_op is operator.sub and isinstance(c, _ArrayChunk):
+        return _chunk_from_values(sorted(set(c.a).difference(d.select(c.a))))
+    elif set_op is operator.or_ and isinstance(c, _RunChunk) and \
+            isinstance(d, _RunChunk):
+        c = c.copy()
+        for s, e in itertools.izip(d.starts, d.ends):
+            c = _chunk_set_range(c, s, e)
+        return c
+    return _chunk_from_bitmap(bm_op(c.bitmap(), d.bitmap()))
+
+def _andnot(x, y):
+    return x.andnot(y)
+
+class SparseBitmap(object):
+    """A compressed bitmap, for large and sparse sets of ids.
+
+    SparseBitmap has the interface of Bitmap, but allocates memory in
+    proportion to the set bits (see the comment above _CHUNK_SHIFT), so
+    setting bit 4 billion of an empty map costs a few bytes instead of
+    512 MB.  optimize() converts chunks to runs where that saves memory.
+    """
+    def __init__(self, nbits=64, resizeable=True):
+        self._nbits = nbits
+        self._resizeable = resizeable
+        self._keys = []
+        self._chunks = {}
+
+    def _check_arg(self, i):
+        if i < 0:
+            raise IndexError(_INDEX_ERR_FMT %
+                    (i, self._nbits, self._resizeable))
+
+        if i >= self._nbits:
+            if not self._resizeable:
+                raise IndexError(_INDEX_ERR_FMT %
+                        (i, self._nbits, self._resizeable))
+            else:
+                self._nbits = i + 1
+
+    def _put(self, k, chunk):
+        # store chunk k, or drop it if chunk is None
+        if chunk is None:
+            if k in self._chunks:
+                del self._chunks[k]
+                del self._keys[bisect.bisect_left(self._keys, k)]
+            return
+        if k not in self._chunks:
+            bisect.insort(self._keys, k)
+        self._chunks[k] = chunk
+
+    def _set_keys(self, chunks):
+        self._chunks = chunks
+        self._keys = sorted(chunks)
+
+    def is_set(self, i):
+        if i >= self._nbits or i < 0:
+            raise IndexError(_INDEX_ERR_FMT %
+                    (i, self._nbits, self._resizeable))
+        c = self._chunks.get(i >> _CHUNK_SHIFT)
+        return c is not None and c.contains(i & _CHUNK_MASK)
+
+    def set(self, i):
+        self._check_arg(i)
+        k = i >> _CHUNK_SHIFT
+        c = self._chunks.get(k)
+        if c is None:
+            self._put(k, _ArrayChunk(_offsets([i & _CHUNK_MASK])))
+        else:
+            self._chunks[k] = c.add(i & _CHUNK_MASK)
+
+    def clr(self, i):
+        self._check_arg(i)
+        k = i >> _CHUNK_SHIFT
+        c = self._chunks.get(k)
+        if c is not None:
+            self._put(k, c.remove(i & _CHUNK_MASK))
+
+    def set_range(self, start, stop):
+        """Set bits start to stop-1."""
+        if start >= stop:
+            return
+        self._check_arg(stop - 1)
+        self._check_arg(start)
+        last = stop - 1
+        for k in xrange(start >> _CHUNK_SHIFT, (last >> _CHUNK_SHIFT) + 1):
+            base = k << _CHUNK_SHIFT
+            lo = max(start, base) - base
+            hi = min(last, base + _CHUNK_MASK) - base
+            self._put(k, _chunk_set_range(self._chunks.get(k), lo, hi))
+
+    def clr_range(self, start, stop):
+        """Clear bits start to stop-1."""
+        if start >= stop:
+            return
+        self._check_arg(stop - 1)
+        self._check_arg(start)
+        last = stop - 1
+        keys = self._keys
+        i = bisect.bisect_left(keys, start >> _CHUNK_SHIFT)
+        j = bisect.bisect_right(keys, last >> _CHUNK_SHIFT)
+        for k in keys[i:j]:
+            base = k << _CHUNK_SHIFT
+            lo = max(start, base) - base
+            hi = min(last, base + _CHUNK_MASK) - base
+            if lo == 0 and hi == _CHUNK_MASK:
+                self._put(k, None)
+            else:
+                self._put(k, self._chunks[k].clr_range(lo, hi))
+
+    def set_many(self, indexes):
+        """Set each bit in indexes, an iterable or array of ints.
+
+        The indexes are checked before any bit is set.
+        """
+        indexes = _sized(indexes)
+        if not len(indexes):
+            return
+        self._check_arg(max(indexes))
+        self._check_arg(min(indexes))
+        # sort once, then merge each chunk's share of the indexes
+        indexes = sorted(set(indexes))
+        i = 0
+        n = len(indexes)
+        while i < n:
+            k = indexes[i] >> _CHUNK_SHIFT
+            base = k << _CHUNK_SHIFT
+            j = bisect.bisect_left(indexes, base + _CHUNK_BITS, i)
+            offsets = [x - base for x in indexes[i:j]]
+            c = self._chunks.get(k)
+            if c is None:
+                c = _chunk_from_values(offsets)
+            elif isinstance(c, _ArrayChunk):
+                c = _chunk_from_values(sorted(set(c.a).union(offsets)))
+            else:
+                bm = c.bitmap()
+                bm.set_many(offsets)
+                c = _chunk_from_bitmap(bm)
+            self._put(k, c)
+            i = j
+
+    def test_many(self, indexes):
+        """Return a list of is_set(i) for each i in indexes."""
+        return [self.is_set(i) for i in _sized(indexes)]
+
+    def zero(self):
+        """Clear every bit."""
+        self._set_keys({})
+
+    def fill(self):
+        """Set every bit below nbits."""
+        self.set_range(0, self._nbits)
+
+    def resize(self, nbits):
+        """Grow or shrink the map to nbits bits, as Bitmap.resize()."""
+        if nbits < 0:
+            raise ValueError('invalid nbits (%d)' % nbits)
+        if nbits < self._nbits:
+            self.clr_range(nbits, self._nbits)
+        self._nbits = nbits
+
+    def copy(self):
+        """Return a new map with the same size and bits."""
+        m = SparseBitmap(self._nbits, self._resizeable)
+        m._set_keys(dict((k, c.copy()) for k, c in self._chunks.iteritems()))
+        return m
+
+    def optimize(self):
+        """Store each chunk in its smallest form, counting runs."""
+        for k, c in self._chunks.items():
+            # runs take 4 bytes each, offsets 2, and a Bitmap 8 KB
+            nruns = c.runs()
+            if nruns >= _RUN_MAX or 2 * nruns >= c.card():
+                if isinstance(c, _RunChunk):
+                    self._chunks[k] = _chunk_from_bitmap(c.bitmap())
+            elif not isinstance(c, _RunChunk):
+                starts = []
+                ends = []
+                prev = -2
+                for x in c:
+                    if x != prev + 1:
+                        if starts:
+                            ends.append(prev)
+                        starts.append(x)
+                    prev = x
+                ends.append(prev)
+                self._chunks[k] = _RunChunk(_offsets(starts), _offsets(ends))
+
+    def popcount(self):
+        """Return the number of set bits."""
+        return sum(c.card() for c in self._chunks.itervalues())
+
+    def iter_set(self):
+        """Yield the index of each set bit, in increasing order."""
+        for k in list(self._keys):
+            base = k << _CHUNK_SHIFT
+            for x in self._chunks[k]:
+                yield base + x
+
+    def ffs(self):
+        if not self._keys:
+            return -1
+        k = self._keys[0]
+        return (k << _CHUNK_SHIFT) + self._chunks[k].first()
+
+    def fls(self):
+        if not self._keys:
+            return -1
+        k = self._keys[-1]
+        return (k << _CHUNK_SHIFT) + self._chunks[k].last()
+
+    def _grow_one(self):
+        if self._resizeable:
+            self._nbits += 1
+            return self._nbits - 1
+        else:
+            return -1
+
+    def ffc(self):
+        # the first missing or non-full chunk holds the first clear bit
+        i = None
+        expect = 0
+        for k in self._keys:
+            if k != expect:
+                break
+            x = self._chunks[k].first_clear()
+            if x is not None:
+                i = (k << _CHUNK_SHIFT) + x
+                break
+            expect = k + 1
+        if i is None:
+            i = expect << _CHUNK_SHIFT
+        if i < self._nbits:
+            return i
+        return self._grow_one()
+
+    def flc(self):
+        hi = self._nbits - 1
+        keys = self._keys
+        j = bisect.bisect_right(keys, hi >> _CHUNK_SHIFT)
+        while hi >= 0:
+            k = hi >> _CHUNK_SHIFT
+            if not j or keys[j-1] != k:
+                return hi
+            x = self._chunks[k].last_clear(hi & _CHUNK_MASK)
+            if x is not None:
+                return (k << _CHUNK_SHIFT) + x
+            hi = (k << _CHUNK_SHIFT) - 1
+            j -= 1
+        return self._grow_one()
+
+    def _combine(self, other, bm_op, set_op, keep_self, keep_other):
+        # self = self op other, chunk by chunk
+        chunks = {}
+        for k, c in self._chunks.iteritems():
+            d = other._chunks.get(k)
+            if d is None:
+                if keep_self:
+                    chunks[k] = c
+            else:
+                c = _chunk_op(c, d, bm_op, set_op)
+                if c is not None:
+                    chunks[k] = c
+        if keep_other:
+            for k, d in other._chunks.iteritems():
+                if k not in self._chunks:
+                    chunks[k] = d.copy()
+        self._set_keys(chunks)
+
+    def _cover(self, other):
+        # make room for the set bits of other
+        if other._nbits <= self._nbits:
+            return
+        if self._resizeable:
+            self._nbits = other._nbits
+            return
+        i = other.fls()
+        if i >= self._nbits:
+            raise IndexError(_INDEX_ERR_FMT %
+                    (i, self._nbits, self._resizeable))
+
+    def __iand__(self, other):
+        if not isinstance(other, SparseBitmap):
+            return NotImplemented
+        self._combine(other, operator.and_, operator.and_, False, False)
+        return self
+
+    def __ior__(self, other):
+        if not isinstance(other, SparseBitmap):
+            return NotImplemented
+        self._cover(other)
+        self._combine(other, operator.or_, operator.or_, True, True)
+        return self
+
+    def __ixor__(self, other):
+        if not isinstance(other, SparseBitmap):
+            return NotImplemented
+        self._cover(other)
+        self._combine(other, operator.xor, operator.xor, True, True)
+        return self
+
+    def iandnot(self, other):
+        """Clear the bits of self that are set in other, in place."""
+        self._combine(other, _andnot, operator.sub, True, False)
+        return self
+
+    def _grown_copy(self, other):
+        m = self.copy()
+        if other._nbits > m._nbits:
+            m._nbits = other._nbits
+        return m
+
+    def __and__(self, other):
+        if not isinstance(other, SparseBitmap):
+            return NotImplemented
+        m = self.copy()
+        m &= other
+        return m
+
+    def __or__(self, other):
+        if not isinstance(other, SparseBitmap):
+            return NotImplemented
+        m = self._grown_copy(other)
+        m |= other
+        return m
+
+    def __xor__(self, other):
+        if not isinstance(other, SparseBitmap):
+            return NotImplemented
+        m = self._grown_copy(other)
+        m ^= other
+        return m
+
+    def andnot(self, other):
+        """Return a copy of self without the bits that are set in other."""
+        return self.copy().iandnot(other)
+
+#
+#   A serialized BloomFilter is a header followed by the filter's state:
+#
+#       offset  size
+#       0       4       magic, 'CBBF'
+#       4       1       0 for a BloomFilter, 1 for a CountingBloomFilter
+#       5       1       nhashes
+#       6       2       padding
+#       8       8       nbits, little endian
+#       16              a BloomFilter's bitmap words, little endian, or a
+#                       CountingBloomFilter's counters, one byte each
+#
+
+_BLOOM_MAGIC = 'CBBF'
+_BLOOM_HEADER = struct.Struct('<4sBB2xQ')
+_BLOOM_HASH = struct.Struct('<QQ')
+_COUNTER_MAX = 255
+
+def _bloom_hashes(key):
+    # two independent 64-bit hashes of key
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return _BLOOM_HASH.unpack(hashlib.md5(key).digest())
+
+class BloomFilter(object):
+    """A Bloom filter over a Bitmap.
+
+    The filter is sized for capacity keys at the given false positive
+    rate.  Keys are strings.  Each key sets nhashes bits, chosen by
+    double hashing: bit (h1 + i*h2) mod nbits for i < nhashes, where h1
+    and h2 come from one MD5 of the key.  add_many() and contains_many()
+    hash a whole batch of keys and then set or test all of its bits in
+    one Bitmap call.
+    """
+    _KIND = 0
+
+    def __init__(self, capacity, error_rate=0.01):
+        if capacity <= 0:
+            raise ValueError('invalid capacity (%d)' % capacity)
+        if not 0.0 < error_rate < 1.0:
+            raise ValueError('invalid error_rate (%r)' % error_rate)
+        nbits = int(math.ceil(-capacity * math.log(error_rate) /
+                math.log(2) ** 2))
+        nhashes = int(round(nbits * math.log(2) / capacity))
+        self._init(nbits, min(max(nhashes, 1), 255))
+
+    def _init(self, nbits, nhashes):
+        self._nbits = nbits
+        self._nhashes = nhashes
+        self._bits = Bitmap(nbits, resizeable=False)
+
+    def _positions(self, keys):
+        # the bit positions of each key in turn, nhashes per key
+        m = self._nbits
+        ks = range(self._nhashes)
+        positions = []
+        extend = positions.extend
+        for key in keys:
+            h1, h2 = _bloom_hashes(key)
+            # reduce first, so the arithmetic stays in machine ints
+            h1 %= m
+            h2 = h2 % m or 1
+            extend([(h1 + i * h2) % m for i in ks])
+        return positions
+
+    def _check_shape(self, other):
+        if type(other) is not type(self) or other._nbits != self._nbits or \
+                other._nhashes != self._nhashes:
+            raise ValueError('filters differ in type, nbits or nhashes')
+
+    def add(self, key):
+        self._bits.set_many(self._positions((key,)))
+
+    def add_many(self, keys):
+        """Add each key of an iterable of keys."""
+        self._bits.set_many(self._positions(keys))
+
+    def __contains__(self, key):
+        return all(self._bits.test_many(self._positions((key,))))
+
+    def contains_many(self, keys):
+        """Return a list of (key in self) for each key in keys."""
+        found = self._test(self._positions(keys))
+        k = self._nhashes
+        return [all(found[j:j+k]) for j in xrange(0, len(found), k)]
+
+    def _test(self, positions):
+        return self._bits.test_many(positions)
+
+    def __ior__(self, other):
+        if not isinstance(other, BloomFilter):
+            return NotImplemented
+        self._check_shape(other)
+        self._bits |= other._bits
+        return self
+
+    def __or__(self, other):
+        if not isinstance(other, BloomFilter):
+            return NotImplemented
+        self._check_shape(other)
+        f = self.__class__.__new__(self.__class__)
+        f._init(self._nbits, self._nhashes)
+        f |= self
+        f |= other
+        return f
+
+    def _payload(self):
+        return self._bits.to_bytes()
+
+    def _load(self, payload):
+        self._bits = Bitmap.from_bytes(payload, self._nbits, False)
+
+    def _payload_size(self):
+        return _nwords(self._nbits) * _WORD_BYTES
+
+    def to_bytes(self):
+        """Return the filter as a string; see the comment above _BLOOM_MAGIC."""
+        return _BLOOM_HEADER.pack(_BLOOM_MAGIC, self._KIND, self._nhashes,
+                self._nbits) + self._payload()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Return the filter that to_bytes() turned into data."""
+        if len(data) < _BLOOM_HEADER.size:
+            raise ValueError('truncated filter')
+        magic, kind, nhashes, nbits = _BLOOM_HEADER.unpack_from(data)
+        if magic != _BLOOM_MAGIC or kind != cls._KIND or not nhashes:
+            raise ValueError('not a %s' % cls.__name__)
+        f = cls.__new__(cls)
+        f._init(nbits, nhashes)
+        payload = data[_BLOOM_HEADER.size:]
+        if len(payload) != f._payload_size():
+            raise ValueError('truncated filter')
+        f._load(payload)
+        return f
+
+class CountingBloomFilter(BloomFilter):
+    """A BloomFilter with a counter per position, so keys can be removed.
+
+    Counters are one byte each, and stick at 255: a counter that reaches
+    255 is never decremented again, which keeps the filter free of false
+    negatives at the cost of a little accuracy.
+    """
+    _KIND = 1
+
+    def _init(self, nbits, nhashes):
+        self._nbits = nbits
+        self._nhashes = nhashes
+        self._counts = array.array('B', [0]) * nbits
+
+    def add(self, key):
+        self.add_many((key,))
+
+    def add_many(self, keys):
+        counts = self._counts
+        for i in self._positions(keys):
+            c = counts[i]
+            if c < _COUNTER_MAX:
+                counts[i] = c + 1
+
+    def remove(self, key):
+        """Remove a key added before; raise KeyError if key is absent."""
+        counts = self._counts
+        positions = self._positions((key,))
+        if not all(counts[i] for i in positions):
+            raise KeyError(key)
+        for i in positions:
+            c = counts[i]
+            if c < _COUNTER_MAX:
+                counts[i] = c - 1
+
+    def __contains__(self, key):
+        counts = self._counts
+        return all(counts[i] for i in self._positions((key,)))
+
+    def _test(self, positions):
+        counts = self._counts
+        return [counts[i] for i in positions]
+
+    def __ior__(self, other):
+        if not isinstance(other, CountingBloomFilter):
+            return NotImplemented
+        self._check_shape(other)
+        self._counts = array.array('B', [min(a + b, _COUNTER_MAX)
+                for a, b in itertools.izip(self._counts, other._counts)])
+        return self
+
+    def _payload(self):
+        return self._counts.tostring()
+
+    def _load(self, payload):
+        self._counts = array.array('B', payload)
+
+    def _payload_size(self):
+        return self._nbits
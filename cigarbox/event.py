@@ -1,7 +1,15 @@
 #!/usr/bin/env python
 
+import collections
 import errno
+import fcntl
+import heapq
+import math
+import os
+import Queue
 import select
+import signal
+import threading
 import time
 
 from cigarbox import bitops
@@ -11,9 +19,70 @@ READ    = 1
 WRITE   = 2
 TIMEOUT = 4
 PERSIST = 8
-ALL_MASK = READ | WRITE | TIMEOUT | PERSIST
+EDGE    = 16
+ONESHOT = 32
+ALL_MASK = READ | WRITE | TIMEOUT | PERSIST | EDGE | ONESHOT
+
+# the parts of a mask that the readiness backends care about
+_KERNEL_MASK = READ | WRITE | EDGE | ONESHOT
 
 DEFAULT_MIN_TIMEOUT_MS = 5000
+DEFAULT_EXECUTOR_THREADS = 4
+
+_CLOCK_MONOTONIC = 1
+_TFD_NONBLOCK = os.O_NONBLOCK
+_TFD_CLOEXEC = 0o2000000
+_TFD_TIMER_ABSTIME = 1
+
+# Python 2 has no bindings for clock_gettime(2) or timerfd_create(2); reach
+# them through ctypes where libc provides them
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+def _load_libc():
+    if ctypes is None:
+        return None
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+if _libc is not None:
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    class _itimerspec(ctypes.Structure):
+        _fields_ = [('it_interval', _timespec), ('it_value', _timespec)]
+
+def _libc_error():
+    e = ctypes.get_errno()
+    return OSError(e, os.strerror(e))
+
+def _make_monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        clock_gettime = _libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    except AttributeError:
+        debug.debug('no monotonic clock; falling back to time.time')
+        return time.time
+
+    ts = _timespec()
+    pts = ctypes.pointer(ts)
+    def monotonic():
+        if clock_gettime(_CLOCK_MONOTONIC, pts) != 0:
+            raise _libc_error()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+# seconds since an arbitrary, fixed point; unaffected by wall-clock jumps
+monotonic = _make_monotonic()
 
 def _mask_to_str(mask):
     a = []
@@ -21,6 +90,8 @@ def _mask_to_str(mask):
     if mask & WRITE:   a.append('WRITE')
     if mask & TIMEOUT: a.append('TIMEOUT')
     if mask & PERSIST: a.append('PERSIST')
+    if mask & EDGE:    a.append('EDGE')
+    if mask & ONESHOT: a.append('ONESHOT')
     return '|'.join(a)
 
 def _poll_flags_to_str(flags):
@@ -42,186 +113,1466 @@ def _poll_flags_to_mask(flags):
         assert what, 'poll flags=0x%08x' % flags
         return what
 
+def _fn_name(fn):
+    name = getattr(fn, '__name__', None)
+    if name is None:
+        return repr(fn)
+    module = getattr(fn, '__module__', None)
+    if module:
+        return '%s.%s' % (module, name)
+    return name
+
+class _Histogram(object):
+    """Histogram of non-negative integers in power-of-two buckets.
+
+    Bucket i counts the values v with v.bit_length() == i; that is, bucket
+    0 holds 0 and bucket i > 0 holds [2**(i-1), 2**i).  add() is a couple
+    of integer operations, cheap enough to call on every loop iteration.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    _NBUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * self._NBUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, v):
+        i = v.bit_length()
+        if i >= self._NBUCKETS:
+            i = self._NBUCKETS - 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, p):
+        """Return an upper bound on the p-th percentile (0 < p <= 100)."""
+        if not self.count:
+            return 0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min((1 << i) - 1, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            # (upper bound, count) for each non-empty bucket
+            'buckets': [((1 << i) - 1, n) for i, n in
+                enumerate(self.buckets) if n],
+        }
+
+class _LoopStats(object):
+    __slots__ = ('iterations', 'callbacks', 'timeouts', 'slow_callbacks',
+            'poll_wait_us', 'events_per_wakeup', 'callback_us',
+            'timer_lateness_us')
+
+    def __init__(self):
+        self.iterations = 0
+        self.callbacks = 0
+        self.timeouts = 0
+        self.slow_callbacks = 0
+        self.poll_wait_us = _Histogram()
+        self.events_per_wakeup = _Histogram()
+        self.callback_us = _Histogram()
+        self.timer_lateness_us = _Histogram()
+
+    def snapshot(self):
+        return {
+            'iterations': self.iterations,
+            'callbacks': self.callbacks,
+            'timeouts': self.timeouts,
+            'slow_callbacks': self.slow_callbacks,
+            'poll_wait_us': self.poll_wait_us.snapshot(),
+            'events_per_wakeup': self.events_per_wakeup.snapshot(),
+            'callback_us': self.callback_us.snapshot(),
+            'timer_lateness_us': self.timer_lateness_us.snapshot(),
+        }
+
+class CancelledError(Exception):
+    pass
+
+class Future(object):
+    """The eventual result of an operation running on a Loop.
+
+    The API follows asyncio.Future.  Done callbacks are called as fn(future)
+    on the loop's thread, through loop.call_soon(), in the order they were
+    added.  Futures are not thread-safe; complete them from other threads
+    with loop.call_soon_threadsafe().
+    """
+    __slots__ = ('_loop', '_state', '_result', '_exception', '_callbacks')
+
+    _PENDING = 0
+    _CANCELLED = 1
+    _FINISHED = 2
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._state = self._PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._state != self._PENDING
+
+    def cancelled(self):
+        return self._state == self._CANCELLED
+
+    def result(self):
+        """Return the result, or raise the future's exception.
+
+        Raises:
+            CancelledError: the future was cancelled.
+            ValueError: the future is not done yet.
+        """
+        if self._state == self._CANCELLED:
+            raise CancelledError()
+        if self._state != self._FINISHED:
+            raise ValueError('future is not done')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        """Return the future's exception, or None if it succeeded."""
+        if self._state == self._CANCELLED:
+            raise CancelledError()
+        if self._state != self._FINISHED:
+            raise ValueError('future is not done')
+        return self._exception
+
+    def add_done_callback(self, fn):
+        if self.done():
+            self._loop.call_soon(fn, self)
+        else:
+            self._callbacks.append(fn)
+
+    def remove_done_callback(self, fn):
+        n = len(self._callbacks)
+        self._callbacks = [cb for cb in self._callbacks if cb != fn]
+        return n - len(self._callbacks)
+
+    def _schedule_callbacks(self):
+        callbacks = self._callbacks
+        self._callbacks = []
+        for fn in callbacks:
+            self._loop.call_soon(fn, self)
+
+    def set_result(self, result):
+        if self.done():
+            raise ValueError('future is already done')
+        self._result = result
+        self._state = self._FINISHED
+        self._schedule_callbacks()
+
+    def set_exception(self, exc):
+        if self.done():
+            raise ValueError('future is already done')
+        self._exception = exc
+        self._state = self._FINISHED
+        self._schedule_callbacks()
+
+    def cancel(self):
+        """Cancel the future.
+
+        Returns False if the future was already done, and True otherwise.
+        """
+        if self.done():
+            return False
+        self._state = self._CANCELLED
+        self._schedule_callbacks()
+        return True
+
+class _Sleep(object):
+    __slots__ = ('ms',)
+
+    def __init__(self, ms):
+        self.ms = ms
+
+def sleep(ms):
+    """Return a value that a Task yields to sleep for ms milliseconds."""
+    return _Sleep(ms)
+
+class Task(Future):
+    """A generator driven by a Loop; create one with loop.spawn().
+
+    The generator yields what it waits for, and is resumed with the
+    outcome:
+
+        (fd, READ) or (fd, WRITE): resumed with the event mask once fd is
+            ready.  The fd stays registered with the kernel (as a ONESHOT
+            event) between yields, so waiting on the same fd again only
+            re-arms it.  While a task waits on an fd, nothing else in the
+            loop may add() that fd.
+
+        sleep(ms): resumed with None after ms milliseconds; sleep(0)
+            just lets other ready work run first.
+
+        a Future (including another Task): resumed with its result, or
+            has its exception raised at the yield.
+
+    The task is itself a Future: it completes with None when the
+    generator returns, or with the exception that escaped the generator.
+    Cancelling the task closes the generator and drops its fd.
+    """
+    __slots__ = ('_gen', '_fd', '_timer')
+
+    def __init__(self, loop, gen):
+        Future.__init__(self, loop)
+        self._gen = gen
+        self._fd = -1
+        self._timer = 0
+        loop.call_soon(self._step, None, None)
+
+    def _release(self):
+        if self._fd >= 0:
+            self._loop.remove(self._fd)
+            self._fd = -1
+        if self._timer:
+            self._loop.remove(self._timer)
+            self._timer = 0
+
+    def _step(self, value, exc):
+        if self.done():
+            return
+        try:
+            if exc is None:
+                yielded = self._gen.send(value)
+            else:
+                yielded = self._gen.throw(exc)
+        except StopIteration:
+            self._release()
+            self.set_result(None)
+            return
+        except Exception as e:
+            self._release()
+            self.set_exception(e)
+            return
+
+        loop = self._loop
+        if isinstance(yielded, tuple):
+            fd, mask = yielded
+            if not mask & (READ | WRITE) or mask & ~(READ | WRITE):
+                loop.call_soon(self._step, None,
+                        ValueError('invalid task mask %08x' % mask))
+            elif fd == self._fd:
+                loop.rearm(fd, mask)
+            else:
+                if self._fd >= 0:
+                    loop.remove(self._fd)
+                loop.add(fd, self._on_io, mask|ONESHOT)
+                self._fd = fd
+        elif isinstance(yielded, _Sleep):
+            if yielded.ms > 0:
+                self._timer = loop.once(self._on_timeout, yielded.ms)
+            else:
+                loop.call_soon(self._step, None, None)
+        elif isinstance(yielded, Future):
+            yielded.add_done_callback(self._on_future)
+        else:
+            loop.call_soon(self._step, None,
+                    TypeError('task yielded %r' % (yielded,)))
+
+    def _on_io(self, what, loop):
+        self._step(what, None)
+
+    def _on_timeout(self, what, loop):
+        self._timer = 0
+        self._step(None, None)
+
+    def _on_future(self, future):
+        if future.cancelled():
+            self._step(None, CancelledError())
+        elif future.exception() is not None:
+            self._step(None, future.exception())
+        else:
+            self._step(future.result(), None)
+
+    def cancel(self):
+        if self.done():
+            return False
+        self._release()
+        self._gen.close()
+        return Future.cancel(self)
+
 class _Event(object):
-    def __init__(self, fd, fn, mask, timeout=0):
+    def __init__(self, fd, fn, mask, timeout=0, now=0):
         self.fd = fd
         self.fn = fn
         self.mask = mask
         self.timeout = timeout
         self.dispatchable = True
+        self.armed = True
+        self.timer = None
         if timeout > 0:
-            self.reset_expires()
+            self.reset_expires(now)
         else:
             self.expires = 0
 
     def has_timeout(self):
         return self.timeout > 0
 
-    def has_expired(self):
-        assert self.timeout > 0 and self.expires > 0
-        return time.time() >  self.expires
+    def has_expired(self, now):
+        assert self.timeout > 0
+        return now >= self.expires
 
-    def reset_expires(self):
+    def reset_expires(self, now):
         assert self.timeout > 0
-        t = time.time()
-        ms = self.timeout / 1000.0
-        self.expires = t + ms
+        self.expires = now + self.timeout / 1000.0
+
+class _FdHandlers(object):
+    """The reader and writer callbacks sharing one fd's event."""
+    __slots__ = ('event', 'reader', 'writer')
+
+    def __init__(self):
+        self.event = None
+        self.reader = None
+        self.writer = None
+
+    def mask(self):
+        mask = 0
+        if self.reader is not None:
+            mask |= READ
+        if self.writer is not None:
+            mask |= WRITE
+        return mask
+
+    def dispatch(self, what, loop):
+        # either callback may drop the other, so look each up when needed
+        if what & READ and self.reader is not None:
+            self.reader(READ, loop)
+        if what & WRITE and self.writer is not None:
+            self.writer(WRITE, loop)
+
+class _TimerHeap(object):
+    """Min-heap of event deadlines.
+
+    Insertion is O(log n).  Cancellation is O(1): the heap entry is
+    marked dead and discarded once it reaches the top of the heap, or when
+    dead entries make up more than half of the heap.
+    """
+    _COMPACT_MIN = 64
+
+    def __init__(self, slack=0):
+        self._heap = []
+        self._seq = 0
+        self._ncancelled = 0
+        self._slack = slack / 1000.0
+
+    def __len__(self):
+        return len(self._heap) - self._ncancelled
+
+    def push(self, ident, event):
+        # the sequence number breaks ties between equal deadlines so that
+        # events are never compared, and timers fire in insertion order
+        entry = [event.expires, self._seq, ident, event]
+        self._seq += 1
+        event.timer = entry
+        heapq.heappush(self._heap, entry)
+
+    def cancel(self, event):
+        entry = event.timer
+        if entry is None:
+            return
+        entry[3] = None
+        event.timer = None
+        self._ncancelled += 1
+        if (self._ncancelled > self._COMPACT_MIN and
+                self._ncancelled * 2 > len(self._heap)):
+            self._heap = [e for e in self._heap if e[3] is not None]
+            heapq.heapify(self._heap)
+            self._ncancelled = 0
+
+    def next_deadline(self):
+        """Return the earliest live deadline, or None if there is none."""
+        heap = self._heap
+        while heap and heap[0][3] is None:
+            heapq.heappop(heap)
+            self._ncancelled -= 1
+        if heap:
+            return heap[0][0]
+        return None
+
+    def next_wakeup(self):
+        """Return when the loop should next wake up for a timer, or None.
+
+        With slack, the earliest deadline is rounded up to the end of its
+        slack window, so every timer due within that window fires in the
+        same wakeup.
+        """
+        deadline = self.next_deadline()
+        if deadline is None or not self._slack:
+            return deadline
+        return math.ceil(deadline / self._slack) * self._slack
+
+    def poll_timeout(self, now, idle):
+        """Return the poll timeout in milliseconds, at most idle."""
+        wakeup = self.next_wakeup()
+        if wakeup is None:
+            return idle
+        ms = int(math.ceil((wakeup - now) * 1000))
+        return max(0, min(ms, idle))
+
+    def close(self):
+        pass
+
+    def pop_expired(self, now):
+        """Remove and return the (ident, event) pairs due at or before now.
+
+        The expired events are collected before any of them is dispatched,
+        so a callback that re-arms a timer cannot make this loop spin.
+        """
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            event = entry[3]
+            if event is None:
+                self._ncancelled -= 1
+                continue
+            event.timer = None
+            expired.append((entry[2], event))
+        return expired
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class _Waker(object):
+    """A self-pipe that lets other threads wake up a sleeping Loop.
+
+    wake() only writes to the pipe if no wakeup is already outstanding, so
+    a burst of wake() calls costs one write and one loop dispatch.  The
+    owner must queue its work before calling wake(), and pop it only after
+    drain() returns.
+    """
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        _set_nonblocking(self._rfd)
+        _set_nonblocking(self._wfd)
+        self._pending = False
+
+    def fileno(self):
+        return self._rfd
+
+    def wake(self):
+        if self._pending:
+            return
+        self._pending = True
+        try:
+            os.write(self._wfd, '\0')
+        except OSError as e:
+            # a full pipe already guarantees a wakeup
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def drain(self):
+        while True:
+            try:
+                data = os.read(self._rfd, 4096)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if len(data) < 4096:
+                break
+        # clear the flag only once the pipe is empty.  Cleared earlier, a
+        # wake() could set it again and have its byte consumed by this
+        # drain, leaving the flag set with nothing in the pipe, and every
+        # later wake() would be lost.  A wake() that finds the flag still
+        # set here queued its work before it, and the caller pops that
+        # work after drain() returns.
+        self._pending = False
+
+    def close(self):
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+class _ThreadPool(object):
+    """A fixed number of worker threads that run jobs for a Loop.
+
+    Each job's outcome is handed to done(callback, result, exc) on the
+    worker thread; the Loop uses that to queue the completion and wake
+    itself up.
+    """
+    def __init__(self, nthreads, done):
+        self._jobs = Queue.Queue()
+        self._done = done
+        self._threads = []
+        for i in xrange(nthreads):
+            t = threading.Thread(target=self._work,
+                    name='cigarbox-executor-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn, args, callback):
+        self._jobs.put((fn, args, callback))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            fn, args, callback = job
+            try:
+                result = fn(*args)
+            except Exception as e:
+                self._done(callback, None, e)
+            else:
+                self._done(callback, result, None)
+
+    def shutdown(self):
+        for t in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+class _TimerfdTimers(_TimerHeap):
+    """A timer heap whose next wakeup is kept in a timerfd.
+
+    The kernel keeps the deadline: the timerfd is armed, on
+    CLOCK_MONOTONIC, to the heap's next wakeup and is registered with the
+    loop as an ordinary READ event.  The loop then polls with its idle
+    timeout.  The timerfd is only re-armed when the next wakeup changes.
+    """
+    def __init__(self, slack=0):
+        _TimerHeap.__init__(self, slack)
+        create = _libc.timerfd_create
+        create.argtypes = [ctypes.c_int, ctypes.c_int]
+        self._settime = _libc.timerfd_settime
+        self._settime.argtypes = [ctypes.c_int, ctypes.c_int,
+                ctypes.POINTER(_itimerspec), ctypes.POINTER(_itimerspec)]
+        self._fd = create(_CLOCK_MONOTONIC, _TFD_NONBLOCK | _TFD_CLOEXEC)
+        if self._fd < 0:
+            raise _libc_error()
+        self._spec = _itimerspec()
+        self._armed = None
+
+    def fileno(self):
+        return self._fd
+
+    def _arm(self, when):
+        # an all-zero it_value disarms the timer
+        value = self._spec.it_value
+        if when is None:
+            value.tv_sec = value.tv_nsec = 0
+        else:
+            # round up, so that the loop's clock has reached the deadline
+            # by the time the timerfd fires
+            sec, nsec = divmod(int(math.ceil(when * 1e9)), 1000000000)
+            value.tv_sec = sec
+            value.tv_nsec = nsec
+        if self._settime(self._fd, _TFD_TIMER_ABSTIME,
+                ctypes.byref(self._spec), None) != 0:
+            raise _libc_error()
+        self._armed = when
+
+    def poll_timeout(self, now, idle):
+        wakeup = self.next_wakeup()
+        if wakeup != self._armed:
+            self._arm(wakeup)
+        return idle
+
+    def on_fire(self, what, loop):
+        try:
+            os.read(self._fd, 8)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+        # a fired timerfd is disarmed; the next poll_timeout() re-arms it
+        self._armed = None
+
+    def close(self):
+        os.close(self._fd)
+
+_TIMERS = {
+    'heap': _TimerHeap,
+    'timerfd': _TimerfdTimers,
+}
+
+def _have_timerfd():
+    return _libc is not None and hasattr(_libc, 'timerfd_create')
+
+class _Backend(object):
+    """Base class for the kernel readiness backends.
+
+    A backend keeps its registrations across loop iterations.  The Loop
+    calls update() whenever the interest mask of an fd may have changed;
+    the backend only talks to the kernel if the mask actually differs from
+    what is already registered.
+
+    Backends that cannot express EDGE treat it as level-triggered, which
+    only costs extra wakeups.  Backends without kernel ONESHOT support
+    emulate it through disarm().
+    """
+    name = None
+
+    def __init__(self):
+        self._fds = {}
+
+    def update(self, fd, mask):
+        mask &= _KERNEL_MASK
+        if not mask & (READ | WRITE):
+            mask = 0
+        old = self._fds.get(fd, 0)
+        if mask == old:
+            return
+        if not mask:
+            del self._fds[fd]
+            if debug.DEBUG:
+                debug.debug('unregister fd=%d' % fd)
+            self._unregister(fd)
+        elif not old:
+            self._fds[fd] = mask
+            if debug.DEBUG:
+                debug.debug('register fd=%d %s' % (fd, _mask_to_str(mask)))
+            self._register(fd, mask)
+        else:
+            self._fds[fd] = mask
+            if debug.DEBUG:
+                debug.debug('modify fd=%d %s' % (fd, _mask_to_str(mask)))
+            self._modify(fd, mask)
+
+    def refresh(self, fd, mask):
+        """Like update(), but always pass the mask of a registered fd on
+        to the kernel.
+
+        The Loop calls this for an fd added with a new event, which may
+        have been closed and its number reused since it was registered;
+        the kernel has then forgotten it, whatever mask the backend
+        remembers.  _modify() must register such an fd afresh.
+        """
+        mask &= _KERNEL_MASK
+        if not mask & (READ | WRITE) or fd not in self._fds:
+            self.update(fd, mask)
+            return
+        self._fds[fd] = mask
+        if debug.DEBUG:
+            debug.debug('refresh fd=%d %s' % (fd, _mask_to_str(mask)))
+        self._modify(fd, mask)
+
+    def disarm(self, fd, reported):
+        """Stop reporting a ONESHOT fd until it is updated again.
+
+        reported is true when the fd was just returned by poll().
+        """
+        self.update(fd, 0)
+
+    def __len__(self):
+        return len(self._fds)
+
+    def __contains__(self, fd):
+        return fd in self._fds
+
+    def _register(self, fd, mask):
+        raise NotImplementedError
+
+    def _modify(self, fd, mask):
+        raise NotImplementedError
+
+    def _unregister(self, fd):
+        raise NotImplementedError
+
+    def poll(self, timeout):
+        """Wait up to timeout milliseconds for registered fds.
+
+        Returns a list of (fd, what) tuples.  An interrupted wait (EINTR)
+        returns an empty list.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class _SelectBackend(_Backend):
+    name = 'select'
+
+    def __init__(self):
+        _Backend.__init__(self)
+        self._r = set()
+        self._w = set()
+
+    def _register(self, fd, mask):
+        if mask & READ:
+            self._r.add(fd)
+        if mask & WRITE:
+            self._w.add(fd)
+
+    def _modify(self, fd, mask):
+        if mask & READ:
+            self._r.add(fd)
+        else:
+            self._r.discard(fd)
+        if mask & WRITE:
+            self._w.add(fd)
+        else:
+            self._w.discard(fd)
+
+    def _unregister(self, fd):
+        self._r.discard(fd)
+        self._w.discard(fd)
+
+    def poll(self, timeout):
+        e = self._r | self._w
+        try:
+            r, w, e = select.select(self._r, self._w, e, timeout / 1000.0)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return []
+
+        ready = {}
+        for fd in r:
+            ready[fd] = READ
+        for fd in w:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        for fd in e:
+            ready[fd] = READ | WRITE
+        return ready.items()
+
+def _mask_to_poll_flags(mask):
+    flags = 0
+    if mask & READ:
+        flags |= select.POLLIN
+    if mask & WRITE:
+        flags |= select.POLLOUT
+    return flags
+
+class _PollBackend(_Backend):
+    name = 'poll'
+
+    def __init__(self):
+        _Backend.__init__(self)
+        self._pollster = select.poll()
+
+    def _register(self, fd, mask):
+        self._pollster.register(fd, _mask_to_poll_flags(mask))
+
+    def _modify(self, fd, mask):
+        self._pollster.modify(fd, _mask_to_poll_flags(mask))
+
+    def _unregister(self, fd):
+        self._pollster.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            r = self._pollster.poll(timeout)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return []
+        return [(fd, _poll_flags_to_mask(flags)) for fd, flags in r]
+
+def _mask_to_epoll_flags(mask):
+    flags = 0
+    if mask & READ:
+        flags |= select.EPOLLIN
+    if mask & WRITE:
+        flags |= select.EPOLLOUT
+    if mask & EDGE:
+        flags |= select.EPOLLET
+    if mask & ONESHOT:
+        flags |= select.EPOLLONESHOT
+    return flags
+
+class _EpollBackend(_Backend):
+    name = 'epoll'
+
+    def __init__(self):
+        _Backend.__init__(self)
+        self._epoll = select.epoll()
+
+    def _register(self, fd, mask):
+        self._epoll.register(fd, _mask_to_epoll_flags(mask))
+
+    def _modify(self, fd, mask):
+        try:
+            self._epoll.modify(fd, _mask_to_epoll_flags(mask))
+        except (IOError, OSError) as err:
+            # the fd was closed and its number reused while registered
+            # (e.g. by a Task that re-arms it), so the kernel dropped it
+            if err.errno != errno.ENOENT:
+                raise
+            self._register(fd, mask)
+
+    def disarm(self, fd, reported):
+        # the kernel disarms an EPOLLONESHOT fd when it reports it; the fd
+        # stays in the epoll set, so re-arming is a single EPOLL_CTL_MOD.
+        # The ONESHOT marker never equals a real mask, so the next update()
+        # always issues that modify.
+        if not reported:
+            self._epoll.modify(fd, 0)
+        self._fds[fd] = ONESHOT
+
+    def _unregister(self, fd):
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, OSError) as err:
+            # the fd was closed before it was removed from the loop, in
+            # which case the kernel has already dropped it from the set
+            if err.errno not in (errno.EBADF, errno.ENOENT):
+                raise
+
+    def poll(self, timeout):
+        try:
+            r = self._epoll.poll(timeout / 1000.0)
+        except (IOError, OSError) as err:
+            if err.errno != errno.EINTR:
+                raise
+            return []
+        # EPOLLIN/EPOLLOUT/EPOLLERR/EPOLLHUP share the values of their
+        # POLL* counterparts
+        return [(fd, _poll_flags_to_mask(flags)) for fd, flags in r]
+
+    def close(self):
+        self._epoll.close()
+
+_BACKENDS = {
+    'select': _SelectBackend,
+    'poll': _PollBackend,
+    'epoll': _EpollBackend,
+}
+
+def _default_backend_name():
+    for name in ('epoll', 'poll', 'select'):
+        if hasattr(select, name):
+            return name
+
 
 class Loop(object):
-    def __init__(self, min_timeout=None):
+    def __init__(self, min_timeout=None, backend=None, clock=None,
+            instrument=False, slow_callback_ms=0, max_callbacks=0,
+            max_dispatch_ms=0, timers='heap', timer_slack_ms=0):
+        """Create a run loop.
+
+        Args:
+            min_timeout (int, optional): the maximum time, in milliseconds,
+                that a single poll may block when no timer is due sooner.
+                Defaults to DEFAULT_MIN_TIMEOUT_MS.
+
+            backend (str, optional): the readiness backend to use: 'epoll',
+                'poll', or 'select'.  Defaults to the best one available on
+                the platform.
+
+            clock (func, optional): a function of no arguments that returns
+                the current time in seconds, used for all timer deadlines.
+                Defaults to the monotonic clock.  Tests and benchmarks can
+                pass their own clock to drive time deterministically.
+
+            instrument (bool, optional): collect the counters and histograms
+                reported by stats().  Costs a few clock reads per iteration
+                and per callback; off by default.
+
+            slow_callback_ms (int, optional): if positive, warn (through
+                debug.warn) about every callback that runs for longer than
+                this many milliseconds.  Also available as the
+                slow_callback_ms attribute.
+
+            max_callbacks (int, optional): if positive, the most callbacks
+                to dispatch in one loop iteration.  Also available as the
+                max_callbacks attribute.
+
+            max_dispatch_ms (int, optional): if positive, stop dispatching
+                callbacks in an iteration once this many milliseconds have
+                passed since the poll returned.  Also available as the
+                max_dispatch_ms attribute.
+
+            Ready fds and expired timers that are left over when a budget
+            runs out stay queued, in the order they became ready, and are
+            dispatched first in the next iteration, before the loop polls
+            again.  One busy fd or a burst of timers therefore cannot
+            starve the rest of the loop.
+
+            timers (str, optional): how timer deadlines are kept: 'heap' (the
+                default) computes the poll timeout from the earliest
+                deadline; 'timerfd' has the kernel keep it in a timerfd
+                (Linux only) that wakes the loop as an ordinary READ event.
+                'timerfd' requires the default clock.
+
+            timer_slack_ms (int, optional): coalescing window for timers.
+                The loop wakes up at the end of the window that holds the
+                earliest deadline, and fires every timer due by then, so
+                timers within one window cost a single wakeup.  Timers may
+                fire up to this much late.
+
+        Raises:
+            ValueError: backend or timers is unknown or not supported by the
+                platform, or timers='timerfd' is combined with a custom
+                clock.
+        """
         self._active = {} 
         self._pending = {}
-        self._neg_idents = bitops.Bitmap()
+        self._dead = []
+        self._neg_idents = bitops.HierBitmap()
         self._neg_idents.set(0)
-        self.min_timeout = DEFAULT_MIN_TIMEOUT_MS
-        self.min_timeout_stale = False
+        if min_timeout is None:
+            min_timeout = DEFAULT_MIN_TIMEOUT_MS
+        self.min_timeout = min_timeout
+        self._clock = clock or monotonic
+        self._now = self._clock()
+        self._dispatching = False
+        self._stopped = False
+        self._backend = self._make_backend(backend)
+        self._timers = self._make_timers(timers, timer_slack_ms, clock)
+        self._stats = _LoopStats() if instrument else None
+        self.slow_callback_ms = slow_callback_ms
+        self._ready = collections.deque()
+        self._signals = {}
+        self._sigcounts = {}
+        self._fdhandlers = {}
+        self._old_wakeup_fd = -1
+        self.max_callbacks = max_callbacks
+        self.max_dispatch_ms = max_dispatch_ms
+        self._internal = set()
+        self._soon = collections.deque()
+        self._executor = None
+        self._executor_threads = DEFAULT_EXECUTOR_THREADS
+        self._inflight = 0
+        self._completions = collections.deque()
+        # created up front so that other threads never have to register it
+        self._waker = _Waker()
+        self._add_internal(self._waker.fileno(), self._on_wake, READ|PERSIST)
+        if isinstance(self._timers, _TimerfdTimers):
+            self._add_internal(self._timers.fileno(), self._timers.on_fire,
+                    READ|PERSIST)
 
-    def _get_poll_fn(self):
-        if hasattr(select, 'poll'):
-            debug.debug('using poll')
-            return self._poll
-        else:
-            debug.debug('using select')
-            return self._select
+    def _make_timers(self, name, slack, clock):
+        if name not in _TIMERS:
+            raise ValueError('unsupported timers %r' % name)
+        if name == 'timerfd':
+            if not _have_timerfd():
+                raise ValueError('timerfd is not supported by the platform')
+            if clock is not None:
+                raise ValueError('timerfd requires the default clock')
+        debug.debug('using %s timers' % name)
+        return _TIMERS[name](slack)
 
-    def _reset_min_timeout(self):
-        self.min_timeout = DEFAULT_MIN_TIMEOUT_MS
-        for ident, event in self._pending.iteritems():
-            if event.has_timeout() and event.timeout < self.min_timeout:
-                self._min_timeout = event.timeout
-        self.min_timeout_stale = False
+    def _make_backend(self, name):
+        if name is None:
+            name = _default_backend_name()
+        if name not in _BACKENDS or not hasattr(select, name):
+            raise ValueError('unsupported backend %r' % name)
+        debug.debug('using %s' % name)
+        return _BACKENDS[name]()
+
+    @property
+    def backend(self):
+        """The name of the readiness backend ('epoll', 'poll', or 'select')"""
+        return self._backend.name
+
+    def now(self):
+        """Return the loop's cached time, in seconds.
+
+        The clock is sampled once before and once after each poll, and the
+        cached value is used for every expiry check and re-arm in between.
+        """
+        return self._now
+
+    def _poll_timeout(self):
+        if self._soon:
+            return 0
+        if len(self._timers):
+            self._now = self._clock()
+        return self._timers.poll_timeout(self._now, self.min_timeout)
+
+    def _kill(self, ident, event):
+        event.dispatchable = False
+        self._timers.cancel(event)
+        self._dead.append(ident)
 
     def _dispatch(self, ident, event, what):
-        debug.debug('ident=%d, what=%s' % (ident, _mask_to_str(what)))
+        if debug.DEBUG:
+            debug.debug('ident=%d, what=%s' % (ident, _mask_to_str(what)))
+        if event.mask & ONESHOT:
+            # disarm before the callback so that it can call rearm()
+            event.armed = False
+            self._timers.cancel(event)
+            self._backend.disarm(event.fd, what & (READ | WRITE))
+            event.fn(what, self)
+            return
         event.fn(what, self)
         if not event.mask & PERSIST:
-            event.dispatchable = False
-            if event.timeout == self.min_timeout:
-                self.min_timeout_stale = True
-        else:
-            if what & TIMEOUT:
-                assert event.timeout > 0
-                event.reset_expires()
+            if event.dispatchable:
+                self._kill(ident, event)
+        elif what & TIMEOUT and event.dispatchable:
+            # unless the callback removed its own event, re-arm its timer
+            assert event.timeout > 0
+            self._timers.cancel(event)
+            event.reset_expires(self._now)
+            self._timers.push(ident, event)
 
-    def _make_select_args(self):
-        r = []; w = []; e = []
-        for ident, event in self._active.iteritems():
+    def _merge_pending(self):
+        backend = self._backend
+        for ident in self._dead:
+            event = self._active.get(ident)
+            if event is None or event.dispatchable:
+                continue
+            del self._active[ident]
+            if ident not in self._pending:
+                if event.fd >= 0:
+                    backend.update(event.fd, 0)
+                elif ident < 0:
+                    self._neg_idents.clr(-1 * ident)
+        self._dead = []
+
+        for ident, event in self._pending.iteritems():
+            old = self._active.get(ident)
+            if old is not None:
+                # re-adding an fd that is still active replaces its event
+                old.dispatchable = False
+                self._timers.cancel(old)
+            self._active[ident] = event
             if event.fd >= 0:
-                if event.mask & READ:
-                    r.append(event.fd)
-                if event.mask & WRITE:
-                    w.append(event.fd)
-                if event.mask & WRITE or event.mask & READ:
-                    e.append(event.fd)
-        return r, w, e
-
-    def _select(self):
-        r, w, e = self._make_select_args()
-        try:
-            r, w, e = select.select(r, w, e, self.min_timeout / 1000.0)
-        except select.error as e:
-            if e.errno != errno.EINTR:
-                raise
+                # the fd may still be registered for an event that was
+                # killed or replaced since, and may have been closed and
+                # its number reused meanwhile: refresh() costs one modify
+                backend.refresh(event.fd, event.mask)
+            if event.has_timeout():
+                self._timers.push(ident, event)
+        self._pending = {}
+
+    def _dispatch_timed(self, ident, event, what):
+        stats = self._stats
+        start = self._clock()
+        if what & TIMEOUT and stats is not None:
+            stats.timeouts += 1
+            stats.timer_lateness_us.add(max(0,
+                int((start - event.expires) * 1e6)))
+        self._dispatch(ident, event, what)
+        elapsed = self._clock() - start
+        if stats is not None:
+            stats.callbacks += 1
+            stats.callback_us.add(int(elapsed * 1e6))
+        ms = elapsed * 1000
+        if self.slow_callback_ms > 0 and ms > self.slow_callback_ms:
+            if stats is not None:
+                stats.slow_callbacks += 1
+            debug.warn('slow callback %s (ident=%d, what=%s) took %.1f ms' %
+                    (_fn_name(event.fn), ident, _mask_to_str(what), ms))
+
+    def _run_once(self):
+        stats = self._stats
+        ready = self._ready
+        if ready:
+            # work carried over from the last iteration's budget; finish it
+            # before polling again
+            r = ()
+            self._now = now = self._clock()
+        else:
+            timeout = self._poll_timeout()
+            if stats is None:
+                r = self._backend.poll(timeout)
+                self._now = now = self._clock()
             else:
-                return
+                before = self._clock()
+                r = self._backend.poll(timeout)
+                self._now = now = self._clock()
+                stats.poll_wait_us.add(int((now - before) * 1e6))
+        if stats is not None:
+            stats.iterations += 1
 
-        for fd in r:
-            what = 0
+        nready = len(ready)
+        for fd, what in r:
             event = self._active.get(fd)
+            if event is None or not event.dispatchable:
+                continue
             assert event.fd == fd
-            what |= READ
-            if event.has_timeout() and event.has_expired():
+            if event.has_timeout() and event.has_expired(now):
                 what |= TIMEOUT
-            self._dispatch(fd, event, what)
+            ready.append((fd, event, what))
+        for ident, event in self._timers.pop_expired(now):
+            ready.append((ident, event, TIMEOUT))
+        if stats is not None:
+            stats.events_per_wakeup.add(len(ready) - nready)
 
-        for fd in w:
-            what = 0
-            event = self._active.get(fd)
-            assert event.fd == fd
-            what |= WRITE 
-            if event.has_timeout() and event.has_expired():
-                what |= TIMEOUT
-            self._dispatch(fd, event, what)
+        if stats is not None or self.slow_callback_ms > 0:
+            dispatch = self._dispatch_timed
+        else:
+            dispatch = self._dispatch
+        max_callbacks = self.max_callbacks
+        if self.max_dispatch_ms > 0:
+            deadline = now + self.max_dispatch_ms / 1000.0
+        else:
+            deadline = None
 
-        for fd in e:
-            what = 0
-            event = self._active.get(fd)
-            assert event.fd == fd
-            what |= WRITE | READ
-            if event.has_timeout() and event.has_expired():
-                what |= TIMEOUT
-            self._dispatch(fd, event, what)
+        n = 0
+        self._dispatching = True
+        try:
+            if self._sigcounts:
+                self._run_signals()
+            while ready:
+                ident, event, what = ready.popleft()
+                if not event.dispatchable:
+                    continue
+                if event.mask & ONESHOT and not event.armed:
+                    continue
+                if what == TIMEOUT and event.timer is not None:
+                    # re-armed since its deadline was collected
+                    continue
+                dispatch(ident, event, what)
+                n += 1
+                if max_callbacks > 0 and n >= max_callbacks:
+                    break
+                if deadline is not None and self._clock() >= deadline:
+                    break
+        finally:
+            self._dispatching = False
+
+    def stats(self):
+        """Return a snapshot of the loop's stats as a dict.
 
-        for ident, event in self._active.iteritems(): 
-            if event.has_timeout() and event.has_expired():
-                self._dispatch(ident, event, TIMEOUT)
+        The snapshot always has the current number of events ('events'),
+        registered fds ('fds', not counting the loop's own waker and timerfd
+        descriptors), pending timers ('timers'), and executor jobs in flight
+        ('inflight').  A loop created with instrument=True also
+        reports counters ('iterations', 'callbacks', 'timeouts',
+        'slow_callbacks') and histograms of poll wait time, events per
+        wakeup, callback run time, and timer lateness (the time a timer
+        fired, minus its deadline).  Times are in microseconds.  Each
+        histogram is a dict with 'count', 'sum', 'max', upper bounds on the
+        'p50', 'p90', and 'p99' percentiles, and the non-empty
+        power-of-two 'buckets'.
+        """
+        d = {
+            'events': self.nevents(),
+            'fds': len(self._backend) - self._ninternal_fds(),
+            'timers': len(self._timers),
+            'inflight': self._inflight,
+        }
+        if self._stats is not None:
+            d.update(self._stats.snapshot())
+        return d
 
-        if self.min_timeout_stale:
-            self._reset_min_timeout()
+    def reset_stats(self):
+        """Zero the counters and histograms of an instrumented loop."""
+        if self._stats is not None:
+            self._stats = _LoopStats()
 
-    def _make_pollster(self):
-        pollster = select.poll()
+    def nevents(self):
+        """Return the number of events in the loop."""
+        n = len(self._pending)
         for ident, event in self._active.iteritems():
-            flags = 0
-            if event.fd >= 0:
-                if event.mask & READ:
-                    flags |= select.POLLIN
-                if event.mask & WRITE:
-                    flags |= select.POLLOUT
-                if flags:
-                    debug.debug('register fd=%d %s' %
-                            (event.fd, _poll_flags_to_str(flags)))
-                    pollster.register(event.fd, flags)
-        return pollster
+            if event.dispatchable and ident not in self._pending:
+                n += 1
+        return n - len(self._internal)
 
-    def _merge_pending(self):
-        for ident, event in self._active.items():
-            if not event.dispatchable:
-                del self._active[ident] 
-        self._active.update(self._pending)
-        self._pending = {}
+    def _ninternal_fds(self):
+        n = 0
+        for ident in self._internal:
+            if ident >= 0 and ident in self._backend:
+                n += 1
+        return n
 
-    def _poll(self):
-        self._merge_pending()
-        pollster = self._make_pollster()
+    def _alive(self):
+        return (len(self._active) > len(self._internal) or self._inflight or
+                self._soon)
 
-        while True:
-            try:
-                r = pollster.poll(self.min_timeout)
-            except select.error as e:
-                if e.errno == errno.EINTR:
-                    continue
-                else:
-                    raise
-            break
+    def _add_internal(self, fd, fn, mask, timeout=0):
+        # internal events do not keep run() going on their own
+        ident = self.add(fd, fn, mask, timeout)
+        self._internal.add(ident)
+        return ident
 
-        for fd, flags in r:
-            event = self._active.get(fd)
-            if not event.dispatchable:
-                continue
-            assert event.fd == fd
-            what = _poll_flags_to_mask(flags)
-            if event.has_timeout() and event.has_expired():
-                what |= TIMEOUT
-            self._dispatch(fd, event, what)
+    def _discard(self, ident, event):
+        # remove ident only if it still refers to this (live) event
+        if event.dispatchable and (self._pending.get(ident) is event or
+                self._active.get(ident) is event):
+            self.remove(ident)
 
-        for ident, event in self._active.iteritems(): 
-            if not event.dispatchable:
-                continue
-            if event.has_timeout() and event.has_expired():
-                self._dispatch(ident, event, TIMEOUT)
+    def _run_soon(self):
+        # only the calls queued so far; calls that these queue run in the
+        # next iteration, after a zero-timeout poll
+        soon = self._soon
+        for i in xrange(len(soon)):
+            fn, args = soon.popleft()
+            fn(*args)
+
+    def _on_signal(self, signum, frame):
+        # runs between bytecodes on the main thread; only count the signal.
+        # The C-level handler has already written to the wakeup fd.
+        self._sigcounts[signum] = self._sigcounts.get(signum, 0) + 1
+
+    def _run_signals(self):
+        # swap first: a signal that arrives meanwhile lands in the new dict
+        counts = self._sigcounts
+        self._sigcounts = {}
+        for signum, count in counts.iteritems():
+            entry = self._signals.get(signum)
+            if entry is not None:
+                entry[0](signum, count, self)
 
-        if self.min_timeout_stale:
-            self._reset_min_timeout()
+    def _on_wake(self, what, loop):
+        self._waker.drain()
+        completions = self._completions
+        while completions:
+            callback, result, exc = completions.popleft()
+            self._inflight -= 1
+            if callback is not None:
+                callback(result, exc)
+
+    def _executor_done(self, callback, result, exc):
+        # runs on an executor thread
+        self._completions.append((callback, result, exc))
+        self._waker.wake()
 
     def run(self):
         """Start the run loop.
 
-        The loop terminates when there are no more events to process
+        The loop terminates when there are no more events to process, or
+        when stop() is called.
+        """
+        while True:
+            self._run_soon()
+            self._merge_pending()
+            if self._stopped or not self._alive():
+                break
+            self._run_once()
+        self._stopped = False
+
+    def stop(self):
+        """Make run() return after the current iteration.
+
+        The events in the loop are kept, so run() can be called again.  If
+        the loop is not running, the next call to run() returns at once.
+        stop() only sets a flag and is safe to call from a signal handler.
+        """
+        self._stopped = True
+
+    def close(self):
+        """Release the resources held by the loop.
+
+        This restores the signal handlers replaced by add_signal(), stops
+        the executor threads after they finish their current jobs, and
+        closes the loop's kernel objects.
+        """
+        for signum in self._signals.keys():
+            self.remove_signal(signum)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._waker.close()
+        self._timers.close()
+        self._backend.close()
+
+    def add_signal(self, signum, fn):
+        """Deliver a signal as a loop event.
+
+        The Python-level handler only records the signal; the loop is woken
+        through signal.set_wakeup_fd() and calls fn(signum, count, loop) on
+        its own schedule, before the ready fds of the iteration, instead of
+        at an arbitrary point between callbacks.  Deliveries are coalesced:
+        a signal that arrives several times within one iteration makes a
+        single call, with count set to the number of times it arrived.
+        The kernel itself merges a signal that arrives while an earlier
+        one is still pending, so count is a lower bound on the number of
+        kill() calls.  Signal handlers do not keep run() going on their own.
+
+        add_signal() must be called from the main thread, and replaces any
+        previous handler for signum until remove_signal().
+
+        Raises:
+            ValueError: signum is invalid, or this is not the main thread.
+        """
+        if signum not in self._signals:
+            old = signal.signal(signum, self._on_signal)
+            if not self._signals:
+                self._old_wakeup_fd = signal.set_wakeup_fd(self._waker._wfd)
+            self._signals[signum] = (fn, old)
+        else:
+            self._signals[signum] = (fn, self._signals[signum][1])
+
+    def remove_signal(self, signum):
+        """Stop delivering signum, and restore its previous handler.
+
+        Raises:
+            ValueError: signum was not added with add_signal().
+        """
+        if signum not in self._signals:
+            raise ValueError('signal %d is not in run loop' % signum)
+        fn, old = self._signals.pop(signum)
+        signal.signal(signum, old)
+        self._sigcounts.pop(signum, None)
+        if not self._signals:
+            signal.set_wakeup_fd(self._old_wakeup_fd)
+            self._old_wakeup_fd = -1
+
+    def call_soon(self, fn, *args):
+        """Call fn(*args) at the start of the next loop iteration.
+
+        Deferred calls run in the order they were queued, before the loop
+        polls.  While calls are queued, the loop polls with a zero timeout.
+        call_soon() must be called from the loop's thread; other threads
+        use call_soon_threadsafe().
+        """
+        self._soon.append((fn, args))
+
+    def call_soon_threadsafe(self, fn, *args):
+        """Like call_soon(), but may be called from any thread.
+
+        The call also wakes the loop if it is sleeping in poll.  Note that a
+        loop with no events of its own exits instead of waiting for calls
+        from other threads.
+        """
+        self._soon.append((fn, args))
+        self._waker.wake()
+
+    def set_executor_threads(self, nthreads):
+        """Set the size of the thread pool used by run_in_executor().
+
+        Must be called before the first call to run_in_executor().
+
+        Raises:
+            ValueError: nthreads is not positive, or the pool already exists.
+        """
+        if nthreads <= 0:
+            raise ValueError('nthreads (%d) must be positive' % nthreads)
+        if self._executor is not None:
+            raise ValueError('executor is already running')
+        self._executor_threads = nthreads
+
+    def run_in_executor(self, fn, *args, **kwargs):
+        """Run fn(*args) on a worker thread.
+
+        Use this for blocking work (DNS lookups, disk reads, CPU-heavy
+        parsing) that would otherwise stall every other event in the loop.
+        The thread pool has DEFAULT_EXECUTOR_THREADS threads unless
+        set_executor_threads() says otherwise; jobs beyond that queue up.
+
+        Completions are delivered on the loop's thread.  Worker threads wake
+        the loop through a self-pipe, and all completions that are ready at
+        a wakeup are delivered in one dispatch.  The loop keeps running
+        while jobs are outstanding.
+
+        Args:
+            fn (func): the function to run.
+
+            args: the positional arguments to fn.
+
+            callback (func, optional): keyword-only.  Called on the loop's
+                thread as callback(result, exc).  exc is None on success;
+                otherwise result is None and exc is the exception that fn
+                raised.
+        """
+        callback = kwargs.pop('callback', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s' %
+                    ', '.join(kwargs))
+        future = None
+        if callback is None:
+            future = Future(self)
+            def callback(result, exc):
+                if future.cancelled():
+                    return
+                if exc is not None:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+        if self._executor is None:
+            self._executor = _ThreadPool(self._executor_threads,
+                    self._executor_done)
+        self._inflight += 1
+        self._executor.submit(fn, args, callback)
+        return future
+
+    def spawn(self, gen):
+        """Run the generator gen as a Task, starting in the next iteration.
+
+        See Task for what the generator may yield.  Returns the Task.
+        """
+        return Task(self, gen)
+
+    def create_future(self):
+        """Return a new Future attached to this loop."""
+        return Future(self)
+
+    def run_until_complete(self, future):
+        """Run the loop until future is done, and return its result.
+
+        The loop's other events keep being dispatched meanwhile, and stay
+        in the loop afterwards.
+
+        Raises:
+            RuntimeError: the loop ran out of events, or was stopped, before
+                the future was done.
+            The future's exception, or CancelledError.
+        """
+        def on_done(future):
+            self.stop()
+        future.add_done_callback(on_done)
+        try:
+            self.run()
+        finally:
+            future.remove_done_callback(on_done)
+        if not future.done():
+            raise RuntimeError('loop stopped before the future was done')
+        return future.result()
+
+    def _wait_fd(self, fd, mask, timeout):
+        future = Future(self)
+        if timeout > 0:
+            mask |= TIMEOUT
+        def on_event(what, loop):
+            if not future.done():
+                future.set_result(what)
+        def on_done(future):
+            if future.cancelled():
+                self._discard(fd, event)
+        self.add(fd, on_event, mask, timeout)
+        event = self._pending[fd]
+        future.add_done_callback(on_done)
+        return future
+
+    def wait_readable(self, fd, timeout=0):
+        """Return a Future that completes when fd is readable.
+
+        The result is the event mask: READ, or TIMEOUT if timeout (in
+        milliseconds) passes first.  Cancelling the future removes the
+        event from the loop.
+        """
+        return self._wait_fd(fd, READ, timeout)
+
+    def wait_writable(self, fd, timeout=0):
+        """Return a Future that completes when fd is writable.
+
+        The result is the event mask: WRITE, or TIMEOUT if timeout (in
+        milliseconds) passes first.  Cancelling the future removes the
+        event from the loop.
         """
-        poll_fn = self._get_poll_fn()
-        while self._pending or self._active:
-            poll_fn()
+        return self._wait_fd(fd, WRITE, timeout)
+
+    def sleep(self, ms, result=None):
+        """Return a Future that completes with result after ms milliseconds.
+
+        Cancelling the future removes the timer from the loop.
+        """
+        future = Future(self)
+        def on_timeout(what, loop):
+            if not future.done():
+                future.set_result(result)
+        ident = self.once(on_timeout, ms)
+        event = self._pending[ident]
+        def on_done(future):
+            if future.cancelled():
+                self._discard(ident, event)
+        future.add_done_callback(on_done)
+        return future
 
     def add(self, fd, fn, mask, timeout=0):
         """Add an event to the run loop.
@@ -238,7 +1589,19 @@ class Loop(object):
                 (READ, WRITE, and/or TIMEOUT), and loop is the run loop.
 
             mask (int): The events to listen for.  Must be READ, WRITE, and/or
-                TIMEOUT.
+                TIMEOUT, optionally combined with:
+
+                PERSIST: keep the event after it is dispatched.
+
+                EDGE: report the fd only when it becomes ready, rather than
+                for as long as it is ready (EPOLLET).  The callback must
+                drain the fd until EAGAIN.  Backends other than epoll fall
+                back to level-triggered reporting.
+
+                ONESHOT: keep the event after it is dispatched, but stop
+                listening until rearm() is called.  With epoll the fd stays
+                registered with the kernel (EPOLLONESHOT), so re-arming
+                costs a single modify call.
 
             timeout (int, optional): If mask includes TIMEOUT, the timeout
                 value in milliseconds.
@@ -254,6 +1617,13 @@ class Loop(object):
         """
         if not (mask & ALL_MASK) or (mask & ~ALL_MASK):
             raise ValueError('invalid mask %08x' % mask) 
+        if mask & (EDGE | ONESHOT):
+            if fd < 0 or not mask & (READ | WRITE):
+                raise ValueError('EDGE and ONESHOT require an fd with READ '
+                        'and/or WRITE (mask %08x)' % mask)
+            if mask & ONESHOT and mask & PERSIST:
+                raise ValueError('ONESHOT and PERSIST are exclusive (mask '
+                        '%08x)' % mask)
         if mask & TIMEOUT and timeout <= 0:
             raise ValueError('timeout (%d) must be positive', timeout)
 
@@ -266,9 +1636,10 @@ class Loop(object):
             ident = self._neg_idents.ffc()
             self._neg_idents.set(ident)
             ident *= -1
-        event = _Event(fd, fn, mask, timeout)
-        if event.has_timeout() and (event.timeout < self.min_timeout):
-            self.min_timeout = event.timeout
+        if not self._dispatching:
+            # callbacks use the time cached for the current iteration
+            self._now = self._clock()
+        event = _Event(fd, fn, mask, timeout, self._now)
         self._pending[ident] = event
 
         debug.trace_exit('ident=%d' % ident)
@@ -289,22 +1660,149 @@ class Loop(object):
         debug.trace_enter('ident=%d'% ident)
         if ident not in self._active and ident not in self._pending:
             raise ValueError('ident %d is not in run loop' % ident)
-        if ident < 0:
-            assert self._neg_idents.is_set(-1 * ident)
-            self._neg_idents.clr(-1 * ident)
         if ident in self._active:
             event = self._active[ident]
-            event.dispatchable = False
-            if event.timeout == self.min_timeout:
-                self.min_timeout_stale = True
+            if event.dispatchable:
+                self._kill(ident, event)
         if ident in self._pending:
-            event = self._pending[ident]
-            if event.timeout == self.min_timeout:
-                self.min_timeout_stale = True
             del self._pending[ident]
+            if ident < 0 and ident not in self._active:
+                self._neg_idents.clr(-1 * ident)
+        self._internal.discard(ident)
+        self._fdhandlers.pop(ident, None)
 
         debug.trace_exit()
 
+    def rearm(self, ident, mask=None):
+        """Re-enable a ONESHOT event after it has been dispatched.
+
+        Args:
+            ident (int): identifier of the ONESHOT event
+
+            mask (int, optional): the READ and/or WRITE interest to re-arm
+                with.  Defaults to the event's current interest.  The other
+                flags of the event are kept.
+
+        Raises:
+            ValueError: the event does not exist, is not a ONESHOT event, or
+                mask is invalid.
+        """
+        event = self._pending.get(ident) or self._active.get(ident)
+        if event is None or not event.dispatchable:
+            raise ValueError('ident %d is not in run loop' % ident)
+        if not event.mask & ONESHOT:
+            raise ValueError('ident %d is not a ONESHOT event' % ident)
+        if mask is not None:
+            if not (mask & (READ | WRITE)) or (mask & ~(READ | WRITE)):
+                raise ValueError('invalid rearm mask %08x' % mask)
+            event.mask = (event.mask & ~(READ | WRITE)) | mask
+        if self._pending.get(ident) is event:
+            # not registered yet; the next merge picks up the new mask
+            return
+        if not event.armed:
+            event.armed = True
+            if event.has_timeout():
+                event.reset_expires(self._now)
+                self._timers.push(ident, event)
+        self._backend.update(event.fd, event.mask)
+
+    def _live_handlers(self, fd):
+        h = self._fdhandlers.get(fd)
+        if h is None:
+            return None
+        event = self._pending.get(fd) or self._active.get(fd)
+        if event is not h.event or not event.dispatchable:
+            # the fd was re-added with add() since; the handlers are gone
+            del self._fdhandlers[fd]
+            return None
+        return h
+
+    def _set_handler(self, fd, reader, fn):
+        h = self._live_handlers(fd)
+        if h is None:
+            if fn is None:
+                return False
+            event = self._pending.get(fd) or self._active.get(fd)
+            if event is not None and event.dispatchable:
+                raise ValueError('fd %d already has an event' % fd)
+            h = _FdHandlers()
+        elif fn is None and (h.reader if reader else h.writer) is None:
+            return False
+        if reader:
+            h.reader = fn
+        else:
+            h.writer = fn
+
+        mask = h.mask()
+        if h.event is None:
+            self.add(fd, h.dispatch, mask | PERSIST)
+            h.event = self._pending[fd]
+            self._fdhandlers[fd] = h
+        elif not mask:
+            self.remove(fd)
+        else:
+            h.event.mask = mask | PERSIST
+            if self._active.get(fd) is h.event:
+                # already registered: just change the kernel interest
+                self._backend.update(fd, h.event.mask)
+        return True
+
+    def add_reader(self, fd, fn):
+        """Call fn whenever fd is readable, until remove_reader().
+
+        Readers and writers are registered independently of each other:
+        a connection can keep a reader for its whole life and add a writer
+        only while it has data queued.  Both share a single event on the
+        fd, so adding or removing one of them only changes the fd's
+        interest with the kernel, and takes effect in the current
+        iteration.  Adding a reader replaces any previous reader.
+
+        The fd cannot also be used with add() while it has a reader or
+        writer; remove(fd) drops both.
+
+        Args:
+            fd (int): file descriptor
+
+            fn (func): callback function.  Receives two parameters: READ,
+                and the run loop.
+
+        Raises:
+            ValueError: fd already has an event from add().
+        """
+        self._set_handler(fd, True, fn)
+
+    def remove_reader(self, fd):
+        """Stop calling the reader of fd.
+
+        Returns:
+            bool: True if fd had a reader.
+        """
+        return self._set_handler(fd, True, None)
+
+    def add_writer(self, fd, fn):
+        """Call fn whenever fd is writable, until remove_writer().
+
+        See add_reader().
+
+        Args:
+            fd (int): file descriptor
+
+            fn (func): callback function.  Receives two parameters: WRITE,
+                and the run loop.
+
+        Raises:
+            ValueError: fd already has an event from add().
+        """
+        self._set_handler(fd, False, fn)
+
+    def remove_writer(self, fd):
+        """Stop calling the writer of fd.
+
+        Returns:
+            bool: True if fd had a writer.
+        """
+        return self._set_handler(fd, False, None)
+
     def once(self, fn, ms):
         """Add a timer event.
 
@@ -1,11 +1,97 @@
 #!/usr/bin/env python
 
+import array
+import ctypes
+import itertools
 import struct 
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 _EOF_READ_FMT = "can't read %d bytes from IOBuffer; buffer only has %d bytes left"
 
 _EOF_WRITE_FMT = "can't write %d bytes to bounded (maxsize=%d) IOBuffer; buffer only has %d bytes available"
 
+# The fixed-size reads unpack straight from the bytearray, and writes
+# append or pack into it in place, with Struct objects compiled once,
+# instead of splicing temporary strings and parsing the format on every
+# call.  Each method does its own checks inline; a shared helper would
+# cost more in call overhead than the struct work saves.
+_U8 = struct.Struct('>B')
+_U16BE = struct.Struct('>H')
+_U32BE = struct.Struct('>I')
+_U64BE = struct.Struct('>Q')
+_U16LE = struct.Struct('<H')
+_U32LE = struct.Struct('<I')
+_U64LE = struct.Struct('<Q')
+
+# Struct objects for the formats given to read_unpack() and write_pack()
+_STRUCTS = {}
+
+# zero bytes to grow the buffer by before packing into its new end
+_PADS = ['\0' * n for n in xrange(9)]
+
+def _struct(fmt):
+    st = _STRUCTS.get(fmt)
+    if st is None:
+        st = _STRUCTS[fmt] = struct.Struct(fmt)
+    return st
+
+# struct byte-order prefixes, and the byte order they stand for
+_ORDERS = {'<': 'little', '>': 'big', '!': 'big', '=': sys.byteorder,
+        '@': sys.byteorder}
+
+# for each struct code read_array() takes, the array typecodes of the
+# same kind, one of which has the code's standard size
+_ARRAY_CODES = {
+    'b': 'b', 'B': 'B',
+    'h': 'hil', 'H': 'HIL',
+    'i': 'hil', 'I': 'HIL',
+    'l': 'hil', 'L': 'HIL',
+    'q': 'hil', 'Q': 'HIL',
+    'f': 'f', 'd': 'd',
+}
+
+# records unpacked per struct call by iter_records()
+_RECORD_BATCH = 256
+
+def _split_fmt(fmt):
+    # (byte order prefix, rest of fmt)
+    if fmt[:1] in _ORDERS:
+        return fmt[0], fmt[1:]
+    return '@', fmt
+
+def _array_typecode(fmt):
+    prefix, code = _split_fmt(fmt)
+    size = struct.calcsize(prefix + code)
+    for typecode in _ARRAY_CODES.get(code, ''):
+        if array.array(typecode).itemsize == size:
+            return typecode
+    raise ValueError('unsupported array format %r' % fmt)
+
+def _batch_records(fmt, st, data, count):
+    # records of a standard-size format are packed back to back, so
+    # unpack _RECORD_BATCH of them at a time with one repeated format
+    prefix, body = _split_fmt(fmt)
+    nfields = len(st.unpack_from(data))
+    batch = _struct(prefix + body * _RECORD_BATCH)
+    off = 0
+    for i in xrange(count // _RECORD_BATCH):
+        fields = iter(batch.unpack_from(data, off))
+        for record in itertools.izip(*[fields] * nfields):
+            yield record
+        off += batch.size
+    while off < len(data):
+        yield st.unpack_from(data, off)
+        off += st.size
+
+def _each_record(st, data):
+    for off in xrange(0, len(data), st.size):
+        yield st.unpack_from(data, off)
+
 class IOBuffer:
     def __init__(self, data=None, maxsize=-1):
         if data:
@@ -46,89 +132,152 @@ class IOBuffer:
         self._i = newi
         return s
 
-    def read_u8(self):
-        size = 1
+    def read_view(self, n):
+        """Like read(), but return a memoryview into the buffer, not a copy.
+
+        The buffer cannot grow while the view is alive: writes past its
+        end raise BufferError until the view is released (del).
+        """
         z = len(self._a)
-        have = z - self._i
-        if have < size:
-            raise EOFError(_EOF_READ_FMT, size, have)
-        newi = self._i + size
-        s = self._a[self._i:newi]
-        num = struct.unpack('>B', s)[0]
+        newi = self._i + min(n, z - self._i)
+        v = memoryview(self._a)[self._i:newi]
         self._i = newi
-        return num
+        return v
+
+    def _unpack(self, st):
+        i = self._i
+        newi = i + st.size
+        if newi > len(self._a):
+            raise EOFError(_EOF_READ_FMT, st.size, len(self._a) - i)
+        self._i = newi
+        return st.unpack_from(self._a, i)
+
+    def read_unpack(self, fmt):
+        return self._unpack(_struct(fmt))
+
+    def _take(self, size):
+        # advance past size bytes; return where they start
+        i = self._i
+        newi = i + size
+        if newi > len(self._a):
+            raise EOFError(_EOF_READ_FMT, size, len(self._a) - i)
+        self._i = newi
+        return i
+
+    def read_array(self, fmt, count):
+        """Read count items of fmt, one struct code with an optional byte
+        order prefix such as '>I' or '<d', into an array.array.
+
+        The items are copied out in one step and byteswapped in place if
+        fmt's byte order is not the machine's.
+        """
+        typecode = _array_typecode(fmt)
+        a = array.array(typecode)
+        i = self._take(a.itemsize * count)
+        a.fromstring(buffer(self._a, i, a.itemsize * count))
+        if _ORDERS[_split_fmt(fmt)[0]] != sys.byteorder:
+            a.byteswap()
+        return a
+
+    def iter_records(self, fmt, count):
+        """Return an iterator over count records of the struct format fmt,
+        as tuples.
+
+        The cursor moves past all of the records at once, and they are
+        copied out before iteration, so later writes do not affect them.
+        """
+        st = _struct(fmt)
+        i = self._take(st.size * count)
+        data = str(buffer(self._a, i, st.size * count))
+        if not count or _split_fmt(fmt)[0] == '@':
+            # native alignment can pad between records
+            return _each_record(st, data)
+        return _batch_records(fmt, st, data, count)
+
+    def _pin(self, i, n):
+        # a ctypes char array over bytes i to i+n-1 that holds an export
+        # of the bytearray, so that the bytearray cannot move its memory
+        # while the char array, or anything built on it, is alive
+        c = (ctypes.c_char * n).from_buffer(self._a, i)
+        c._pin = memoryview(self._a)
+        return c
+
+    def read_ndarray(self, dtype, count):
+        """Return a numpy array of the next count items of dtype that
+        views the buffer in place, without copying.
+
+        The byte order of dtype (for instance '>u4' or '<f8') is that of
+        the data; convert with astype() for arithmetic in native order.
+        As with read_view(), the buffer cannot grow while the array (or
+        a view of it) is alive: writes past its end raise BufferError.
+        numpy.frombuffer() alone would not hold the buffer in place on
+        Python 2, so the array is built over a char array that does.
+        Needs numpy.
+        """
+        if numpy is None:
+            raise ValueError('read_ndarray needs numpy, which is not installed')
+        dtype = numpy.dtype(dtype)
+        n = dtype.itemsize * count
+        i = self._take(n)
+        if not n:
+            return numpy.empty(0, dtype=dtype)
+        return numpy.frombuffer(self._pin(i, n), dtype=dtype, count=count)
+
+    def read_u8(self):
+        i = self._i
+        newi = i + 1
+        if newi > len(self._a):
+            raise EOFError(_EOF_READ_FMT, 1, len(self._a) - i)
+        self._i = newi
+        return _U8.unpack_from(self._a, i)[0]
 
     def read_u16be(self):
-        size = 2
-        z = len(self._a)
-        have = z - self._i
-        if have < size:
-            raise EOFError(_EOF_READ_FMT, size, have)
-        newi = self._i + size
-        s = self._a[self._i:newi]
-        num = struct.unpack('>H', s)[0]
+        i = self._i
+        newi = i + 2
+        if newi > len(self._a):
+            raise EOFError(_EOF_READ_FMT, 2, len(self._a) - i)
         self._i = newi
-        return num
+        return _U16BE.unpack_from(self._a, i)[0]
 
     def read_u32be(self):
-        size = 4
-        z = len(self._a)
-        have = z - self._i
-        if have < size:
-            raise EOFError(_EOF_READ_FMT, size, have)
-        newi = self._i + size
-        s = self._a[self._i:newi]
-        num = struct.unpack('>I', s)[0]
+        i = self._i
+        newi = i + 4
+        if newi > len(self._a):
+            raise EOFError(_EOF_READ_FMT, 4, len(self._a) - i)
         self._i = newi
-        return num
+        return _U32BE.unpack_from(self._a, i)[0]
 
     def read_u64be(self):
-        size = 8
-        z = len(self._a)
-        have = z - self._i
-        if have < size:
-            raise EOFError(_EOF_READ_FMT, size, have)
-        newi = self._i + size
-        s = self._a[self._i:newi]
-        num = struct.unpack('>Q', s)[0]
+        i = self._i
+        newi = i + 8
+        if newi > len(self._a):
+            raise EOFError(_EOF_READ_FMT, 8, len(self._a) - i)
         self._i = newi
-        return num
+        return _U64BE.unpack_from(self._a, i)[0]
 
     def read_u16le(self):
-        size = 2
-        z = len(self._a)
-        have = z - self._i
-        if have < size:
-            raise EOFError(_EOF_READ_FMT, size, have)
-        newi = self._i + size
-        s = self._a[self._i:newi]
-        num = struct.unpack('<H', s)[0]
+        i = self._i
+        newi = i + 2
+        if newi > len(self._a):
+            raise EOFError(_EOF_READ_FMT, 2, len(self._a) - i)
         self._i = newi
-        return num
+        return _U16LE.unpack_from(self._a, i)[0]
 
     def read_u32le(self):
-        size = 4
-        z = len(self._a)
-        have = z - self._i
-        if have < size:
-            raise EOFError(_EOF_READ_FMT, size, have)
-        newi = self._i + size
-        s = self._a[self._i:newi]
-        num = struct.unpack('<I', s)[0]
+        i = self._i
+        newi = i + 4
+        if newi > len(self._a):
+            raise EOFError(_EOF_READ_FMT, 4, len(self._a) - i)
         self._i = newi
-        return num
+        return _U32LE.unpack_from(self._a, i)[0]
 
     def read_u64le(self):
-        size = 8
-        z = len(self._a)
-        have = z - self._i
-        if have < size:
-            raise EOFError(_EOF_READ_FMT, size, have)
-        newi = self._i + size
-        s = self._a[self._i:newi]
-        num = struct.unpack('<Q', s)[0]
+        i = self._i
+        newi = i + 8
+        if newi > len(self._a):
+            raise EOFError(_EOF_READ_FMT, 8, len(self._a) - i)
         self._i = newi
-        return num
+        return _U64LE.unpack_from(self._a, i)[0]
 
     def read_line(self):
         newi = self._a.find('\n', self._i)
@@ -148,75 +297,134 @@ class IOBuffer:
         self._i = newi
         return size
 
-    def write_u8(self):
-        size = 1
-        newi = self._i + size
+    def _pack(self, st, *args):
+        size = st.size
+        i = self._i
+        newi = i + size
         if self.maxsize != -1 and newi > self.maxsize:
             raise EOFError(_EOF_WRITE_FMT, size, self.maxsize,
-                    self.maxsize - self._i)
-        self._a[self._i:newi] = struct.pack('>B', i)
+                    self.maxsize - i)
+        a = self._a
+        if i == len(a):
+            a.extend(st.pack(*args))
+        else:
+            if newi > len(a):
+                a.extend('\0' * (newi - len(a)))
+            st.pack_into(a, i, *args)
         self._i = newi
         return size
 
+    def write_u8(self, i):
+        pos = self._i
+        newi = pos + 1
+        if self.maxsize != -1 and newi > self.maxsize:
+            raise EOFError(_EOF_WRITE_FMT, 1, self.maxsize,
+                    self.maxsize - pos)
+        a = self._a
+        if pos == len(a):
+            a.extend(_U8.pack(i))
+        else:
+            if newi > len(a):
+                a.extend(_PADS[newi - len(a)])
+            _U8.pack_into(a, pos, i)
+        self._i = newi
+        return 1
+
     def write_u16be(self, i):
-        size = 2
-        newi = self._i + size
+        pos = self._i
+        newi = pos + 2
         if self.maxsize != -1 and newi > self.maxsize:
-            raise EOFError(_EOF_WRITE_FMT, size, self.maxsize,
-                    self.maxsize - self._i)
-        self._a[self._i:newi] = struct.pack('>H', i)
+            raise EOFError(_EOF_WRITE_FMT, 2, self.maxsize,
+                    self.maxsize - pos)
+        a = self._a
+        if pos == len(a):
+            a.extend(_U16BE.pack(i))
+        else:
+            if newi > len(a):
+                a.extend(_PADS[newi - len(a)])
+            _U16BE.pack_into(a, pos, i)
         self._i = newi
-        return size
+        return 2
 
     def write_u32be(self, i):
-        size = 4
-        newi = self._i + size
+        pos = self._i
+        newi = pos + 4
         if self.maxsize != -1 and newi > self.maxsize:
-            raise EOFError(_EOF_WRITE_FMT, size, self.maxsize,
-                    self.maxsize - self._i)
-        self._a[self._i:newi] = struct.pack('>I', i)
+            raise EOFError(_EOF_WRITE_FMT, 4, self.maxsize,
+                    self.maxsize - pos)
+        a = self._a
+        if pos == len(a):
+            a.extend(_U32BE.pack(i))
+        else:
+            if newi > len(a):
+                a.extend(_PADS[newi - len(a)])
+            _U32BE.pack_into(a, pos, i)
         self._i = newi
-        return size
+        return 4
 
     def write_u64be(self, i):
-        size = 8
-        newi = self._i + size
+        pos = self._i
+        newi = pos + 8
         if self.maxsize != -1 and newi > self.maxsize:
-            raise EOFError(_EOF_WRITE_FMT, size, self.maxsize,
-                    self.maxsize - self._i)
-        self._a[self._i:newi] = struct.pack('>Q', i)
+            raise EOFError(_EOF_WRITE_FMT, 8, self.maxsize,
+                    self.maxsize - pos)
+        a = self._a
+        if pos == len(a):
+            a.extend(_U64BE.pack(i))
+        else:
+            if newi > len(a):
+                a.extend(_PADS[newi - len(a)])
+            _U64BE.pack_into(a, pos, i)
         self._i = newi
-        return size
+        return 8
 
     def write_u16le(self, i):
-        size = 2
-        newi = self._i + size
+        pos = self._i
+        newi = pos + 2
         if self.maxsize != -1 and newi > self.maxsize:
-            raise EOFError(_EOF_WRITE_FMT, size, self.maxsize,
-                    self.maxsize - self._i)
-        self._a[self._i:newi] = struct.pack('<H', i)
+            raise EOFError(_EOF_WRITE_FMT, 2, self.maxsize,
+                    self.maxsize - pos)
+        a = self._a
+        if pos == len(a):
+            a.extend(_U16LE.pack(i))
+        else:
+            if newi > len(a):
+                a.extend(_PADS[newi - len(a)])
+            _U16LE.pack_into(a, pos, i)
         self._i = newi
-        return size
+        return 2
 
     def write_u32le(self, i):
-        size = 4
-        newi = self._i + size
+        pos = self._i
+        newi = pos + 4
         if self.maxsize != -1 and newi > self.maxsize:
-            raise EOFError(_EOF_WRITE_FMT, size, self.maxsize,
-                    self.maxsize - self._i)
-        self._a[self._i:newi] = struct.pack('<I', i)
+            raise EOFError(_EOF_WRITE_FMT, 4, self.maxsize,
+                    self.maxsize - pos)
+        a = self._a
+        if pos == len(a):
+            a.extend(_U32LE.pack(i))
+        else:
+            if newi > len(a):
+                a.extend(_PADS[newi - len(a)])
+            _U32LE.pack_into(a, pos, i)
         self._i = newi
-        return size
+        return 4
 
     def write_u64le(self, i):
-        size = 8
-        newi = self._i + size
+        pos = self._i
+        newi = pos + 8
         if self.maxsize != -1 and newi > self.maxsize:
-            raise EOFError(_EOF_WRITE_FMT, size, self.maxsize,
-                    self.maxsize - self._i)
-        self._a[self._i:newi] = struct.pack('<Q', i)
+            raise EOFError(_EOF_WRITE_FMT, 8, self.maxsize,
+                    self.maxsize - pos)
+        a = self._a
+        if pos == len(a):
+            a.extend(_U64LE.pack(i))
+        else:
+            if newi > len(a):
+                a.extend(_PADS[newi - len(a)])
+            _U64LE.pack_into(a, pos, i)
         self._i = newi
-        return size
+        return 8
 
     def printf(self, fmt, *args):
         s = fmt % args
@@ -230,15 +438,7 @@ class IOBuffer:
         return size
 
     def write_pack(self, fmt, *args):
-        s = struct.pack(fmt, *args)
-        size = len(s)
-        newi = self._i + size
-        if self.maxsize != -1 and newi > self.maxsize:
-            raise EOFError(_EOF_WRITE_FMT, size, self.maxsize,
-                    self.maxsize - self._i)
-        self._a[self._i:newi] = s
-        self._i = newi
-        return size
+        return self._pack(_struct(fmt), *args)
 
 if __name__ == '__main__':
     b = IOBuffer()
@@ -0,0 +1,301 @@
+"""
+Multi-process event loops
+
+A LoopGroup forks a fixed number of worker processes, each of which runs its
+own event.Loop, so that a server is not limited to a single core.  The
+parent process supervises the workers: it restarts workers that die,
+collects per-worker stats, and shuts the workers down gracefully.
+
+Workers share listening sockets in one of two ways:
+
+    - Each worker binds its own socket with reuseport_listener().  The
+      kernel then load-balances new connections across the workers
+      (SO_REUSEPORT, Linux 3.9 and later).
+
+    - The parent binds a single listening socket before calling run().  The
+      workers inherit it across fork() and all accept() on it.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import signal
+import socket
+import time
+import traceback
+
+from cigarbox import debug
+from cigarbox import event
+
+DEFAULT_STATS_INTERVAL_MS = 1000
+DEFAULT_RESTART_DELAY_MS = 1000
+DEFAULT_SHUTDOWN_TIMEOUT_MS = 5000
+
+_REAP_INTERVAL_MS = 1000
+
+# the Linux value; Python 2's socket module does not always export it
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+def reuseport_listener(address, family=socket.AF_INET, backlog=128):
+    """Return a non-blocking listening TCP socket bound with SO_REUSEPORT.
+
+    Every worker of a LoopGroup can call this with the same address; the
+    kernel then distributes incoming connections across the workers.
+    """
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+        sock.bind(address)
+        sock.listen(backlog)
+        sock.setblocking(False)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+class _Worker(object):
+    def __init__(self, index):
+        self.index = index
+        self.pid = 0
+        self.rfd = -1       # parent's end of the worker's stats pipe
+        self.rbuf = ''
+        self.restarts = 0
+        self.stats = {}
+
+class LoopGroup(object):
+    def __init__(self, nworkers, setup, on_stop=None, stats=None,
+            stats_interval=DEFAULT_STATS_INTERVAL_MS,
+            restart_delay=DEFAULT_RESTART_DELAY_MS,
+            shutdown_timeout=DEFAULT_SHUTDOWN_TIMEOUT_MS, backend=None,
+            instrument=False):
+        """Create a group of worker processes.
+
+        Args:
+            nworkers (int): the number of worker processes; typically the
+                number of cores.
+
+            setup (func): called in each worker as setup(loop, index), where
+                loop is the worker's new event.Loop and index is the
+                worker's number, from 0 to nworkers-1.  It adds the worker's
+                listeners and timers to the loop.
+
+            on_stop (func, optional): called in a worker as on_stop(loop)
+                when the worker is asked to shut down.  It should remove
+                the worker's listeners; the worker then keeps running until
+                its remaining events finish or shutdown_timeout passes.
+                Without on_stop, workers exit at once.
+
+            stats (func, optional): called in a worker as stats(loop); the
+                dict it returns is merged into the worker's stats.
+
+            stats_interval (int, optional): how often, in milliseconds, each
+                worker reports its stats to the parent.
+
+            restart_delay (int, optional): how long, in milliseconds, to
+                wait before restarting a worker that died.
+
+            shutdown_timeout (int, optional): how long, in milliseconds, a
+                stopping worker may take to finish its events.
+
+            backend (str, optional): the event.Loop backend for the workers.
+
+            instrument (bool, optional): create the workers' loops with
+                instrument=True, so their stats include the loop's counters
+                and histograms.
+        """
+        if nworkers <= 0:
+            raise ValueError('nworkers (%d) must be positive' % nworkers)
+        self._workers = [_Worker(i) for i in xrange(nworkers)]
+        self._by_pid = {}
+        self._setup = setup
+        self._on_stop = on_stop
+        self._stats = stats
+        self._stats_interval = stats_interval
+        self._restart_delay = restart_delay
+        self._shutdown_timeout = shutdown_timeout
+        self._backend = backend
+        self._instrument = instrument
+        self._loop = None
+        self._reap_ident = None
+        self._stopping = False
+
+    def run(self):
+        """Fork the workers and supervise them.
+
+        Returns once stop() has been called (directly, or by SIGTERM or
+        SIGINT to the parent) and every worker has exited.
+        """
+        self._stopping = False
+        self._loop = event.Loop()
+        try:
+            stop = lambda signum, count, loop: self.stop()
+            self._loop.add_signal(signal.SIGTERM, stop)
+            self._loop.add_signal(signal.SIGINT, stop)
+            self._loop.add_signal(signal.SIGCHLD,
+                    lambda signum, count, loop: self._reap(signum, loop))
+            for w in self._workers:
+                self._spawn(w)
+            # SIGCHLD reaps promptly; the timer keeps the loop alive until
+            # every worker has been reaped
+            self._reap_ident = self._loop.periodic(self._reap,
+                    _REAP_INTERVAL_MS)
+            self._loop.run()
+        finally:
+            self._loop.close()
+            self._loop = None
+
+    def stop(self):
+        """Ask every worker to shut down gracefully.
+
+        stop() only sets a flag and sends signals, so it is safe to call
+        from a signal handler.
+        """
+        self._stopping = True
+        for w in self._workers:
+            if w.pid:
+                try:
+                    os.kill(w.pid, signal.SIGTERM)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+
+    def stats(self):
+        """Return a dict that maps each worker index to its latest stats.
+
+        Each worker's stats hold its pid, restart count, uptime (seconds),
+        number of loop events, and the snapshot from its loop's stats()
+        ('loop'), plus whatever the stats function returned.
+        """
+        ret = {}
+        for w in self._workers:
+            d = dict(w.stats)
+            d['pid'] = w.pid
+            d['restarts'] = w.restarts
+            ret[w.index] = d
+        return ret
+
+    def _spawn(self, w):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            self._child(w, wfd)
+        os.close(wfd)
+        debug.debug('worker %d has pid %d' % (w.index, pid))
+        w.pid = pid
+        w.rfd = rfd
+        w.rbuf = ''
+        self._by_pid[pid] = w
+        self._loop.add(rfd, lambda what, loop: self._read_stats(w, rfd),
+                event.READ|event.PERSIST)
+
+    def _respawn(self, w):
+        if not self._stopping:
+            self._spawn(w)
+
+    def _read_stats(self, w, rfd):
+        try:
+            data = os.read(rfd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            raise
+        if not data:
+            # the worker exited
+            self._loop.remove(rfd)
+            os.close(rfd)
+            if w.rfd == rfd:
+                w.rfd = -1
+            return
+        if w.rfd != rfd:
+            return
+        w.rbuf += data
+        lines = w.rbuf.split('\n')
+        w.rbuf = lines.pop()
+        if lines:
+            w.stats = json.loads(lines[-1])
+
+    def _reap(self, what, loop):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if not pid:
+                break
+            w = self._by_pid.pop(pid, None)
+            if w is None:
+                continue
+            w.pid = 0
+            if not self._stopping:
+                debug.warn('worker %d (pid %d) exited with status 0x%04x; '
+                        'restarting' % (w.index, pid, status))
+                w.restarts += 1
+                loop.once(lambda what, loop, w=w: self._respawn(w),
+                        self._restart_delay)
+
+        if self._stopping and not self._by_pid and self._reap_ident:
+            loop.remove(self._reap_ident)
+            self._reap_ident = None
+
+    def _child(self, w, wfd):
+        status = 1
+        try:
+            # the parent's loop (and its signal handlers) and the other
+            # workers' pipes belong to the parent; drop our copies
+            self._loop.close()
+            for other in self._workers:
+                if other.rfd >= 0:
+                    os.close(other.rfd)
+            # the parent decides when workers stop
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            status = self._worker_main(w, wfd)
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def _worker_main(self, w, wfd):
+        flags = fcntl.fcntl(wfd, fcntl.F_GETFL)
+        fcntl.fcntl(wfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        loop = event.Loop(backend=self._backend, instrument=self._instrument)
+        term = []
+        def on_term(signum, count, loop):
+            term.append(signum)
+            loop.stop()
+        loop.add_signal(signal.SIGTERM, on_term)
+
+        self._setup(loop, w.index)
+
+        started = time.time()
+        def report(what, loop):
+            d = {'index': w.index, 'pid': os.getpid(),
+                    'uptime': time.time() - started,
+                    'events': loop.nevents(),
+                    'loop': loop.stats()}
+            if self._stats:
+                d.update(self._stats(loop))
+            try:
+                os.write(wfd, json.dumps(d) + '\n')
+            except OSError as e:
+                # if the parent has fallen behind, drop this sample
+                if e.errno not in (errno.EINTR, errno.EAGAIN):
+                    raise
+        report_ident = loop.periodic(report, self._stats_interval)
+
+        loop.run()
+        if not term or not self._on_stop:
+            return 0
+
+        loop.remove(report_ident)
+        self._on_stop(loop)
+        loop.add_signal(signal.SIGALRM,
+                lambda signum, count, loop: loop.stop())
+        signal.setitimer(signal.ITIMER_REAL, self._shutdown_timeout / 1000.0)
+        loop.run()
+        return 0
@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 
 from cigarbox import bitops
+from cigarbox import sockutil
 
 class TestBitopsBitmap(unittest.TestCase):
     def setUp(self):
@@ -63,10 +70,604 @@ class TestBitopsBitmap(unittest.TestCase):
         pass
 
     def test_bitmap_zero(self):
-        pass
+        for i in (0, 63, 64, 99):
+            self._map.set(i)
+        self._map.zero()
+        self.assertEqual(self._map.ffs(), -1)
+        self._map.fill()
+        self._map.zero()
+        self.assertEqual(self._map.fls(), -1)
+
+    def test_bitmap_fill(self):
+        m = bitops.Bitmap(100, resizeable=False)
+        m.fill()
+        self.assertTrue(m.is_set(99))
+        self.assertEqual(m.ffc(), -1)
+        self.assertEqual(m.flc(), -1)
+        m.clr(70)
+        self.assertEqual(m.ffc(), 70)
+        self.assertEqual(m.flc(), 70)
+
+    def test_bitmap_ffs_fls(self):
+        m = bitops.Bitmap(1000, resizeable=False)
+        self.assertEqual(m.ffs(), -1)
+        self.assertEqual(m.fls(), -1)
+        for i in (700, 64, 129, 999):
+            m.set(i)
+        self.assertEqual(m.ffs(), 64)
+        self.assertEqual(m.fls(), 999)
+        m.clr(64)
+        m.clr(999)
+        self.assertEqual(m.ffs(), 129)
+        self.assertEqual(m.fls(), 700)
+
+    def test_bitmap_ffc_flc(self):
+        m = bitops.Bitmap(1000, resizeable=False)
+        self.assertEqual(m.ffc(), 0)
+        self.assertEqual(m.flc(), 999)
+        for i in xrange(500):
+            m.set(i)
+        for i in xrange(600, 1000):
+            m.set(i)
+        self.assertEqual(m.ffc(), 500)
+        self.assertEqual(m.flc(), 599)
+
+    def test_bitmap_ffc_grows(self):
+        m = bitops.Bitmap(64)
+        m.fill()
+        self.assertEqual(m.ffc(), 64)
+        self.assertFalse(m.is_set(64))
+        m.set(64)
+        self.assertEqual(m.ffc(), 65)
+
+    def test_bitmap_resize(self):
+        m = bitops.Bitmap(200, resizeable=False)
+        m.fill()
+        m.resize(70)
+        self.assertEqual(m.fls(), 69)
+        m.resize(300)
+        self.assertEqual(m.fls(), 69)
+        self.assertEqual(m.ffc(), 70)
+        self.assertFalse(m.is_set(299))
+        self.assertRaises(IndexError, m.is_set, 300)
+
+    def test_bitmap_range(self):
+        m = bitops.Bitmap(300, resizeable=False)
+        m.set_range(10, 200)
+        self.assertEqual(m.ffs(), 10)
+        self.assertEqual(m.fls(), 199)
+        self.assertEqual(m.popcount(), 190)
+        m.clr_range(64, 128)
+        self.assertEqual(m.popcount(), 126)
+        self.assertFalse(m.is_set(64))
+        self.assertTrue(m.is_set(128))
+        m.set_range(5, 7)
+        m.set_range(7, 7)
+        self.assertEqual(list(m.iter_set())[:3], [5, 6, 10])
+        self.assertRaises(IndexError, m.set_range, 0, 301)
+        g = bitops.Bitmap(0)
+        g.set_range(100, 130)
+        self.assertEqual(g.fls(), 129)
+
+    def test_bitmap_many(self):
+        m = bitops.Bitmap(100, resizeable=False)
+        m.set_many([3, 99, 64])
+        self.assertEqual(list(m.iter_set()), [3, 64, 99])
+        self.assertEqual(m.test_many(xrange(2, 5)), [False, True, False])
+        self.assertRaises(IndexError, m.set_many, [1, 100])
+        self.assertFalse(m.is_set(1))
+        self.assertRaises(IndexError, m.test_many, [-1])
+        g = bitops.Bitmap(0)
+        g.set_many(i for i in (7, 500))
+        self.assertEqual(list(g.iter_set()), [7, 500])
+
+    def test_bitmap_setops(self):
+        rng = random.Random(3)
+        for na, nb in ((100, 100), (1000, 70000), (70000, 64)):
+            xs = set(rng.randrange(na) for i in xrange(na // 3))
+            ys = set(rng.randrange(nb) for i in xrange(nb // 3))
+            a = bitops.Bitmap(na)
+            a.set_many(xs)
+            b = bitops.Bitmap(nb)
+            b.set_many(ys)
+            self.assertEqual(a.popcount(), len(xs))
+            self.assertEqual(list((a & b).iter_set()), sorted(xs & ys))
+            self.assertEqual(list((a | b).iter_set()), sorted(xs | ys))
+            self.assertEqual(list((a ^ b).iter_set()), sorted(xs ^ ys))
+            self.assertEqual(list(a.andnot(b).iter_set()), sorted(xs - ys))
+            self.assertEqual(list(a.iter_set()), sorted(xs))
+            a |= b
+            self.assertEqual(a.popcount(), len(xs | ys))
+
+    def test_bitmap_setops_fixed(self):
+        a = bitops.Bitmap(70, resizeable=False)
+        b = bitops.Bitmap(200)
+        b.set(10)
+        a |= b
+        self.assertTrue(a.is_set(10))
+        b.set(150)
+        self.assertRaises(IndexError, a.__ior__, b)
+        self.assertEqual((a | b).fls(), 150)
+
+    def test_bitmap_bytes(self):
+        m = bitops.Bitmap(100)
+        m.set_many([0, 9, 64, 99])
+        data = m.to_bytes()
+        self.assertEqual(len(data), 16)
+        self.assertEqual(data[:2], '\x01\x02')
+        self.assertEqual(data[12], '\x08')
+        n = bitops.Bitmap.from_bytes(data, 100)
+        self.assertEqual(list(n.iter_set()), [0, 9, 64, 99])
+        self.assertRaises(IndexError, n.is_set, 100)
+        self.assertEqual(bitops.Bitmap.from_bytes(data).fls(), 99)
+        self.assertRaises(ValueError, bitops.Bitmap.from_bytes, data, 200)
+        h = bitops.HierBitmap.from_bytes(data, 70)
+        self.assertEqual(h.fls(), 64)
+        self.assertEqual(h.ffc(), 1)
+
+    def test_bitmap_from_buffer(self):
+        buf = bytearray(16)
+        buf[1] = 0x80
+        m = bitops.Bitmap.from_buffer(buf)
+        self.assertEqual(m.ffs(), 15)
+        m.set(127)
+        self.assertEqual(buf[15], 0x80)
+        m.zero()
+        self.assertEqual(buf, bytearray(16))
+        m.set_range(0, 20)
+        self.assertEqual(m.popcount(), 20)
+        self.assertEqual(list((m & m).iter_set()), range(20))
+        self.assertRaises(IndexError, m.set, 128)
+        self.assertRaises(TypeError, bitops.Bitmap.from_buffer, 'x' * 16)
+
+    def test_bitmap_memoryview(self):
+        m = bitops.Bitmap(128)
+        m.set(8)
+        mv = m.memoryview()
+        self.assertEqual(mv.tobytes(), m.to_bytes())
+        mv[0] = '\xff'
+        self.assertEqual(m.ffc(), 9)
+        a, b = socket.socketpair()
+        try:
+            sockutil.NBBSocket(a).send_all_sync(m.memoryview())
+            self.assertEqual(b.recv(64), m.to_bytes())
+        finally:
+            a.close()
+            b.close()
+
+    def test_bitmap_memoryview_pins(self):
+        m = bitops.Bitmap(128)
+        mv = m.memoryview()[8:]
+        self.assertRaises(BufferError, m.set, 100000)
+        self.assertRaises(BufferError, m.resize, 10)
+        self.assertFalse(m.is_set(127))
+        self.assertRaises(IndexError, m.is_set, 128)
+        m.resize(100)
+        mv[0] = '\x01'
+        self.assertEqual(m.ffs(), 64)
+        del mv
+        m.set(100000)
+        self.assertEqual(m.fls(), 100000)
+
+class TestBitopsHierBitmap(unittest.TestCase):
+    def _check(self, h, m):
+        self.assertEqual(h.ffs(), m.ffs())
+        self.assertEqual(h.fls(), m.fls())
+        self.assertEqual(h.ffc(), m.ffc())
+        self.assertEqual(h.flc(), m.flc())
+
+    def test_hier_memoryview(self):
+        # writes that bypass the summaries are refused
+        h = bitops.HierBitmap(128)
+        h.set(9)
+        mv = h.memoryview()
+        self.assertTrue(mv.readonly)
+        self.assertEqual(mv.tobytes(), h.to_bytes())
+        self.assertRaises(TypeError, mv.__setitem__, 0, '\xff')
+        self.assertEqual(h.ffs(), 9)
+        self.assertEqual(h.ffc(), 0)
+        self.assertRaises(BufferError, h.set, 1000)
+        del mv
+        h.set(1000)
+        self.assertEqual(h.fls(), 1000)
+        self.assertRaises(ValueError, bitops.HierBitmap.from_buffer,
+                bytearray(16))
+
+    def test_hier_matches_bitmap(self):
+        rng = random.Random(7)
+        for nbits in (1, 64, 65, 4096, 4097, 300000):
+            h = bitops.HierBitmap(nbits, resizeable=False)
+            m = bitops.Bitmap(nbits, resizeable=False)
+            self._check(h, m)
+            for i in xrange(200):
+                j = rng.randrange(nbits)
+                if rng.random() < 0.6:
+                    h.set(j)
+                    m.set(j)
+                else:
+                    h.clr(j)
+                    m.clr(j)
+                self._check(h, m)
+            h.fill()
+            m.fill()
+            self._check(h, m)
+            h.clr(nbits // 2)
+            m.clr(nbits // 2)
+            self._check(h, m)
+
+    def test_hier_bulk(self):
+        rng = random.Random(11)
+        for nbits in (64, 200, 300000):
+            h = bitops.HierBitmap(nbits, resizeable=False)
+            m = bitops.Bitmap(nbits, resizeable=False)
+            for i in xrange(50):
+                lo = rng.randrange(nbits)
+                hi = min(nbits, lo + rng.choice((1, 70, 5000, nbits)))
+                if rng.random() < 0.5:
+                    h.set_range(lo, hi)
+                    m.set_range(lo, hi)
+                else:
+                    h.clr_range(lo, hi)
+                    m.clr_range(lo, hi)
+                self._check(h, m)
+            ids = [rng.randrange(nbits) for i in xrange(100)]
+            h.set_many(ids)
+            m.set_many(ids)
+            self._check(h, m)
+            other = bitops.Bitmap(nbits)
+            other.set_range(0, nbits // 2)
+            h ^= other
+            m ^= other
+            self._check(h, m)
+            self.assertTrue(isinstance(h & other, bitops.HierBitmap))
+
+    def test_hier_alloc(self):
+        h = bitops.HierBitmap(10000, resizeable=False)
+        for i in xrange(10000):
+            self.assertEqual(h.ffc(), i)
+            h.set(i)
+        self.assertEqual(h.ffc(), -1)
+        h.clr(5000)
+        h.clr(70)
+        self.assertEqual(h.ffc(), 70)
+        self.assertEqual(h.flc(), 5000)
+
+    def test_hier_grows(self):
+        h = bitops.HierBitmap(0)
+        for i in xrange(5000):
+            self.assertEqual(h.ffc(), i)
+            h.set(i)
+        self.assertEqual(h.fls(), 4999)
+        h.resize(100000)
+        self.assertEqual(h.ffc(), 5000)
+        self.assertEqual(h.flc(), 99999)
+        h.resize(100)
+        h.zero()
+        self.assertEqual(h.ffs(), -1)
+        self.assertEqual(h.flc(), 99)
+
+class TestBitopsMappedBitmap(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'map')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_mapped_persists(self):
+        m = bitops.MappedBitmap(self._path, 1000, resizeable=False)
+        for i in (0, 63, 64, 999):
+            m.set(i)
+        m.close()
+        m = bitops.MappedBitmap(self._path)
+        self.assertEqual(list(m.iter_set()), [0, 63, 64, 999])
+        self.assertEqual(m.memoryview().tobytes(), m.to_bytes())
+        self.assertRaises(IndexError, m.set, 1000)
+        self.assertEqual(m.ffc(), 1)
+        self.assertEqual(m.flc(), 998)
+        m.fill()
+        self.assertEqual(m.popcount(), 1000)
+        m.zero()
+        self.assertEqual(m.fls(), -1)
+        m.close()
+
+    def test_mapped_grows(self):
+        m = bitops.MappedBitmap(self._path, 0)
+        for i in xrange(5000):
+            self.assertEqual(m.ffc(), i)
+            m.set(i)
+        m.set(100000)
+        m.resize(100)
+        self.assertEqual(m.fls(), 99)
+        m.resize(200000)
+        self.assertEqual(m.fls(), 99)
+        m.close()
+        self.assertTrue(os.path.getsize(self._path) >= 16 + 200000 // 8)
+        m = bitops.MappedBitmap(self._path)
+        self.assertEqual(m.ffc(), 100)
+        self.assertTrue(m.is_set(99))
+        self.assertRaises(IndexError, m.is_set, 200000)
+        other = bitops.Bitmap(300000)
+        other.set(250000)
+        m |= other
+        self.assertEqual(m.fls(), 250000)
+        self.assertTrue(isinstance(m & other, bitops.Bitmap))
+        m.close()
+
+    def test_mapped_memoryview_pins(self):
+        m = bitops.MappedBitmap(self._path, 64)
+        mv = m.memoryview()
+        self.assertRaises(BufferError, m.set, 50000000)
+        mv[0] = 'x'
+        self.assertEqual(m.ffs(), 3)
+        del mv
+        m.set(50000000)
+        mv = m.memoryview()
+        mv[0] = '\x01'
+        self.assertEqual(m.ffs(), 0)
+        del mv
+        m.close()
+
+    def test_mapped_bad_file(self):
+        with open(self._path, 'w') as f:
+            f.write('x' * 32)
+        self.assertRaises(ValueError, bitops.MappedBitmap, self._path)
+
+class TestBitopsSharedBitmap(unittest.TestCase):
+    def _fork(self, func, n):
+        pids = []
+        for i in xrange(n):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    func()
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def test_shared_alloc(self):
+        m = bitops.SharedBitmap(nbits=5000)
+        def alloc():
+            ids = []
+            for i in xrange(1000):
+                ids.append(m.ffc_and_set())
+                if ids[-1] < 0:
+                    raise RuntimeError('out of ids')
+                # free every other id, to race with the other workers
+                if i % 2:
+                    m.clr(ids[-2])
+        self._fork(alloc, 4)
+        # two workers given the same id would leave fewer bits set
+        self.assertEqual(m.popcount(), 4 * 500)
+        m.close()
+
+    def test_shared_threads(self):
+        m = bitops.SharedBitmap(nbits=5000)
+        errors = []
+        def alloc():
+            try:
+                ids = [m.ffc_and_set() for i in xrange(500)]
+                for i in ids[::2]:
+                    m.clr(i)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=alloc) for i in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(m.popcount(), 4 * 250)
+        # a word held by one thread does not block another word
+        m._lock(0)
+        try:
+            t = threading.Thread(target=m.set, args=(64,))
+            t.start()
+            t.join(5)
+            self.assertFalse(t.is_alive())
+            self.assertTrue(m.is_set(64))
+        finally:
+            m._unlock(0)
+        m.close()
+
+    def test_shared_full(self):
+        m = bitops.SharedBitmap(nbits=70)
+        for i in xrange(70):
+            self.assertEqual(m.ffc_and_set(), i)
+        self.assertEqual(m.ffc_and_set(), -1)
+        self.assertRaises(IndexError, m.set, 70)
+        self.assertRaises(ValueError, m.resize, 100)
+        m.close()
+
+    def test_shared_attach(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'map')
+            m = bitops.SharedBitmap(path, 100)
+            n = bitops.SharedBitmap(path)
+            self.assertEqual(m.ffc_and_set(), 0)
+            self.assertEqual(n.ffc_and_set(), 1)
+            self.assertTrue(m.is_set(1))
+            n.close()
+            m.close()
+        finally:
+            shutil.rmtree(d)
+
+class TestBitopsSparseBitmap(unittest.TestCase):
+    def _check(self, s, m):
+        self.assertEqual(s.ffs(), m.ffs())
+        self.assertEqual(s.fls(), m.fls())
+        self.assertEqual(s.ffc(), m.ffc())
+        self.assertEqual(s.flc(), m.flc())
+        self.assertEqual(s.popcount(), m.popcount())
+
+    def test_sparse_matches_bitmap(self):
+        rng = random.Random(5)
+        for nbits in (1, 100, 65536, 65537, 300000):
+            s = bitops.SparseBitmap(nbits, resizeable=False)
+            m = bitops.Bitmap(nbits, resizeable=False)
+            self._check(s, m)
+            for i in xrange(300):
+                op = rng.random()
+                j = rng.randrange(nbits)
+                k = min(nbits, j + rng.choice((1, 100, 70000)))
+                if op < 0.4:
+                    s.set(j)
+                    m.set(j)
+                elif op < 0.6:
+                    s.clr(j)
+                    m.clr(j)
+                elif op < 0.8:
+                    s.set_range(j, k)
+                    m.set_range(j, k)
+                else:
+                    s.clr_range(j, k)
+                    m.clr_range(j, k)
+                self._check(s, m)
+            self.assertEqual(list(s.iter_set()), list(m.iter_set()))
+            s.optimize()
+            self._check(s, m)
+            self.assertEqual(list(s.iter_set()), list(m.iter_set()))
+            s.fill()
+            m.fill()
+            self._check(s, m)
+
+    def test_sparse_chunk_forms(self):
+        s = bitops.SparseBitmap(20000)
+        # fill an array chunk past its limit, then empty it again
+        for i in xrange(0, 20000, 2):
+            s.set(i)
+        self.assertEqual(s.popcount(), 10000)
+        for i in xrange(0, 20000, 2):
+            self.assertTrue(s.is_set(i))
+            self.assertFalse(s.is_set(i + 1))
+        for i in xrange(0, 19000, 2):
+            s.clr(i)
+        self.assertEqual(s.ffs(), 19000)
+        self.assertEqual(s.ffc(), 0)
+        self.assertEqual(s.popcount(), 500)
+
+    def test_sparse_huge(self):
+        s = bitops.SparseBitmap(0)
+        s.set(4000000000)
+        self.assertTrue(s.is_set(4000000000))
+        self.assertEqual(s.ffs(), 4000000000)
+        self.assertEqual(s.flc(), 3999999999)
+        s.set_range(1 << 20, 1 << 32)
+        self.assertEqual(s.popcount(), (1 << 32) - (1 << 20))
+        self.assertEqual(s.ffc(), 0)
+        s.set_range(0, 1 << 20)
+        self.assertEqual(s.ffc(), 1 << 32)
+        s.clr(123456789)
+        self.assertEqual(s.ffc(), 123456789)
+
+    def test_sparse_setops(self):
+        rng = random.Random(9)
+        xs = set(rng.randrange(1 << 24) for i in xrange(5000))
+        xs.update(xrange(100, 9000))
+        ys = set(rng.randrange(1 << 20) for i in xrange(5000))
+        a = bitops.SparseBitmap(0)
+        a.set_many(xs)
+        b = bitops.SparseBitmap(0)
+        b.set_many(ys)
+        b.set_range(200000, 300000)
+        ys.update(xrange(200000, 300000))
+        self.assertEqual(list((a & b).iter_set()), sorted(xs & ys))
+        self.assertEqual(list((a | b).iter_set()), sorted(xs | ys))
+        self.assertEqual(list((a ^ b).iter_set()), sorted(xs ^ ys))
+        self.assertEqual(list(a.andnot(b).iter_set()), sorted(xs - ys))
+        self.assertEqual(list(a.iter_set()), sorted(xs))
+        c = bitops.SparseBitmap(0)
+        c.set_range(250000, 400000)
+        c.set_range(0, 10)
+        self.assertEqual(list((b | c).iter_set()),
+                sorted(ys.union(xrange(250000, 400000), xrange(10))))
+        a.optimize()
+        self.assertEqual(list(a.iter_set()), sorted(xs))
+        a &= b
+        self.assertEqual(a.popcount(), len(xs & ys))
+
+    def test_sparse_fixed(self):
+        s = bitops.SparseBitmap(100, resizeable=False)
+        self.assertRaises(IndexError, s.set, 100)
+        self.assertRaises(IndexError, s.is_set, -1)
+        s.fill()
+        self.assertEqual(s.ffc(), -1)
+        self.assertEqual(s.flc(), -1)
+        s.resize(50)
+        self.assertEqual(s.fls(), 49)
+        self.assertEqual(s.test_many([0, 49]), [True, True])
+
+class TestBitopsBloomFilter(unittest.TestCase):
+    def _keys(self, prefix, n):
+        return ['%s-%d' % (prefix, i) for i in xrange(n)]
+
+    def test_bloom_membership(self):
+        f = bitops.BloomFilter(10000, 0.01)
+        keys = self._keys('in', 10000)
+        f.add_many(keys[:5000])
+        for key in keys[5000:]:
+            f.add(key)
+        self.assertTrue(all(f.contains_many(keys)))
+        self.assertTrue(keys[1234] in f)
+        self.assertTrue(u'in-7' in f)
+        fp = sum(f.contains_many(self._keys('out', 10000)))
+        self.assertTrue(fp < 200, fp)
+
+    def test_bloom_union(self):
+        a = bitops.BloomFilter(1000, 0.01)
+        b = bitops.BloomFilter(1000, 0.01)
+        a.add_many(self._keys('a', 500))
+        b.add_many(self._keys('b', 500))
+        c = a | b
+        self.assertTrue(all(c.contains_many(self._keys('a', 500))))
+        self.assertTrue(all(c.contains_many(self._keys('b', 500))))
+        self.assertFalse('b-3' in a)
+        a |= b
+        self.assertTrue('b-3' in a)
+        self.assertRaises(ValueError, a.__ior__, bitops.BloomFilter(2000))
+
+    def test_bloom_bytes(self):
+        f = bitops.BloomFilter(1000, 0.001)
+        f.add_many(self._keys('k', 1000))
+        data = f.to_bytes()
+        g = bitops.BloomFilter.from_bytes(data)
+        self.assertTrue(all(g.contains_many(self._keys('k', 1000))))
+        self.assertEqual(g.to_bytes(), data)
+        self.assertRaises(ValueError, bitops.BloomFilter.from_bytes, data[:-1])
+        self.assertRaises(ValueError,
+                bitops.CountingBloomFilter.from_bytes, data)
+
+    def test_counting_remove(self):
+        f = bitops.CountingBloomFilter(1000, 0.01)
+        keys = self._keys('k', 1000)
+        f.add_many(keys)
+        f.add(keys[0])
+        for key in keys[1:]:
+            f.remove(key)
+        self.assertTrue(keys[0] in f)
+        f.remove(keys[0])
+        self.assertTrue(keys[0] in f)
+        f.remove(keys[0])
+        self.assertFalse(any(f.contains_many(keys)))
+        self.assertRaises(KeyError, f.remove, keys[0])
+        g = bitops.CountingBloomFilter.from_bytes((f | f).to_bytes())
+        self.assertFalse(keys[0] in g)
 
 def suite():
-    return unittest.TestLoader().loadTestsFromTestCase(TestBitopsBitmap)
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestBitopsBitmap),
+        loader.loadTestsFromTestCase(TestBitopsHierBitmap),
+        loader.loadTestsFromTestCase(TestBitopsMappedBitmap),
+        loader.loadTestsFromTestCase(TestBitopsSharedBitmap),
+        loader.loadTestsFromTestCase(TestBitopsSparseBitmap),
+        loader.loadTestsFromTestCase(TestBitopsBloomFilter),
+    ])
 
 if __name__ == '__main__':
     unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,869 @@
+#!/usr/bin/env python
+
+import os
+import signal
+import socket
+import threading
+import time
+import unittest
+
+from cigarbox import event
+
+class _LoopTestMixin(object):
+    backend = None
+
+    def setUp(self):
+        self._loop = event.Loop(backend=self.backend)
+        self._rfd, self._wfd = os.pipe()
+
+    def tearDown(self):
+        self._loop.close()
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+    def test_loop_read(self):
+        got = []
+        def fn(what, loop):
+            got.append(what)
+            os.read(self._rfd, 1)
+        os.write(self._wfd, 'x')
+        self._loop.add(self._rfd, fn, event.READ)
+        self._loop.run()
+        self.assertEqual(got, [event.READ])
+
+    def test_loop_persist_read(self):
+        got = []
+        def fn(what, loop):
+            got.append(os.read(self._rfd, 1))
+            if len(got) == 3:
+                loop.remove(self._rfd)
+            else:
+                os.write(self._wfd, 'y')
+        os.write(self._wfd, 'x')
+        self._loop.add(self._rfd, fn, event.READ|event.PERSIST)
+        self._loop.run()
+        self.assertEqual(got, ['x', 'y', 'y'])
+
+    def test_loop_readd(self):
+        got = []
+        def fn(what, loop):
+            got.append(os.read(self._rfd, 1))
+            if len(got) < 3:
+                os.write(self._wfd, 'y')
+                loop.add(self._rfd, fn, event.READ)
+        os.write(self._wfd, 'x')
+        self._loop.add(self._rfd, fn, event.READ)
+        self._loop.run()
+        self.assertEqual(got, ['x', 'y', 'y'])
+        self.assertFalse(self._rfd in self._loop._backend._fds)
+
+    def test_loop_readd_calls(self):
+        # a handler that re-adds itself costs at most one modify per
+        # wakeup, never an unregister and register
+        calls = {'register': 0, 'modify': 0, 'unregister': 0}
+        backend = self._loop._backend
+        def counting(name):
+            method = getattr(backend, '_' + name)
+            def wrapper(*args):
+                calls[name] += 1
+                return method(*args)
+            return wrapper
+        for name in calls:
+            setattr(backend, '_' + name, counting(name))
+        got = []
+        def fn(what, loop):
+            got.append(os.read(self._rfd, 1))
+            if len(got) < 100:
+                os.write(self._wfd, 'y')
+                loop.add(self._rfd, fn, event.READ)
+        os.write(self._wfd, 'x')
+        self._loop.add(self._rfd, fn, event.READ)
+        self._loop.run()
+        self.assertEqual(len(got), 100)
+        self.assertEqual(calls['register'], 2)
+        self.assertEqual(calls['unregister'], 1)
+        self.assertTrue(calls['modify'] <= 99)
+
+    def test_loop_fd_reuse(self):
+        # the close-then-accept pattern: remove and close an fd, and get
+        # the same fd number back in the same iteration
+        got = []
+        def new_fn(what, loop):
+            got.append(os.read(self._rfd, 1))
+        def old_fn(what, loop):
+            got.append(os.read(self._rfd, 1))
+            loop.remove(self._rfd)
+            os.close(self._rfd)
+            os.close(self._wfd)
+            self._rfd, self._wfd = os.pipe()
+            self.assertEqual(self._rfd, rfd)
+            os.write(self._wfd, 'y')
+            loop.add(self._rfd, new_fn, event.READ)
+        rfd = self._rfd
+        os.write(self._wfd, 'x')
+        self._loop.add(self._rfd, old_fn, event.READ|event.PERSIST)
+        self._loop.once(lambda what, loop: loop.stop(), 50)
+        self._loop.run()
+        self.assertEqual(got, ['x', 'y'])
+
+    def test_loop_fd_reuse_readd(self):
+        # same, but the fd is closed without remove() and then re-added
+        got = []
+        def new_fn(what, loop):
+            got.append(os.read(self._rfd, 1))
+            loop.remove(self._rfd)
+        def old_fn(what, loop):
+            got.append(os.read(self._rfd, 1))
+            os.close(self._rfd)
+            os.close(self._wfd)
+            self._rfd, self._wfd = os.pipe()
+            os.write(self._wfd, 'y')
+            loop.add(self._rfd, new_fn, event.READ|event.PERSIST)
+        os.write(self._wfd, 'x')
+        self._loop.add(self._rfd, old_fn, event.READ|event.PERSIST)
+        self._loop.once(lambda what, loop: loop.stop(), 50)
+        self._loop.run()
+        self.assertEqual(got, ['x', 'y'])
+
+    def test_loop_fd_reuse_task(self):
+        # a task that closes its fd and waits on a new one with the same
+        # number re-arms the fd in place
+        got = []
+        def reader():
+            yield (self._rfd, event.READ)
+            got.append(os.read(self._rfd, 1))
+            os.close(self._rfd)
+            os.close(self._wfd)
+            self._rfd, self._wfd = os.pipe()
+            self._loop.once(lambda what, loop: os.write(self._wfd, 'y'), 5)
+            yield (self._rfd, event.READ)
+            got.append(os.read(self._rfd, 1))
+        os.write(self._wfd, 'x')
+        t = self._loop.spawn(reader())
+        guard = self._loop.once(lambda what, loop: t.cancel(), 500)
+        t.add_done_callback(lambda t: self._loop.remove(guard))
+        self._loop.run()
+        self.assertEqual(got, ['x', 'y'])
+
+    def test_loop_once(self):
+        got = []
+        self._loop.once(lambda what, loop: got.append(what), 1)
+        self._loop.run()
+        self.assertEqual(got, [event.TIMEOUT])
+
+    def test_loop_periodic(self):
+        got = []
+        def fn(what, loop):
+            got.append(what)
+            if len(got) == 3:
+                loop.remove(ident)
+        ident = self._loop.periodic(fn, 1)
+        self.assertTrue(ident < 0)
+        self._loop.run()
+        self.assertEqual(got, [event.TIMEOUT] * 3)
+
+    def test_loop_remove(self):
+        ident = self._loop.once(lambda what, loop: None, 1)
+        self._loop.remove(ident)
+        self.assertRaises(ValueError, self._loop.remove, ident)
+        self._loop.run()
+
+    def test_loop_oneshot(self):
+        got = []
+        def fn(what, loop):
+            got.append(os.read(self._rfd, 1))
+            if len(got) < 3:
+                loop.rearm(self._rfd)
+        def stop(what, loop):
+            loop.remove(self._rfd)
+        os.write(self._wfd, 'abcd')
+        self._loop.add(self._rfd, fn, event.READ|event.ONESHOT)
+        self._loop.once(stop, 20)
+        self._loop.run()
+        self.assertEqual(got, ['a', 'b', 'c'])
+
+    def test_loop_oneshot_timeout(self):
+        got = []
+        def fn(what, loop):
+            got.append(what)
+            if what & event.READ:
+                loop.remove(self._rfd)
+            else:
+                loop.rearm(self._rfd)
+        self._loop.add(self._rfd, fn, event.READ|event.ONESHOT|event.TIMEOUT,
+                5)
+        self._loop.once(lambda what, loop: os.write(self._wfd, 'x'), 20)
+        self._loop.run()
+        self.assertEqual(got[0], event.TIMEOUT)
+        self.assertEqual(got[-1], event.READ)
+        self.assertEqual(got.count(event.READ), 1)
+
+    def test_loop_edge(self):
+        got = []
+        def fn(what, loop):
+            got.append(os.read(self._rfd, 1))
+        def stop(what, loop):
+            loop.remove(self._rfd)
+        os.write(self._wfd, 'abcd')
+        self._loop.add(self._rfd, fn, event.READ|event.EDGE|event.PERSIST)
+        self._loop.once(stop, 20)
+        self._loop.run()
+        if self.backend == 'epoll':
+            self.assertEqual(got, ['a'])
+        else:
+            self.assertEqual(got, ['a', 'b', 'c', 'd'])
+
+    def test_loop_reader_writer(self):
+        a, b = socket.socketpair()
+        queue = ['a', 'b', 'c']
+        got = []
+        def writer(what, loop):
+            a.send(queue.pop(0))
+            if not queue:
+                loop.remove_writer(a.fileno())
+        def reader(what, loop):
+            got.append(a.recv(1))
+            if len(got) == 3:
+                loop.remove_reader(a.fileno())
+                loop.remove_reader(b.fileno())
+        def echo(what, loop):
+            b.send(b.recv(1).upper())
+        self._loop.add_reader(a.fileno(), reader)
+        self._loop.add_writer(a.fileno(), writer)
+        self._loop.add_reader(b.fileno(), echo)
+        self._loop.run()
+        self.assertEqual(got, ['A', 'B', 'C'])
+        self.assertEqual(self._loop.nevents(), 0)
+        self.assertFalse(self._loop.remove_writer(a.fileno()))
+        a.close()
+        b.close()
+
+    def test_loop_reader_conflict(self):
+        fn = lambda what, loop: None
+        self._loop.add(self._rfd, fn, event.READ)
+        self.assertRaises(ValueError, self._loop.add_reader, self._rfd, fn)
+        self._loop.remove(self._rfd)
+        self._loop.add_reader(self._rfd, fn)
+        self._loop.remove(self._rfd)
+        self.assertFalse(self._loop.remove_reader(self._rfd))
+        self.assertEqual(self._loop.nevents(), 0)
+
+    def test_loop_add_invalid(self):
+        fn = lambda what, loop: None
+        self.assertRaises(ValueError, self._loop.add, -1, fn, 0)
+        self.assertRaises(ValueError, self._loop.add, -1, fn, 0x1000)
+        self.assertRaises(ValueError, self._loop.add, -1, fn, event.TIMEOUT)
+        self.assertRaises(ValueError, self._loop.add, -1, fn,
+                event.TIMEOUT|event.ONESHOT, 10)
+        self.assertRaises(ValueError, self._loop.add, self._rfd, fn,
+                event.READ|event.ONESHOT|event.PERSIST)
+        self.assertRaises(ValueError, self._loop.rearm, self._rfd)
+
+class _FakeClock(object):
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+class TestEventLoopTimers(unittest.TestCase):
+    timers = 'heap'
+
+    def setUp(self):
+        self._loop = event.Loop(timers=self.timers)
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_timers_order(self):
+        got = []
+        for ms in (30, 10, 20, 10):
+            self._loop.once(lambda what, loop, ms=ms: got.append(ms), ms)
+        self._loop.run()
+        self.assertEqual(got, [10, 10, 20, 30])
+
+    def test_timers_periodic_self_remove(self):
+        # a periodic timer that removes itself leaves nothing armed
+        got = []
+        def fn(what, loop):
+            loop.remove(ident)
+            loop.call_soon(lambda: got.append(len(loop._timers)))
+        ident = self._loop.periodic(fn, 1)
+        self._loop.run()
+        self.assertEqual(got, [0])
+
+    def test_timers_cancel(self):
+        got = []
+        idents = []
+        for ms in xrange(1, 201):
+            fn = lambda what, loop, ms=ms: got.append(ms)
+            idents.append(self._loop.once(fn, ms % 10 + 1))
+        for ident in idents[::2]:
+            self._loop.remove(ident)
+        self._loop.run()
+        self.assertEqual(sorted(got), range(2, 201, 2))
+
+    def test_timers_poll_timeout(self):
+        start = time.time()
+        self._loop.once(lambda what, loop: None, 20)
+        self._loop.run()
+        self.assertTrue(time.time() - start < 1.0)
+
+    def test_timers_ident_reuse(self):
+        a = self._loop.once(lambda what, loop: None, 1)
+        self._loop.run()
+        b = self._loop.once(lambda what, loop: None, 1)
+        self.assertEqual(a, b)
+        self._loop.run()
+
+    def test_timers_fd_timeout(self):
+        rfd, wfd = os.pipe()
+        got = []
+        def fn(what, loop):
+            got.append(what)
+        self._loop.add(rfd, fn, event.READ|event.TIMEOUT, 5)
+        self._loop.run()
+        os.close(rfd)
+        os.close(wfd)
+        self.assertEqual(got, [event.TIMEOUT])
+
+class TestEventLoopTimerfd(TestEventLoopTimers):
+    timers = 'timerfd'
+
+    def test_timerfd_custom_clock(self):
+        self.assertRaises(ValueError, event.Loop, timers='timerfd',
+                clock=_FakeClock())
+
+class TestEventLoopTimerSlack(unittest.TestCase):
+    def test_slack_coalesce(self):
+        start = time.time()
+        clock = lambda: 1000.0 + (time.time() - start)
+        loop = event.Loop(clock=clock, timer_slack_ms=100, instrument=True)
+        got = []
+        for ms in (10, 20, 30, 40, 50):
+            loop.once(lambda what, loop: got.append(loop.now()), ms)
+        loop.run()
+        self.assertEqual(len(got), 5)
+        self.assertEqual(len(set(got)), 1)
+        self.assertTrue(got[0] >= 1000.1)
+        self.assertEqual(loop.stats()['events_per_wakeup']['max'], 5)
+        loop.close()
+
+    def test_slack_timerfd(self):
+        loop = event.Loop(timers='timerfd', timer_slack_ms=20)
+        got = []
+        for ms in (5, 10, 15):
+            loop.once(lambda what, loop, ms=ms: got.append(ms), ms)
+        loop.run()
+        self.assertEqual(got, [5, 10, 15])
+        loop.close()
+
+class TestEventLoopClock(unittest.TestCase):
+    def setUp(self):
+        self._clock = _FakeClock()
+        self._loop = event.Loop(clock=self._clock)
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_clock_now(self):
+        self.assertEqual(self._loop.now(), 1000.0)
+        self._clock.t = 1001.0
+        self._loop.once(lambda what, loop: None, 1)
+        self.assertEqual(self._loop.now(), 1001.0)
+
+    def test_clock_injected(self):
+        got = []
+        def fn(what, loop):
+            got.append(loop.now())
+            if len(got) == 3:
+                loop.remove(ident)
+            self._clock.t += 60.0
+        ident = self._loop.periodic(fn, 60000)
+        self._clock.t += 60.0
+        start = time.time()
+        self._loop.run()
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual(got, [1060.0, 1120.0, 1180.0])
+
+    def test_clock_monotonic(self):
+        a = event.monotonic()
+        b = event.monotonic()
+        self.assertTrue(b >= a)
+
+class TestEventLoopExecutor(unittest.TestCase):
+    def setUp(self):
+        self._loop = event.Loop()
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_executor_result(self):
+        got = []
+        def callback(result, exc):
+            got.append((result, exc, threading.current_thread().name))
+        def fn(a, b):
+            time.sleep(0.01)
+            return a + b
+        self._loop.run_in_executor(fn, 1, 2, callback=callback)
+        self._loop.run()
+        self.assertEqual(got, [(3, None, threading.current_thread().name)])
+
+    def test_executor_exception(self):
+        got = []
+        def fn():
+            raise KeyError('x')
+        self._loop.run_in_executor(fn, callback=lambda r, e: got.append(e))
+        self._loop.run()
+        self.assertEqual(len(got), 1)
+        self.assertTrue(isinstance(got[0], KeyError))
+
+    def test_executor_batch(self):
+        got = []
+        self._loop.set_executor_threads(2)
+        for i in xrange(100):
+            self._loop.run_in_executor(lambda i: i * i, i,
+                    callback=lambda r, e: got.append(r))
+        self._loop.run()
+        self.assertEqual(sorted(got), [i * i for i in xrange(100)])
+        self.assertEqual(self._loop.nevents(), 0)
+        self.assertRaises(ValueError, self._loop.set_executor_threads, 4)
+
+    def test_executor_stress(self):
+        # many short jobs on many threads: the workers drop the GIL while
+        # they sleep, so their wake() calls race with the loop's drain,
+        # and no completion may be lost
+        self._loop.set_executor_threads(8)
+        for j in xrange(10):
+            got = []
+            def callback(r, e):
+                got.append(r)
+                if len(got) == 400:
+                    self._loop.remove(guard)
+            for i in xrange(400):
+                self._loop.run_in_executor(time.sleep, 0.0005,
+                        callback=callback)
+            guard = self._loop.once(lambda what, loop: loop.stop(), 2000)
+            self._loop.run()
+            self.assertEqual(len(got), 400)
+        self.assertFalse(self._loop._waker._pending)
+
+    def test_executor_with_timer(self):
+        got = []
+        self._loop.once(lambda what, loop: got.append('timer'), 1)
+        self._loop.run_in_executor(time.sleep, 0.05,
+                callback=lambda r, e: got.append('job'))
+        self._loop.run()
+        self.assertEqual(got, ['timer', 'job'])
+
+class TestEventLoopCallSoon(unittest.TestCase):
+    def setUp(self):
+        self._loop = event.Loop()
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_call_soon_order(self):
+        got = []
+        def fn(i):
+            got.append(i)
+            if i < 3:
+                self._loop.call_soon(fn, i + 10)
+        self._loop.call_soon(fn, 1)
+        self._loop.call_soon(fn, 2)
+        self._loop.run()
+        self.assertEqual(got, [1, 2, 11, 12])
+
+    def test_call_soon_before_poll(self):
+        got = []
+        start = time.time()
+        self._loop.periodic(lambda what, loop: loop.stop(), 1000)
+        self._loop.call_soon(got.append, 'x')
+        self._loop.call_soon(lambda: self._loop.call_soon(self._loop.stop))
+        self._loop.run()
+        self.assertEqual(got, ['x'])
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_call_soon_threadsafe(self):
+        got = []
+        def other():
+            time.sleep(0.05)
+            self._loop.call_soon_threadsafe(got.append, 'x')
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop.periodic(lambda what, loop: None, 5000)
+        t = threading.Thread(target=other)
+        start = time.time()
+        t.start()
+        self._loop.run()
+        t.join()
+        self.assertEqual(got, ['x'])
+        self.assertTrue(time.time() - start < 1.0)
+
+    def test_call_soon_threadsafe_latency(self):
+        # calls posted from many threads while the loop keeps draining its
+        # waker must each run promptly, not after the poll timeout
+        latency = []
+        def record(posted):
+            latency.append(time.time() - posted)
+            if len(latency) == 800:
+                self._loop.remove(guard)
+        def other():
+            for i in xrange(100):
+                self._loop.call_soon_threadsafe(record, time.time())
+                time.sleep(0.0005)
+        guard = self._loop.once(lambda what, loop: loop.stop(), 3000)
+        threads = [threading.Thread(target=other) for i in xrange(8)]
+        for t in threads:
+            t.start()
+        self._loop.run()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(latency), 800)
+        self.assertTrue(max(latency) < 0.5)
+
+class TestEventLoopFuture(unittest.TestCase):
+    def setUp(self):
+        self._loop = event.Loop()
+
+    def tearDown(self):
+        self._loop.close()
+
+    def test_future_result(self):
+        f = self._loop.create_future()
+        self.assertFalse(f.done())
+        self.assertRaises(ValueError, f.result)
+        self._loop.once(lambda what, loop: f.set_result(42), 1)
+        self.assertEqual(self._loop.run_until_complete(f), 42)
+        self.assertRaises(ValueError, f.set_result, 43)
+
+    def test_future_exception(self):
+        f = self._loop.create_future()
+        self._loop.call_soon(f.set_exception, KeyError('x'))
+        self.assertRaises(KeyError, self._loop.run_until_complete, f)
+        self.assertTrue(isinstance(f.exception(), KeyError))
+
+    def test_future_callbacks(self):
+        got = []
+        f = self._loop.create_future()
+        f.add_done_callback(lambda f: got.append(1))
+        f.add_done_callback(lambda f: got.append(2))
+        f.set_result(None)
+        f.add_done_callback(lambda f: got.append(3))
+        self.assertEqual(got, [])
+        self._loop.run()
+        self.assertEqual(got, [1, 2, 3])
+
+    def test_future_cancel(self):
+        f = self._loop.sleep(5000)
+        self._loop.call_soon(f.cancel)
+        start = time.time()
+        self.assertRaises(event.CancelledError, self._loop.run_until_complete,
+                f)
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual(self._loop.nevents(), 0)
+        self.assertFalse(f.cancel())
+
+    def test_future_never_done(self):
+        f = self._loop.create_future()
+        self.assertRaises(RuntimeError, self._loop.run_until_complete, f)
+
+    def test_future_sleep(self):
+        f = self._loop.sleep(10, 'done')
+        self.assertEqual(self._loop.run_until_complete(f), 'done')
+
+    def test_future_wait_readable(self):
+        rfd, wfd = os.pipe()
+        f = self._loop.wait_readable(rfd, timeout=10)
+        self.assertEqual(self._loop.run_until_complete(f), event.TIMEOUT)
+        f = self._loop.wait_readable(rfd)
+        self._loop.once(lambda what, loop: os.write(wfd, 'x'), 10)
+        self.assertEqual(self._loop.run_until_complete(f), event.READ)
+        f = self._loop.wait_writable(wfd)
+        self.assertEqual(self._loop.run_until_complete(f), event.WRITE)
+        os.close(rfd)
+        os.close(wfd)
+
+    def test_future_executor(self):
+        f = self._loop.run_in_executor(lambda a, b: a * b, 6, 7)
+        self.assertEqual(self._loop.run_until_complete(f), 42)
+
+class TestEventLoopStats(unittest.TestCase):
+    def test_stats_basic(self):
+        loop = event.Loop()
+        loop.once(lambda what, loop: None, 1000)
+        stats = loop.stats()
+        self.assertEqual(stats['events'], 1)
+        self.assertEqual(stats['fds'], 0)
+        self.assertFalse('callbacks' in stats)
+        loop.close()
+
+    def test_stats_fds(self):
+        # the loop's waker and timerfd are not counted
+        loop = event.Loop(timers='timerfd')
+        rfd, wfd = os.pipe()
+        got = []
+        def fn(what, loop):
+            got.append(loop.stats()['fds'])
+            os.write(wfd, 'x')
+        loop.add(rfd, lambda what, loop: None, event.READ)
+        loop.once(fn, 1)
+        loop.run()
+        self.assertEqual(got, [1])
+        self.assertEqual(loop.stats()['fds'], 0)
+        loop.close()
+        os.close(rfd)
+        os.close(wfd)
+
+    def test_stats_instrument(self):
+        loop = event.Loop(instrument=True)
+        got = []
+        def fn(what, loop):
+            got.append(what)
+            if len(got) == 5:
+                loop.remove(ident)
+        ident = loop.periodic(fn, 2)
+        loop.run()
+        stats = loop.stats()
+        self.assertEqual(stats['callbacks'], 5)
+        self.assertEqual(stats['timeouts'], 5)
+        self.assertEqual(stats['timer_lateness_us']['count'], 5)
+        self.assertTrue(stats['iterations'] >= 5)
+        self.assertTrue(stats['poll_wait_us']['sum'] > 0)
+        self.assertEqual(stats['events'], 0)
+        loop.reset_stats()
+        self.assertEqual(loop.stats()['callbacks'], 0)
+        loop.close()
+
+    def test_stats_slow_callback(self):
+        loop = event.Loop(instrument=True, slow_callback_ms=5)
+        loop.once(lambda what, loop: time.sleep(0.01), 1)
+        loop.once(lambda what, loop: None, 2)
+        old = event.debug.warn
+        warnings = []
+        event.debug.warn = lambda msg, self=None: warnings.append(msg)
+        try:
+            loop.run()
+        finally:
+            event.debug.warn = old
+        self.assertEqual(loop.stats()['slow_callbacks'], 1)
+        self.assertEqual(len(warnings), 1)
+        self.assertTrue('<lambda>' in warnings[0])
+        loop.close()
+
+    def test_stats_histogram(self):
+        h = event._Histogram()
+        for v in xrange(1, 101):
+            h.add(v)
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.max, 100)
+        self.assertEqual(h.percentile(50), 63)
+        self.assertEqual(h.percentile(100), 100)
+        self.assertEqual(sum(n for b, n in h.snapshot()['buckets']), 100)
+
+class TestEventLoopBudget(unittest.TestCase):
+    def setUp(self):
+        self._pipes = [os.pipe() for i in xrange(3)]
+        for rfd, wfd in self._pipes:
+            os.write(wfd, 'x')
+
+    def tearDown(self):
+        for rfd, wfd in self._pipes:
+            os.close(rfd)
+            os.close(wfd)
+
+    def _run(self, loop):
+        got = []
+        for rfd, wfd in self._pipes:
+            # never drained, so always ready
+            loop.add(rfd, lambda what, loop, rfd=rfd: got.append(rfd),
+                    event.READ|event.PERSIST)
+        def stop(what, loop):
+            got.append('timer')
+            loop.stop()
+        loop.once(stop, 20)
+        loop.run()
+        loop.close()
+        return got
+
+    def test_budget_max_callbacks(self):
+        loop = event.Loop(max_callbacks=1)
+        polls = []
+        poll = loop._backend.poll
+        def counting_poll(timeout):
+            r = poll(timeout)
+            polls.append(len(r))
+            return r
+        loop._backend.poll = counting_poll
+        got = self._run(loop)
+        self.assertEqual(got[-1], 'timer')
+        rfds = [rfd for rfd, wfd in self._pipes]
+        for i in xrange(0, len(got) - 1 - 3, 3):
+            self.assertEqual(sorted(got[i:i+3]), rfds)
+        # one poll per three single-callback iterations
+        self.assertTrue(len(polls) <= len(got) / 3 + 1)
+
+    def test_budget_max_dispatch_ms(self):
+        def slow(what, loop):
+            time.sleep(0.002)
+        loop = event.Loop(max_dispatch_ms=1)
+        for i in xrange(5):
+            loop.once(slow, 1)
+        got = self._run(loop)
+        self.assertEqual(got[-1], 'timer')
+
+class TestEventLoopSignal(unittest.TestCase):
+    def setUp(self):
+        self._loop = event.Loop()
+        self._old = signal.getsignal(signal.SIGUSR1)
+
+    def tearDown(self):
+        self._loop.close()
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), self._old)
+
+    def test_signal_delivery(self):
+        got = []
+        def fn(signum, count, loop):
+            got.append(signum)
+            loop.stop()
+        self._loop.add_signal(signal.SIGUSR1, fn)
+        self._loop.periodic(lambda what, loop: None, 5000)
+        self._loop.once(lambda what, loop: os.kill(os.getpid(),
+                signal.SIGUSR1), 10)
+        start = time.time()
+        self._loop.run()
+        self.assertEqual(got, [signal.SIGUSR1])
+        self.assertTrue(time.time() - start < 1.0)
+
+    def test_signal_storm(self):
+        got = []
+        def storm(what, loop):
+            for i in xrange(100):
+                os.kill(os.getpid(), signal.SIGUSR1)
+            got.append('storm')
+        # the storm is coalesced into one call, and no signal is lost
+        self._loop.add_signal(signal.SIGUSR1,
+                lambda s, count, loop: got.append((s, count)))
+        self._loop.once(storm, 1)
+        self._loop.once(lambda what, loop: None, 20)
+        self._loop.run()
+        self.assertEqual(got, ['storm', (signal.SIGUSR1, 100)])
+
+    def test_signal_remove(self):
+        self._loop.add_signal(signal.SIGUSR1, lambda s, count, loop: None)
+        self.assertNotEqual(signal.getsignal(signal.SIGUSR1), self._old)
+        self._loop.remove_signal(signal.SIGUSR1)
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), self._old)
+        self.assertRaises(ValueError, self._loop.remove_signal,
+                signal.SIGUSR1)
+
+class TestEventLoopSelect(_LoopTestMixin, unittest.TestCase):
+    backend = 'select'
+
+class TestEventLoopPoll(_LoopTestMixin, unittest.TestCase):
+    backend = 'poll'
+
+class TestEventLoopEpoll(_LoopTestMixin, unittest.TestCase):
+    backend = 'epoll'
+
+class TestEventLoopTask(unittest.TestCase):
+    def setUp(self):
+        self._loop = event.Loop()
+        self._rfd, self._wfd = os.pipe()
+
+    def tearDown(self):
+        self._loop.close()
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+    def test_task_io(self):
+        got = []
+        def reader():
+            while len(got) < 3:
+                what = yield (self._rfd, event.READ)
+                self.assertEqual(what, event.READ)
+                got.append(os.read(self._rfd, 1))
+        def writer():
+            for c in 'abc':
+                yield (self._wfd, event.WRITE)
+                os.write(self._wfd, c)
+                yield event.sleep(1)
+        r = self._loop.spawn(reader())
+        w = self._loop.spawn(writer())
+        self._loop.run()
+        self.assertEqual(got, ['a', 'b', 'c'])
+        self.assertTrue(r.done() and w.done())
+        self.assertEqual(self._loop.nevents(), 0)
+
+    def test_task_await_future(self):
+        def child():
+            yield event.sleep(1)
+        def parent():
+            value = yield self._loop.sleep(1, 42)
+            yield self._loop.spawn(child())
+            try:
+                yield self._loop.run_in_executor(int, 'x')
+            except ValueError:
+                self.result = value
+        self.result = None
+        t = self._loop.spawn(parent())
+        self._loop.run_until_complete(t)
+        self.assertEqual(self.result, 42)
+
+    def test_task_exception(self):
+        def fails():
+            yield event.sleep(1)
+            raise KeyError('x')
+        t = self._loop.spawn(fails())
+        self.assertRaises(KeyError, self._loop.run_until_complete, t)
+
+    def test_task_bad_yield(self):
+        def bad():
+            yield 'what'
+        t = self._loop.spawn(bad())
+        self.assertRaises(TypeError, self._loop.run_until_complete, t)
+
+    def test_task_cancel(self):
+        closed = []
+        def waits():
+            try:
+                yield (self._rfd, event.READ)
+            finally:
+                closed.append(True)
+        t = self._loop.spawn(waits())
+        self._loop.once(lambda what, loop: t.cancel(), 10)
+        self.assertRaises(event.CancelledError, self._loop.run_until_complete,
+                t)
+        self.assertEqual(closed, [True])
+        self.assertEqual(self._loop.nevents(), 0)
+
+    def test_task_many(self):
+        done = []
+        def sleeper(i):
+            yield event.sleep(i % 5)
+            done.append(i)
+        for i in xrange(1000):
+            self._loop.spawn(sleeper(i))
+        self._loop.run()
+        self.assertEqual(sorted(done), range(1000))
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestEventLoopTimers),
+        loader.loadTestsFromTestCase(TestEventLoopTimerfd),
+        loader.loadTestsFromTestCase(TestEventLoopTimerSlack),
+        loader.loadTestsFromTestCase(TestEventLoopClock),
+        loader.loadTestsFromTestCase(TestEventLoopExecutor),
+        loader.loadTestsFromTestCase(TestEventLoopCallSoon),
+        loader.loadTestsFromTestCase(TestEventLoopFuture),
+        loader.loadTestsFromTestCase(TestEventLoopTask),
+        loader.loadTestsFromTestCase(TestEventLoopStats),
+        loader.loadTestsFromTestCase(TestEventLoopBudget),
+        loader.loadTestsFromTestCase(TestEventLoopSignal),
+        loader.loadTestsFromTestCase(TestEventLoopSelect),
+        loader.loadTestsFromTestCase(TestEventLoopPoll),
+        loader.loadTestsFromTestCase(TestEventLoopEpoll),
+    ])
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
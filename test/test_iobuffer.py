@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import struct
+import unittest
+
+from cigarbox import iobuffer
+
+class TestIOBuffer(unittest.TestCase):
+    def test_iobuffer_roundtrip(self):
+        b = iobuffer.IOBuffer()
+        self.assertEqual(b.write_u8(0xab), 1)
+        b.write_u16be(0x1234)
+        b.write_u32be(0x12345678)
+        b.write_u64be(0x123456789abcdef0)
+        b.write_u16le(0x1234)
+        b.write_u32le(0x12345678)
+        b.write_u64le(0x123456789abcdef0)
+        b.write_pack('>HI', 7, 8)
+        self.assertEqual(len(b), 1 + 2 * (2 + 4 + 8) + 6)
+        self.assertEqual(str(b._a[1:3]), '\x12\x34')
+        self.assertEqual(str(b._a[15:17]), '\x34\x12')
+        b.rewind()
+        self.assertEqual(b.read_u8(), 0xab)
+        self.assertEqual(b.read_u16be(), 0x1234)
+        self.assertEqual(b.read_u32be(), 0x12345678)
+        self.assertEqual(b.read_u64be(), 0x123456789abcdef0)
+        self.assertEqual(b.read_u16le(), 0x1234)
+        self.assertEqual(b.read_u32le(), 0x12345678)
+        self.assertEqual(b.read_u64le(), 0x123456789abcdef0)
+        self.assertEqual(b.read_unpack('>HI'), (7, 8))
+        self.assertEqual(b.left(), 0)
+        self.assertRaises(EOFError, b.read_u8)
+
+    def test_iobuffer_overwrite(self):
+        b = iobuffer.IOBuffer('\x00' * 6)
+        b.write_u32be(1)
+        self.assertEqual(len(b), 6)
+        b.write_u32be(2)
+        self.assertEqual(len(b), 8)
+        b.rewind()
+        self.assertEqual(b.read_u32be(), 1)
+        self.assertEqual(b.read_u32be(), 2)
+
+    def test_iobuffer_bounded(self):
+        b = iobuffer.IOBuffer(maxsize=4)
+        b.write_u16le(1)
+        self.assertRaises(EOFError, b.write_u32le, 1)
+        b.write_u16le(2)
+        self.assertEqual(len(b), 4)
+
+    def test_iobuffer_read_view(self):
+        b = iobuffer.IOBuffer('hello, world')
+        v = b.read_view(5)
+        self.assertEqual(v.tobytes(), 'hello')
+        self.assertEqual(b.tell(), 5)
+        b._a[0] = 'j'
+        self.assertEqual(v.tobytes(), 'jello')
+        self.assertEqual(b.read_view(100).tobytes(), ', world')
+        self.assertEqual(b.read_view(1).tobytes(), '')
+
+class TestIOBufferBatch(unittest.TestCase):
+    def test_iobuffer_read_array(self):
+        data = struct.pack('>5I', 1, 2, 3, 4, 0xffffffff)
+        b = iobuffer.IOBuffer(data + struct.pack('<3Q', 5, 6, 1 << 63) + 'x')
+        self.assertEqual(list(b.read_array('>I', 5)),
+                [1, 2, 3, 4, 0xffffffff])
+        a = b.read_array('<Q', 3)
+        self.assertEqual(a.itemsize, 8)
+        self.assertEqual(list(a), [5, 6, 1 << 63])
+        self.assertEqual(b.left(), 1)
+        self.assertRaises(EOFError, b.read_array, '<H', 1)
+        self.assertEqual(list(b.read_array('B', 1)), [ord('x')])
+        self.assertRaises(ValueError, b.read_array, '>4s', 1)
+        b.rewind()
+        self.assertEqual(list(b.read_array('<d', 0)), [])
+
+    def test_iobuffer_iter_records(self):
+        recs = [(i, i * 2, i / 2.0) for i in xrange(1000)]
+        data = ''.join(struct.pack('>QHd', *r) for r in recs)
+        b = iobuffer.IOBuffer(data + '\x01\x02')
+        it = b.iter_records('>QHd', 1000)
+        self.assertEqual(b.read_u16be(), 0x0102)
+        b.rewind()
+        b.write('\xff' * 8)
+        self.assertEqual(list(it), recs)
+        b = iobuffer.IOBuffer(struct.pack('@bI', 1, 2) * 3)
+        self.assertEqual(list(b.iter_records('@bI', 3)), [(1, 2)] * 3)
+        self.assertRaises(EOFError, b.iter_records, 'B', 1)
+
+    def test_iobuffer_pin(self):
+        # what read_ndarray builds its array on, checked without numpy
+        b = iobuffer.IOBuffer(struct.pack('>3I', 1, 2, 3))
+        c = b._pin(4, 8)
+        self.assertEqual(c.raw, struct.pack('>2I', 2, 3))
+        b.write('\xff' * 8)
+        self.assertEqual(c.raw[:4], '\xff' * 4)
+        self.assertRaises(BufferError, b.write, '\xff' * 4096)
+        del c
+        b.write('\xff' * 4096)
+        self.assertEqual(len(b), 8 + 4096)
+
+    @unittest.skipIf(iobuffer.numpy is None, 'numpy is not installed')
+    def test_iobuffer_read_ndarray(self):
+        b = iobuffer.IOBuffer(struct.pack('>3I', 1, 2, 3))
+        a = b.read_ndarray('>u4', 3)
+        self.assertEqual(list(a), [1, 2, 3])
+        self.assertEqual(b.left(), 0)
+        # the array views the buffer, which cannot grow under it
+        b.rewind()
+        b.write('\x00\x00\x00\x07')
+        self.assertEqual(list(a), [7, 2, 3])
+        self.assertRaises(BufferError, b.write, '\xff' * 4096)
+        del a
+        b.write('\xff' * 4096)
+        self.assertEqual(len(b.read_ndarray('>u4', 0)), 0)
+
+    @unittest.skipIf(iobuffer.numpy is not None, 'numpy is installed')
+    def test_iobuffer_read_ndarray_no_numpy(self):
+        b = iobuffer.IOBuffer(struct.pack('>3I', 1, 2, 3))
+        self.assertRaises(ValueError, b.read_ndarray, '>u4', 3)
+        self.assertEqual(b.left(), 12)
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestIOBuffer),
+        loader.loadTestsFromTestCase(TestIOBufferBatch),
+    ])
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import os
+import signal
+import unittest
+
+from cigarbox import loopgroup
+
+class TestLoopGroup(unittest.TestCase):
+    def setUp(self):
+        self._old_alrm = signal.getsignal(signal.SIGALRM)
+
+    def tearDown(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self._old_alrm)
+
+    def _run_for(self, group, secs):
+        signal.signal(signal.SIGALRM, lambda signum, frame: group.stop())
+        signal.setitimer(signal.ITIMER_REAL, secs)
+        group.run()
+
+    def test_loopgroup_stats(self):
+        def setup(loop, index):
+            loop.periodic(lambda what, loop: None, 1000)
+        stats = lambda loop: {'hello': 'world'}
+        group = loopgroup.LoopGroup(2, setup, stats=stats, stats_interval=10,
+                instrument=True)
+        self._run_for(group, 0.3)
+        stats = group.stats()
+        self.assertEqual(sorted(stats.keys()), [0, 1])
+        for index, d in stats.iteritems():
+            self.assertEqual(d['index'], index)
+            self.assertEqual(d['hello'], 'world')
+            self.assertEqual(d['restarts'], 0)
+            self.assertEqual(d['pid'], 0)
+            self.assertTrue(d['events'] >= 1)
+            self.assertTrue(d['loop']['iterations'] > 0)
+
+    def test_loopgroup_restart(self):
+        rfd, wfd = os.pipe()
+        def setup(loop, index):
+            os.write(wfd, 'x')
+            if index == 1:
+                os._exit(3)
+            loop.periodic(lambda what, loop: None, 1000)
+        group = loopgroup.LoopGroup(2, setup, restart_delay=10)
+        self._run_for(group, 0.3)
+        os.close(wfd)
+        stats = group.stats()
+        self.assertEqual(stats[0]['restarts'], 0)
+        self.assertTrue(stats[1]['restarts'] >= 2)
+        # the last restart may have been cancelled by stop()
+        nsetups = len(os.read(rfd, 4096))
+        self.assertTrue(1 + stats[1]['restarts'] <= nsetups <=
+                2 + stats[1]['restarts'])
+        os.close(rfd)
+
+    def test_loopgroup_on_stop(self):
+        rfd, wfd = os.pipe()
+        idents = []
+        def setup(loop, index):
+            idents.append(loop.periodic(lambda what, loop: None, 1000))
+        def on_stop(loop):
+            loop.remove(idents[0])
+            loop.once(lambda what, loop: os.write(wfd, 'x'), 10)
+        group = loopgroup.LoopGroup(2, setup, on_stop=on_stop)
+        self._run_for(group, 0.2)
+        os.close(wfd)
+        self.assertEqual(os.read(rfd, 4096), 'xx')
+        os.close(rfd)
+
+    def test_loopgroup_reuseport(self):
+        a = loopgroup.reuseport_listener(('127.0.0.1', 0))
+        port = a.getsockname()[1]
+        b = loopgroup.reuseport_listener(('127.0.0.1', port))
+        self.assertEqual(b.getsockname()[1], port)
+        a.close()
+        b.close()
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(TestLoopGroup)
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())